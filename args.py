@@ -10,9 +10,9 @@ MODEL_CONFIG_CLASSES = list(MODEL_MAPPING.keys())
 MODEL_TYPES = tuple(conf.model_type for conf in MODEL_CONFIG_CLASSES)
 
 
-def parse_args():
+def parse_args(argv=None):
     """
-    config arguments for training
+    config arguments for training, from `argv` instead of sys.argv if given
     """
     parser = argparse.ArgumentParser(
         description="Finetune a transformers model on a summarization task"
@@ -69,6 +69,12 @@ def parse_args():
         default=None,
         help="Overwrite the cached training and evaluation sets",
     )
+    parser.add_argument(
+        "--preprocessing_cache_dir",
+        type=str,
+        default=None,
+        help="Share the loaded and tokenized datasets between runs through this directory",
+    )
     parser.add_argument(
         "--min_target_length",
         type=int,
@@ -210,9 +216,62 @@ def parse_args():
         default=None,
         help="Cache directory for pre-trained models.",
     )
+    parser.add_argument(
+        "--nltk_data_dir",
+        type=str,
+        default=None,
+        help="Directory searched first for the nltk data and where missing data is "
+        "downloaded (see nltk_resources.py, offline runs need it provisioned).",
+    )
+    parser.add_argument(
+        "--start_snapshot",
+        type=str,
+        default="dedup",
+        choices=("dedup", "full", "no"),
+        help="Initial weights in output_dir/start: linked to one copy in --weight_store_dir "
+        "(dedup), a full save_pretrained copy (full), or only config and tokenizer (no)",
+    )
+    parser.add_argument(
+        "--restore_best",
+        type=str,
+        default="memory",
+        choices=("memory", "disk"),
+        help="Restore the best weights for testing from a CPU copy kept since they were "
+        "saved (memory), or reload output_dir/best (disk, no extra host memory)",
+    )
+    parser.add_argument(
+        "--weight_store_dir",
+        type=str,
+        default=None,
+        help="Content-addressed store of the initial weights (default: <cache_dir>/start_weights)",
+    )
     parser.add_argument(
         "--seed", type=int, default=None, help="A seed for reproducible training."
     )
+    parser.add_argument(
+        "--activation_checkpointing",
+        type=str,
+        default="no",
+        choices=("no", "all", "negatives"),
+        help="Recompute activations in the backward pass instead of keeping them: of "
+        "every encoder/decoder layer (all), or only of the contrastive rows, which then "
+        "skip the decoder (negatives)",
+    )
+    parser.add_argument(
+        "--cpu_threads_per_process",
+        type=int,
+        default=None,
+        help="Threads of every process of a multi-process CPU launch (default: the "
+        "cores of the node split between its processes)",
+    )
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default="fp16",
+        choices=("no", "fp16", "bf16"),
+        help="Autocast precision of training and generation, fp16 needs a GPU "
+        "(fp32 on CPU), bf16 works on GPUs and CPUs",
+    )
     parser.add_argument(
         "--model_type",
         type=str,
@@ -337,6 +396,113 @@ def parse_args():
         default=0.5,
         help="Initial margin",
     )
+    parser.add_argument(
+        "--eval_steps",
+        type=int,
+        default=None,
+        help="Run validation every N optimizer steps instead of at the end of each epoch.",
+    )
+    parser.add_argument(
+        "--eval_subset_size",
+        type=int,
+        default=None,
+        help="Number of validation examples in the fixed subset used for routine validation. "
+        "The full validation set is only decoded when the subset score reaches the best checkpoint.",
+    )
+    parser.add_argument(
+        "--eval_subset_seed",
+        type=int,
+        default=None,
+        help="Seed for sampling the validation subset (defaults to --seed).",
+    )
+    parser.add_argument(
+        "--early_stopping_patience",
+        type=int,
+        default=None,
+        help="Stop training after N validations without a new best ROUGE-2.",
+    )
+    parser.add_argument(
+        "--sort_by_length",
+        type=str,
+        default="no",
+        help="Batch eval/test generation by tokenized length "
+        "(source, or source buckets then target length) instead of dataset order",
+        choices=("no", "source", "source-target"),
+    )
+    parser.add_argument(
+        "--length_budget_slack",
+        type=float,
+        default=None,
+        help="End each eval/test summary once it reaches the length asked by its "
+        "'Length of Summary: N' prompt plus this fraction of slack (e.g. 0.2), "
+        "disabled by default",
+    )
+    parser.add_argument(
+        "--tokens_per_word",
+        type=float,
+        default=1.5,
+        help="Tokens per summary word used to turn the requested length into a token budget",
+    )
+    parser.add_argument(
+        "--generation_cache",
+        type=str,
+        default=None,
+        help="sqlite file caching test summaries by model weights, generation "
+        "settings and input ids, re-running the test of a checkpoint skips beam search",
+    )
+    parser.add_argument(
+        "--generation_cache_size_mb",
+        type=float,
+        default=1024,
+        help="Size bound of --generation_cache, least recently used entries are evicted",
+    )
+    parser.add_argument(
+        "--rouge_workers",
+        type=int,
+        default=None,
+        help="Processes scoring ROUGE (default: min(8, CPU count)), 1 scores in the main process",
+    )
+    parser.add_argument(
+        "--metrics_steps",
+        type=int,
+        default=1,
+        help="Append train loss, contrastive loss, lr, throughput, data wait and peak "
+        "memory to output_dir/metrics.jsonl every N optimizer steps",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Time every train/eval/test phase (data, forward, losses, backward, "
+        "optimizer, generate, decode, ROUGE) and write output_dir/profile_summary.txt",
+    )
+    parser.add_argument(
+        "--profile_start_step",
+        type=int,
+        default=5,
+        help="First train step recorded by the torch.profiler trace of --profile",
+    )
+    parser.add_argument(
+        "--profile_steps",
+        type=int,
+        default=0,
+        help="Number of train steps recorded as a Chrome trace "
+        "(output_dir/profile_trace_<process>.json) with --profile, 0 disables the trace",
+    )
+    parser.add_argument(
+        "--prediction_format",
+        type=str,
+        default="jsonl",
+        choices=("jsonl", "parquet"),
+        help="Format of output_dir/predictions.<format>, one record per test dialogue "
+        "in the result/*.jsonl schema (parquet needs pyarrow)",
+    )
+    parser.add_argument(
+        "--legacy_gen_samples",
+        action="store_true",
+        default=False,
+        help="Also write one output_dir/gen_samples/<id>.txt per test sample",
+    )
     parser.add_argument(
         "--run_test",
         action="store_true",
@@ -349,7 +515,7 @@ def parse_args():
         default=False,
         help="Use the debug mode or not",
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Sanity checks
     if args.train_file is None and args.validation_file is None:
@@ -0,0 +1,942 @@
+import sys
+import copy
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import statistics
+import tempfile
+
+import datasets
+import torch
+import transformers
+from transformers.utils import is_offline_mode
+from accelerate import Accelerator
+
+from args import parse_args as parse_train_args
+from bert_score_s import BertScorer
+from custom_dataloader import CustomWithNegativeDataCollator
+from data_loader import data_processor, get_synonyms, load_from_dialogsum
+from generation import autocast
+from model import banded_sim_loss, sim_band_pairs
+from model_loader import enable_activation_checkpointing
+from nltk_resources import ensure_nltk_resources, required_resources
+from rouge_s import RougeScorer, py_rouge_evaluator, py_rouge_scores
+from special_token import build_tagger, lemmatize_text, simple_tokenize
+from tiny_model import build_tiny_model
+from utils import (
+    contrastive_forward,
+    cosine_embedding_loss,
+    label_smoothed_nll_loss,
+    len_adjust,
+    postprocess_text,
+)
+
+# =  =  =  =  =  =  =  =  =  = Logging Setup =  =  =  =  =  =  =  =  =  =  =  =
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+
+# data_processor logs a training sample on every call
+quiet_logger = logging.getLogger(__name__ + ".quiet")
+quiet_logger.setLevel(logging.WARNING)
+
+
+def parse_args():
+    """
+    config arguments for the benchmarks
+    """
+    parser = argparse.ArgumentParser(
+        description="Time the data and evaluation stages on the bundled data"
+    )
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        default=None,
+        help="Write the results as json, usable as a later --baseline.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="Results json of an earlier run to compare with.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Report a regression when a stage is this fraction slower than the baseline.",
+    )
+    parser.add_argument(
+        "--only",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Run only these benchmarks.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Timed runs of every benchmark."
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=1, help="Untimed runs before timing."
+    )
+    parser.add_argument(
+        "--model_name_or_path",
+        type=str,
+        default=None,
+        help="Tokenizer/model for the tokenization and collator benchmarks, "
+        "a tiny BART built from the bundled data by default (offline).",
+    )
+    parser.add_argument(
+        "--train_file",
+        type=str,
+        default="./data/dialogtest/dialogsum.train.jsonl",
+        help="Training-style dialogsum file (one summary per dialogue).",
+    )
+    parser.add_argument(
+        "--test_file",
+        type=str,
+        default="./data/dialogsum/dialogsum.test.jsonl",
+        help="Test-style dialogsum file (three summaries per dialogue).",
+    )
+    parser.add_argument(
+        "--num_samples",
+        type=int,
+        default=200,
+        help="Dialogues used by the slower NLTK benchmarks.",
+    )
+    parser.add_argument(
+        "--vocab_size",
+        type=int,
+        default=50265,
+        help="Vocabulary of the label smoothing benchmark (facebook/bart-large).",
+    )
+    parser.add_argument(
+        "--activation_budget_mb",
+        type=int,
+        default=8192,
+        help="Activation memory the checkpointing benchmarks size the largest batch for.",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument(
+        "--nltk_data_dir",
+        type=str,
+        default=None,
+        help="Directory searched first for the nltk data (punkt, and the --tagging resources).",
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+def time_function(function, repeat, warmup):
+    """run `function` warmup + repeat times, seconds of the timed runs"""
+
+    for _ in range(warmup):
+        function()
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+
+    return seconds
+
+
+def data_args(contrastive="no", tagging="no", len_input="topic-length"):
+    return argparse.Namespace(
+        contrastive=contrastive,
+        tagging=tagging,
+        len_input=len_input,
+        len_output="no",
+    )
+
+
+def train_args(args, model_path, contrastive="no"):
+    """training arguments as train.py parses them"""
+
+    return parse_train_args(
+        [
+            "--model_name_or_path",
+            model_path,
+            "--train_file",
+            args.train_file,
+            "--validation_file",
+            args.train_file,
+            "--test_file",
+            args.train_file,
+            "--text_column",
+            "dialogue",
+            "--summary_column",
+            "summary",
+            "--contrastive",
+            contrastive,
+            "--overwrite_cache",
+            "True",
+        ]
+    )
+
+
+class Context:
+    """inputs shared by the benchmarks, built on first use"""
+
+    def __init__(self, args):
+        self.args = args
+        self.cache = {}
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def get(self, name, build):
+        if name not in self.cache:
+            self.cache[name] = build()
+        return self.cache[name]
+
+    def train_samples(self):
+        return self.get(
+            "train_samples",
+            lambda: [
+                json.loads(line)
+                for line in open(self.args.train_file, "r")
+                if line.strip()
+            ][: self.args.num_samples],
+        )
+
+    def test_split(self):
+        return self.get(
+            "test_split",
+            lambda: load_from_dialogsum(data_args(), self.args.test_file),
+        )
+
+    def tokenizer_and_model(self):
+        def build():
+            if self.args.model_name_or_path is not None:
+                tokenizer = transformers.AutoTokenizer.from_pretrained(
+                    self.args.model_name_or_path
+                )
+                model = transformers.AutoModelForSeq2SeqLM.from_pretrained(
+                    self.args.model_name_or_path
+                )
+                return self.args.model_name_or_path, tokenizer, model
+            model_path = self.tempdir.name
+            tokenizer, model = build_tiny_model(model_path)
+            return model_path, tokenizer, model
+
+        return self.get("tokenizer_and_model", build)
+
+    def raw_datasets(self, contrastive):
+        def build():
+            random.seed(self.args.seed)
+            split = load_from_dialogsum(data_args(contrastive), self.args.train_file)
+            split = len_adjust(data_args(contrastive), split)
+            return datasets.DatasetDict(
+                {"train": split, "validation": split, "test": split}
+            )
+
+        return self.get("raw_datasets_" + contrastive, build)
+
+    def accelerator(self):
+        return self.get("accelerator", lambda: Accelerator(cpu=True))
+
+
+def bench_load_from_dialogsum(context):
+    return (
+        lambda: load_from_dialogsum(data_args(), context.args.test_file),
+        len(context.test_split()),
+    )
+
+
+def bench_load_from_dialogsum_random(context):
+    def run():
+        random.seed(context.args.seed)
+        load_from_dialogsum(data_args("random"), context.args.test_file)
+
+    return run, len(context.test_split())
+
+
+def bench_get_synonyms(context):
+    words = sorted(
+        {
+            word
+            for sample in context.train_samples()
+            for word in sample["topic"].split()
+            if word not in {"a", "an", "the"}
+        }
+    )
+    return lambda: [get_synonyms(word) for word in words], len(words)
+
+
+def bench_lemmatize_text(context):
+    dialogues = [sample["dialogue"] for sample in context.train_samples()]
+    return lambda: [lemmatize_text(dialogue) for dialogue in dialogues], len(dialogues)
+
+
+def bench_build_tagger(context):
+    samples = context.train_samples()
+    dialogues = [sample["dialogue"] for sample in samples]
+    lemmatized_tokens = [lemmatize_text(dialogue) for dialogue in dialogues]
+
+    def run():
+        # build_tagger tags the token lists in place
+        original_tokens = [simple_tokenize(dialogue) for dialogue in dialogues]
+        for i, sample in enumerate(samples):
+            build_tagger(original_tokens, lemmatized_tokens, sample["topic"], i)
+
+    return run, len(samples)
+
+
+def bench_len_adjust(context):
+    split = context.test_split()
+    return lambda: len_adjust(data_args(), split, "test"), len(split)
+
+
+def bench_data_processor(context):
+    model_path, tokenizer, model = context.tokenizer_and_model()
+    processor_args = train_args(context.args, model_path)
+    raw_datasets = context.raw_datasets("no")
+
+    def run():
+        data_processor(
+            quiet_logger,
+            processor_args,
+            context.accelerator(),
+            raw_datasets,
+            tokenizer,
+            model,
+        )
+
+    return run, 3 * len(raw_datasets["train"])
+
+
+def bench_negative_collator(context):
+    model_path, tokenizer, model = context.tokenizer_and_model()
+    processor_args = train_args(context.args, model_path, contrastive="random")
+    _, (train_dataset, _, _) = data_processor(
+        quiet_logger,
+        processor_args,
+        context.accelerator(),
+        context.raw_datasets("random"),
+        tokenizer,
+        model,
+    )
+    collator = CustomWithNegativeDataCollator(
+        tokenizer, model=model, label_pad_token_id=-100
+    )
+    features = [dict(feature) for feature in train_dataset]
+    batch_size = processor_args.per_device_train_batch_size
+
+    def run():
+        for start in range(0, len(features), batch_size):
+            # the collator pads labels in place
+            collator(
+                [dict(feature) for feature in features[start : start + batch_size]]
+            )
+
+    return run, len(features)
+
+
+def bench_label_smoothed_nll_loss(context):
+    generator = torch.Generator().manual_seed(context.args.seed)
+    batch_size, target_length = 8, 64
+    logits = torch.randn(
+        batch_size, target_length, context.args.vocab_size, generator=generator
+    )
+    lprobs = torch.nn.functional.log_softmax(logits, dim=-1)
+    target = torch.randint(
+        context.args.vocab_size, (batch_size, target_length), generator=generator
+    )
+    target[:, -8:] = -100
+
+    def run():
+        label_smoothed_nll_loss(lprobs, target, 0.1)
+
+    return run, batch_size * target_length
+
+
+def bench_postprocess_text(context):
+    summaries = context.test_split()["summary"]
+    return lambda: postprocess_text(summaries, summaries), len(summaries)
+
+
+def bench_py_rouge_scores(context):
+    summaries = context.test_split()["summary"]
+    predictions = summaries[1:] + summaries[:1]
+
+    def run():
+        # py_rouge_scores logs every call
+        logging.disable(logging.INFO)
+        try:
+            py_rouge_scores(predictions, summaries)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    return run, len(summaries)
+
+
+def bench_py_rouge_reference(context):
+    """the py-rouge evaluator the ROUGE engine replaces, built on every call"""
+
+    summaries = context.test_split()["summary"]
+    predictions = summaries[1:] + summaries[:1]
+
+    return (
+        lambda: py_rouge_evaluator().get_scores(predictions, summaries),
+        len(summaries),
+    )
+
+
+def bench_rouge_scorer_cold(context):
+    """ROUGE engine without cached references, checked against py-rouge"""
+
+    summaries = context.test_split()["summary"]
+    predictions = summaries[1:] + summaries[:1]
+    expected = py_rouge_evaluator().get_scores(predictions, summaries)
+    if RougeScorer().get_scores(predictions, summaries) != expected:
+        raise ValueError("RougeScorer differs from py-rouge")
+
+    return (
+        lambda: RougeScorer().get_scores(predictions, summaries),
+        len(summaries),
+    )
+
+
+def bert_score_inputs(context, num_methods=3):
+    """predictions of `num_methods` methods for every test reference, as in build_excel.ipynb"""
+
+    summaries = context.test_split()["summary"]
+    methods = [
+        summaries[shift:] + summaries[:shift] for shift in range(1, num_methods + 1)
+    ]
+    # the tiny BART has a single encoder layer
+    return context.tokenizer_and_model()[0], 1, summaries, methods
+
+
+def bert_score_notebook(model_path, num_layers, summaries, methods):
+    """one bert_score.score call per method and reference, every call re-embeds the references"""
+
+    try:
+        from bert_score import score
+    except ImportError:
+        # comparing BertScorer with itself would verify nothing
+        raise ImportError(
+            "the notebook BERTScore needs bert_score, `pip install bert-score`"
+        )
+
+    # test summaries are ordered summary1, summary2, summary3
+    size = len(summaries) // 3
+    scores = []
+    for predictions in methods:
+        for k in range(3):
+            part = slice(k * size, (k + 1) * size if k < 2 else None)
+            _, _, F = score(
+                predictions[part],
+                summaries[part],
+                model_type=model_path,
+                num_layers=num_layers,
+            )
+            scores.append(F)
+
+    return scores
+
+
+def bench_bert_score_notebook(context):
+    """BERTScore as the notebooks compute it, with bert_score.score"""
+
+    model_path, num_layers, summaries, methods = bert_score_inputs(context)
+    return (
+        lambda: bert_score_notebook(model_path, num_layers, summaries, methods),
+        len(summaries) * len(methods),
+    )
+
+
+def bench_bert_score_cached(context):
+    """BertScorer with cached reference embeddings, checked against the notebook scores"""
+
+    model_path, num_layers, summaries, methods = bert_score_inputs(context)
+    scorer = BertScorer(model_path, num_layers)
+    candidates = [prediction for predictions in methods for prediction in predictions]
+    references = summaries * len(methods)
+
+    expected = torch.cat(
+        bert_score_notebook(model_path, num_layers, summaries, methods)
+    )
+    _, _, F = scorer.score(candidates, references)
+    if not torch.allclose(F, expected, atol=1e-5):
+        raise ValueError("BertScorer differs from the notebook BERTScore")
+
+    return lambda: scorer.score(candidates, references), len(candidates)
+
+
+def precision_batch(context, batch_size=8):
+    """a padded training batch of the bundled dialogues and the model"""
+
+    _, tokenizer, model = context.tokenizer_and_model()
+    samples = context.train_samples()[:batch_size]
+    batch = tokenizer(
+        [sample["dialogue"] for sample in samples],
+        max_length=512,
+        padding=True,
+        truncation=True,
+        return_tensors="pt",
+    )
+    labels = tokenizer(
+        text_target=[sample["summary"] for sample in samples],
+        max_length=128,
+        padding=True,
+        truncation=True,
+        return_tensors="pt",
+    )["input_ids"]
+    labels[labels == tokenizer.pad_token_id] = -100
+    batch["labels"] = labels
+
+    return model, batch
+
+
+def train_step(model, batch, mixed_precision):
+    """forward under autocast, label smoothed loss in fp32 and backward, as in train.py"""
+
+    with autocast(mixed_precision, model.device):
+        outputs = model(**batch)
+    lprobs = torch.nn.functional.log_softmax(outputs.logits.float(), dim=-1)
+    loss, _ = label_smoothed_nll_loss(
+        lprobs.view(-1, lprobs.size(-1)), batch["labels"].view(-1), 0.1
+    )
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+
+    return loss.item()
+
+
+def saved_activations_mb(function):
+    """
+    MB of the activations autograd keeps for the backward pass of `function`,
+    every storage once, tensors saved while recomputing in backward excluded
+    """
+
+    storages = {}
+    in_backward = []
+
+    def pack(tensor):
+        if not in_backward and not isinstance(tensor, torch.nn.Parameter):
+            storage = tensor.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    def unpack(tensor):
+        in_backward.append(True)
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, unpack):
+        function()
+
+    return sum(storages.values()) / 2**20
+
+
+def bench_train_step(context, mixed_precision):
+    """
+    training step time, activation memory and loss of a precision, the loss
+    is compared with fp32 without dropout
+    """
+
+    model, batch = precision_batch(context)
+    model.eval()
+    loss = train_step(model, batch, mixed_precision)
+    loss_fp32 = train_step(model, batch, "no")
+    model.train()
+    stats = {
+        "loss": loss,
+        "loss_fp32": loss_fp32,
+        "saved_activations_mb": saved_activations_mb(
+            lambda: train_step(model, batch, mixed_precision)
+        ),
+    }
+
+    return (
+        lambda: train_step(model, batch, mixed_precision),
+        len(batch["labels"]),
+        stats,
+    )
+
+
+def bench_generate(context, mixed_precision):
+    """beam search time of a precision and the share of summaries equal to fp32"""
+
+    model, batch = precision_batch(context)
+    model.eval()
+
+    def run(precision=mixed_precision):
+        with torch.no_grad(), autocast(precision, model.device):
+            return model.generate(
+                batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                num_beams=4,
+                max_length=60,
+            ).tolist()
+
+    same = [a == b for a, b in zip(run(), run("no"))]
+    stats = {"same_as_fp32_percent": 100.0 * sum(same) / len(same)}
+
+    return run, len(same), stats
+
+
+def combine_batch(context, batch_size=4):
+    """a --contrastive combine batch: the positives, then two rows of other dialogues each"""
+
+    model, batch = precision_batch(context, batch_size)
+    views = {}
+    for key in ("input_ids", "attention_mask"):
+        rows = batch[key]
+        views[key] = torch.cat((rows, rows.roll(1, 0), rows.roll(2, 0)), 0)
+    views["labels"] = batch["labels"].repeat(3, 1)
+    views["decoder_input_ids"] = model.prepare_decoder_input_ids_from_labels(
+        labels=views["labels"]
+    )
+
+    return model, views
+
+
+def contrastive_step(model, batch, mode, num_positives):
+    """training step of --contrastive combine as in train.py, returns the loss"""
+
+    if mode == "negatives":
+        outputs, encoder_states = contrastive_forward(
+            model, model.get_encoder(), batch, num_positives
+        )
+    else:
+        outputs = model(**batch)
+        encoder_states = outputs.encoder_last_hidden_state
+
+    hidden_size = encoder_states.size(-1)
+    embeddings = encoder_states[:num_positives].reshape(-1, hidden_size)
+    embeddings = torch.cat((embeddings, embeddings), 0)
+    pair_embeddings = encoder_states[num_positives:].reshape(-1, hidden_size)
+    loss_cs = cosine_embedding_loss(
+        embeddings, pair_embeddings, -torch.ones(embeddings.size(0)), 0.5
+    )
+    lprobs = torch.nn.functional.log_softmax(outputs.logits[:num_positives], dim=-1)
+    loss_nll, _ = label_smoothed_nll_loss(
+        lprobs.view(-1, lprobs.size(-1)),
+        batch["labels"][:num_positives].reshape(-1),
+        0.1,
+    )
+    loss = loss_nll + loss_cs
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+
+    return loss.item()
+
+
+def bench_activation_checkpointing(context, mode, batch_size=4):
+    """
+    --contrastive combine steps of an activation checkpointing mode: time,
+    activation memory per dialogue, the largest batch whose activations fit
+    in --activation_budget_mb and the loss against the default (no dropout)
+    """
+
+    model, batch = combine_batch(context, batch_size)
+    num_tokens = int(batch["attention_mask"][:batch_size].sum()) + int(
+        (batch["labels"][:batch_size] != -100).sum()
+    )
+
+    def run():
+        if mode == "all":
+            enable_activation_checkpointing(model)
+        try:
+            return contrastive_step(model, batch, mode, batch_size)
+        finally:
+            model.gradient_checkpointing_disable()
+
+    model.eval()
+    loss = run()
+    loss_default = contrastive_step(model, batch, "no", batch_size)
+    model.train()
+    per_example_mb = saved_activations_mb(run) / batch_size
+    stats = {
+        "loss": loss,
+        "loss_default": loss_default,
+        "activations_per_example_mb": per_example_mb,
+        "max_batch_size": int(context.args.activation_budget_mb // per_example_mb),
+        "tokens": num_tokens,
+    }
+
+    return run, batch_size, stats
+
+
+def bench_checkpointing_no(context):
+    return bench_activation_checkpointing(context, "no")
+
+
+def bench_checkpointing_all(context):
+    return bench_activation_checkpointing(context, "all")
+
+
+def bench_checkpointing_negatives(context):
+    return bench_activation_checkpointing(context, "negatives")
+
+
+def sim_loss_loop(shared, tokenizer, sim_window_size):
+    """the former CTRLenModel sim loss: full cosine matrix, a loop over its diagonals"""
+
+    one_side_window_width = int((sim_window_size - 1) / 2)
+    special_token_weights = shared[tokenizer.additional_special_tokens_ids]
+    special_token_weights = torch.nn.functional.normalize(special_token_weights, dim=1)
+    cos_sim_matrix = torch.matmul(special_token_weights, special_token_weights.T)
+
+    sim_loss = 0
+    for i in range(-one_side_window_width, one_side_window_width + 1):
+        if i == 0:
+            continue
+        sim_loss += torch.diagonal(cos_sim_matrix, offset=i).sum()
+
+    sim_loss = cos_sim_matrix.sum() - 2 * sim_loss
+    return sim_loss / cos_sim_matrix.shape[0] ** 2
+
+
+def bench_sim_loss(context, num_tokens, vectorized, sim_window_size=5):
+    """
+    forward and backward of the CTRLen sim loss over `num_tokens` <len_k>
+    tokens of a bart-large sized embedding, the banded loss is checked
+    against the loop
+    """
+
+    tokenizer = copy.deepcopy(context.tokenizer_and_model()[1])
+    tokenizer.add_special_tokens(
+        {"additional_special_tokens": ["<len_{}>".format(k) for k in range(num_tokens)]}
+    )
+    generator = torch.Generator().manual_seed(context.args.seed)
+    shared = torch.nn.Parameter(torch.randn(len(tokenizer), 1024, generator=generator))
+
+    def loop():
+        loss = sim_loss_loop(shared, tokenizer, sim_window_size)
+        loss.backward()
+        return loss
+
+    # as CTRLenModel.forward, the ids and the band are built once
+    token_ids = torch.tensor(tokenizer.additional_special_tokens_ids)
+    band = sim_band_pairs(num_tokens, int((sim_window_size - 1) / 2))
+
+    def banded():
+        loss = banded_sim_loss(shared[token_ids], *band)
+        loss.backward()
+        return loss
+
+    expected, expected_grad = loop(), shared.grad.clone()
+    shared.grad = None
+    loss = banded()
+    if not torch.allclose(loss, expected, atol=1e-6) or not torch.allclose(
+        shared.grad, expected_grad, atol=1e-7
+    ):
+        raise ValueError("banded_sim_loss differs from the loop")
+
+    return banded if vectorized else loop, 1
+
+
+def bench_sim_loss_loop_100(context):
+    return bench_sim_loss(context, 100, vectorized=False)
+
+
+def bench_sim_loss_banded_100(context):
+    return bench_sim_loss(context, 100, vectorized=True)
+
+
+def bench_sim_loss_loop_1000(context):
+    return bench_sim_loss(context, 1000, vectorized=False)
+
+
+def bench_sim_loss_banded_1000(context):
+    return bench_sim_loss(context, 1000, vectorized=True)
+
+
+def bench_train_step_fp32(context):
+    return bench_train_step(context, "no")
+
+
+def bench_train_step_bf16(context):
+    return bench_train_step(context, "bf16")
+
+
+def bench_generate_fp32(context):
+    return bench_generate(context, "no")
+
+
+def bench_generate_bf16(context):
+    return bench_generate(context, "bf16")
+
+
+BENCHMARKS = {
+    "load_from_dialogsum": bench_load_from_dialogsum,
+    "load_from_dialogsum_random": bench_load_from_dialogsum_random,
+    "get_synonyms": bench_get_synonyms,
+    "lemmatize_text": bench_lemmatize_text,
+    "build_tagger": bench_build_tagger,
+    "len_adjust": bench_len_adjust,
+    "data_processor": bench_data_processor,
+    "negative_collator": bench_negative_collator,
+    "label_smoothed_nll_loss": bench_label_smoothed_nll_loss,
+    "postprocess_text": bench_postprocess_text,
+    "py_rouge_scores": bench_py_rouge_scores,
+    "py_rouge_reference": bench_py_rouge_reference,
+    "rouge_scorer_cold": bench_rouge_scorer_cold,
+    "bert_score_notebook": bench_bert_score_notebook,
+    "bert_score_cached": bench_bert_score_cached,
+    "train_step_fp32": bench_train_step_fp32,
+    "train_step_bf16": bench_train_step_bf16,
+    "generate_fp32": bench_generate_fp32,
+    "generate_bf16": bench_generate_bf16,
+    "checkpointing_no": bench_checkpointing_no,
+    "checkpointing_all": bench_checkpointing_all,
+    "checkpointing_negatives": bench_checkpointing_negatives,
+    "sim_loss_loop_100": bench_sim_loss_loop_100,
+    "sim_loss_banded_100": bench_sim_loss_banded_100,
+    "sim_loss_loop_1000": bench_sim_loss_loop_1000,
+    "sim_loss_banded_1000": bench_sim_loss_banded_1000,
+}
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "datasets": datasets.__version__,
+        "num_threads": torch.get_num_threads(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def run_benchmarks(args):
+    context = Context(args)
+    results = {}
+    for name, benchmark in BENCHMARKS.items():
+        if args.only is not None and name not in args.only:
+            continue
+
+        try:
+            # benchmarks may also return stats besides the timing
+            function, num_items, *stats = benchmark(context)
+            seconds = time_function(function, args.repeat, args.warmup)
+        except (LookupError, ImportError) as error:
+            # NLTK resources or optional packages that are not installed
+            reason = next(
+                line.strip()
+                for line in str(error).splitlines()
+                if line.strip() and not line.strip().startswith("*")
+            )
+            logger.warning("Skipping {}: {}".format(name, reason))
+            results[name] = {"skipped": reason}
+            continue
+
+        median = statistics.median(seconds)
+        results[name] = {
+            "items": num_items,
+            "repeat": len(seconds),
+            "median_s": median,
+            "min_s": min(seconds),
+            "mean_s": statistics.mean(seconds),
+            "items_per_s": num_items / median if median else None,
+        }
+        if stats:
+            results[name].update(stats[0])
+        logger.info(
+            "{}: {:.4f}s median of {} ({:.1f} items/s)".format(
+                name, median, len(seconds), results[name]["items_per_s"] or 0.0
+            )
+        )
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """median time ratio of every benchmark to the baseline, returns the regressions"""
+
+    regressions = []
+    logger.info("")
+    logger.info("benchmark | baseline (s) | current (s) | ratio")
+    for name, result in results.items():
+        base = baseline.get(name, {})
+        if "median_s" not in result or "median_s" not in base:
+            logger.info("{} | - | - | not comparable".format(name))
+            continue
+
+        ratio = result["median_s"] / base["median_s"]
+        result["baseline_median_s"] = base["median_s"]
+        result["ratio"] = ratio
+        result["regression"] = ratio > 1 + tolerance
+        if result["regression"]:
+            regressions.append(name)
+        logger.info(
+            "{} | {:.4f} | {:.4f} | {:.2f}x{}".format(
+                name,
+                base["median_s"],
+                result["median_s"],
+                ratio,
+                " REGRESSION" if result["regression"] else "",
+            )
+        )
+
+    return regressions
+
+
+def main():
+    args = parse_args()
+
+    if args.only is not None:
+        unknown = set(args.only) - set(BENCHMARKS)
+        if unknown:
+            raise ValueError(
+                "Unknown benchmarks {}, choose from {}".format(
+                    sorted(unknown), list(BENCHMARKS)
+                )
+            )
+
+    # punkt is used by most benchmarks, the tagging and synonym data only by a
+    # few, those are skipped when it cannot be provisioned
+    download = not is_offline_mode()
+    ensure_nltk_resources(
+        required_resources(), data_dir=args.nltk_data_dir, download=download
+    )
+    try:
+        ensure_nltk_resources(
+            required_resources(tagging="word", contrastive="synonym"),
+            data_dir=args.nltk_data_dir,
+            download=download,
+        )
+    except LookupError as error:
+        logger.warning(str(error))
+
+    results = run_benchmarks(args)
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+
+    if args.output_file is not None:
+        with open(args.output_file, "w") as f:
+            json.dump(
+                {
+                    "environment": environment(),
+                    "settings": vars(args),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if regressions:
+        logger.error("Slower than the baseline: {}".format(", ".join(regressions)))
+        sys.exit(1)
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# main process
+if __name__ == "__main__":
+    main()
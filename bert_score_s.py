@@ -0,0 +1,236 @@
+import os
+import hashlib
+import logging
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from transformers import AutoModel, AutoTokenizer, GPT2Tokenizer, RobertaTokenizer
+
+# settings of bert_score.score(cands, refs, lang="en") used by the notebooks
+BERTSCORE_SETTINGS = {
+    "model_type": "roberta-large",
+    "num_layers": 17,
+    "batch_size": 64,
+}
+
+
+def _layer_owner(model):
+    """the module holding the transformer layers and the name of its layer list"""
+
+    for owner, name in (
+        (getattr(model, "encoder", None), "layer"),  # bert, roberta
+        (getattr(model, "encoder", None), "block"),  # t5
+        (model, "layers"),  # bart encoder
+        (model, "layer"),
+    ):
+        if owner is not None and isinstance(
+            getattr(owner, name, None), torch.nn.ModuleList
+        ):
+            return owner, name
+    raise ValueError("cannot find the layers of {}".format(type(model).__name__))
+
+
+def load_scorer_model(model_type, num_layers=None):
+    """tokenizer and model of bert_score.get_model, cut after `num_layers` layers"""
+
+    tokenizer = AutoTokenizer.from_pretrained(model_type, use_fast=False)
+    model = AutoModel.from_pretrained(model_type)
+    if hasattr(model, "encoder") and hasattr(model, "decoder"):
+        model = model.encoder
+    if num_layers is not None:
+        owner, name = _layer_owner(model)
+        setattr(owner, name, torch.nn.ModuleList(getattr(owner, name)[:num_layers]))
+    model.eval()
+
+    return tokenizer, model
+
+
+def sent_encode(tokenizer, sentence):
+    """token ids of bert_score.utils.sent_encode"""
+
+    sentence = sentence.strip()
+    if sentence == "":
+        return tokenizer.build_inputs_with_special_tokens([])
+    if isinstance(tokenizer, (GPT2Tokenizer, RobertaTokenizer)):
+        return tokenizer.encode(
+            sentence,
+            add_special_tokens=True,
+            add_prefix_space=True,
+            max_length=tokenizer.model_max_length,
+            truncation=True,
+        )
+    return tokenizer.encode(
+        sentence,
+        add_special_tokens=True,
+        max_length=tokenizer.model_max_length,
+        truncation=True,
+    )
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class BertScorer:
+    """
+    BERTScore P/R/F of bert_score (no idf, no baseline rescaling), every unique
+    reference is embedded once, kept across calls and persisted in `cache_dir`
+    keyed by model and text hash, candidates are embedded per length-sorted
+    scoring batch and dropped after it
+    """
+
+    def __init__(
+        self,
+        model_type=BERTSCORE_SETTINGS["model_type"],
+        num_layers=BERTSCORE_SETTINGS["num_layers"],
+        batch_size=BERTSCORE_SETTINGS["batch_size"],
+        cache_dir=None,
+        device=None,
+    ):
+        self.model_type = model_type
+        self.num_layers = num_layers
+        self.batch_size = batch_size
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.tokenizer, self.model = load_scorer_model(model_type, num_layers)
+        self.model.to(self.device)
+        self.ignored_ids = {self.tokenizer.sep_token_id, self.tokenizer.cls_token_id}
+
+        self.references = {}
+        self.cache_file = None
+        self.num_cached = 0
+        if cache_dir is not None:
+            key = "{}_L{}".format(model_type, num_layers)
+            self.cache_file = os.path.join(
+                cache_dir, "bert_score_{}.pt".format(text_hash(key)[:16])
+            )
+            if os.path.exists(self.cache_file):
+                self.references = torch.load(self.cache_file)
+                self.num_cached = len(self.references)
+
+    def embed(self, texts):
+        """normalized token embeddings and token weights of every text"""
+
+        return self.embed_tokens([sent_encode(self.tokenizer, text) for text in texts])
+
+    @torch.no_grad()
+    def embed_tokens(self, tokens):
+        """`embed` of texts already encoded with sent_encode"""
+
+        order = sorted(range(len(tokens)), key=lambda i: -len(tokens[i]))
+        stats = [None] * len(tokens)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            lengths = [len(tokens[i]) for i in batch]
+            input_ids = torch.full(
+                (len(batch), max(lengths)),
+                self.tokenizer.pad_token_id,
+                dtype=torch.long,
+            )
+            attention_mask = torch.zeros_like(input_ids)
+            for row, i in enumerate(batch):
+                input_ids[row, : lengths[row]] = torch.tensor(tokens[i])
+                attention_mask[row, : lengths[row]] = 1
+            embeddings = self.model(
+                input_ids.to(self.device), attention_mask=attention_mask.to(self.device)
+            )[0]
+            embeddings = embeddings / embeddings.norm(dim=-1, keepdim=True)
+            for row, i in enumerate(batch):
+                weights = torch.tensor(
+                    [0.0 if t in self.ignored_ids else 1.0 for t in tokens[i]]
+                )
+                stats[i] = (embeddings[row, : lengths[row]].cpu(), weights)
+
+        return stats
+
+    def reference_stats(self, references):
+        """embeddings of the references, computed once per unique text"""
+
+        missing = list(
+            {
+                text_hash(reference): reference
+                for reference in references
+                if text_hash(reference) not in self.references
+            }.items()
+        )
+        if missing:
+            hashes, texts = zip(*missing)
+            self.references.update(zip(hashes, self.embed(list(texts))))
+            if self.cache_file is not None:
+                self.save()
+
+        return [self.references[text_hash(reference)] for reference in references]
+
+    def _pad(self, stats):
+        embeddings, weights = zip(*stats)
+        lengths = torch.tensor([len(weight) for weight in weights])
+        mask = torch.arange(int(lengths.max()))[None, :] < lengths[:, None]
+        return (
+            pad_sequence(embeddings, batch_first=True, padding_value=2.0).to(
+                self.device
+            ),
+            mask.to(self.device),
+            pad_sequence(weights, batch_first=True).to(self.device),
+        )
+
+    @torch.no_grad()
+    def score(self, candidates, references):
+        """P, R, F tensors of bert_score.score(candidates, references)"""
+
+        if len(candidates) != len(references):
+            raise ValueError("'cands' and 'refs' do not have the same length")
+
+        reference_stats = self.reference_stats(references)
+        unique = list(dict.fromkeys(candidates))
+        tokens = dict(zip(unique, (sent_encode(self.tokenizer, c) for c in unique)))
+
+        # pairs sorted by candidate length, the candidates of a batch are
+        # embedded with little padding when it is scored, only the references
+        # are kept
+        order = sorted(
+            range(len(candidates)),
+            key=lambda i: (-len(tokens[candidates[i]]), -len(reference_stats[i][1])),
+        )
+        P, R, F = (torch.zeros(len(candidates)) for _ in range(3))
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            batch_unique = list(dict.fromkeys(candidates[i] for i in batch))
+            candidate_stats = dict(
+                zip(
+                    batch_unique,
+                    self.embed_tokens([tokens[text] for text in batch_unique]),
+                )
+            )
+            hyp, hyp_mask, hyp_weights = self._pad(
+                [candidate_stats[candidates[i]] for i in batch]
+            )
+            ref, ref_mask, ref_weights = self._pad([reference_stats[i] for i in batch])
+
+            # greedy cosine matching of bert_score.utils.greedy_cos_idf
+            sim = torch.bmm(hyp, ref.transpose(1, 2))
+            sim = sim * torch.bmm(
+                hyp_mask.unsqueeze(2).float(), ref_mask.unsqueeze(1).float()
+            )
+            hyp_weights = hyp_weights / hyp_weights.sum(dim=1, keepdim=True)
+            ref_weights = ref_weights / ref_weights.sum(dim=1, keepdim=True)
+            precision = (sim.max(dim=2)[0] * hyp_weights).sum(dim=1)
+            recall = (sim.max(dim=1)[0] * ref_weights).sum(dim=1)
+            f1 = 2 * precision * recall / (precision + recall)
+
+            # empty sentences (special tokens only) score 0
+            precision = precision.masked_fill(hyp_mask.sum(dim=1).eq(2), 0.0)
+            recall = recall.masked_fill(ref_mask.sum(dim=1).eq(2), 0.0)
+            f1 = f1.masked_fill(torch.isnan(f1), 0.0)
+
+            index = torch.tensor(batch)
+            P[index], R[index], F[index] = precision.cpu(), recall.cpu(), f1.cpu()
+
+        return P, R, F
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        torch.save(self.references, self.cache_file)
+        logging.info(
+            "{} reference embeddings saved to {}".format(
+                len(self.references), self.cache_file
+            )
+        )
@@ -0,0 +1,75 @@
+import os
+
+import torch
+
+
+def _env_int(names, default):
+    for name in names:
+        if os.environ.get(name):
+            return int(os.environ[name])
+    return default
+
+
+def launch_world():
+    """
+    (rank, world size, local rank, local world size) set by torchrun, or by an
+    MPI launcher, (0, 1, 0, 1) for a single process
+    """
+
+    rank = _env_int(["RANK", "PMI_RANK", "OMPI_COMM_WORLD_RANK"], 0)
+    world_size = _env_int(["WORLD_SIZE", "PMI_SIZE", "OMPI_COMM_WORLD_SIZE"], 1)
+    local_rank = _env_int(
+        ["LOCAL_RANK", "MPI_LOCALRANKID", "OMPI_COMM_WORLD_LOCAL_RANK"], 0
+    )
+    local_world_size = _env_int(
+        ["LOCAL_WORLD_SIZE", "MPI_LOCALNRANKS", "OMPI_COMM_WORLD_LOCAL_SIZE"],
+        world_size,
+    )
+
+    return rank, world_size, local_rank, local_world_size
+
+
+def use_cpu():
+    return not torch.cuda.is_available() or os.environ.get(
+        "ACCELERATE_USE_CPU", "false"
+    ).lower() in ("1", "true", "yes")
+
+
+def init_cpu_process_group(backend="gloo"):
+    """
+    start the process group of a multi-process CPU launch with `backend`
+    before the Accelerator does (it would pick MPI whenever torch has it),
+    returns False for a single process or a GPU launch
+    """
+
+    rank, world_size, _, _ = launch_world()
+    if world_size <= 1 or not use_cpu() or torch.distributed.is_initialized():
+        return False
+
+    # torchrun sets MASTER_ADDR/MASTER_PORT, MPI launchers on one node do not
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29500")
+    torch.distributed.init_process_group(backend, rank=rank, world_size=world_size)
+
+    return True
+
+
+def partition_cpu_threads(num_threads=None):
+    """
+    pin this process to its own slice of the cores it may run on (the cores
+    of the node split between the local processes) and size the torch thread
+    pool to it, `num_threads` caps the slice, returns the pinned cores
+    """
+
+    _, _, local_rank, local_world_size = launch_world()
+    cores = sorted(os.sched_getaffinity(0))
+    per_process = max(1, len(cores) // local_world_size)
+    if num_threads is not None:
+        per_process = min(per_process, num_threads)
+    start = (local_rank * per_process) % len(cores)
+    slice_cores = cores[start : start + per_process]
+
+    os.sched_setaffinity(0, slice_cores)
+    torch.set_num_threads(len(slice_cores))
+
+    return slice_cores
@@ -1,6 +1,12 @@
+import os
 import json
 import csv
 import random
+import pickle
+import shutil
+import hashlib
+import tempfile
+import argparse
 
 import datasets
 from datasets import Dataset
@@ -14,6 +20,7 @@ from transformers import DataCollatorForSeq2Seq
 import utils
 from special_token import simple_tokenize, lemmatize_text, build_tagger
 from custom_dataloader import CustomWithNegativeDataCollator
+from generation import LengthSortedSampler, padding_multiple, source_target_lengths
 
 
 def get_synonyms(word):
@@ -24,6 +31,82 @@ def get_synonyms(word):
     return synonyms
 
 
+# args the raw datasets depend on, besides the data files
+RAW_DATA_ARGS = ["seed", "len_input", "len_output", "contrastive", "tagging"]
+
+# args the tokenized datasets depend on, besides the raw datasets and the tokenizer
+PROCESSED_DATA_ARGS = [
+    "text_column",
+    "summary_column",
+    "source_prefix",
+    "max_source_length",
+    "max_target_length",
+    "pad_to_max_length",
+    "ignore_pad_token_for_loss",
+    "contrastive",
+    "ctrlen_model",
+]
+
+
+def _hash(values):
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def raw_data_key(args):
+    """cache key of the raw datasets, the data files (path, size, mtime) and RAW_DATA_ARGS"""
+
+    files = []
+    for file_path in (args.train_file, args.validation_file, args.test_file):
+        stat = os.stat(file_path)
+        files.append([os.path.abspath(file_path), stat.st_size, stat.st_mtime])
+
+    return "raw_" + _hash([files, {name: getattr(args, name) for name in RAW_DATA_ARGS}])
+
+
+def processed_data_key(args, tokenizer):
+    """cache key of the tokenized datasets"""
+
+    return "processed_" + _hash(
+        [
+            raw_data_key(args),
+            type(tokenizer).__name__,
+            sorted(tokenizer.get_vocab().items()),
+            tokenizer.special_tokens_map,
+            {name: getattr(args, name) for name in PROCESSED_DATA_ARGS},
+        ]
+    )
+
+
+def load_cached_datasets(cache_dir, key):
+    """datasets saved by save_cached_datasets, also restores the random state after them"""
+
+    path = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(path, "random_state.pkl")):
+        return None
+    with open(os.path.join(path, "random_state.pkl"), "rb") as f:
+        random.setstate(pickle.load(f))
+
+    return datasets.load_from_disk(path)
+
+
+def save_cached_datasets(cache_dir, key, dataset_dict):
+    """save datasets and the random state, concurrent runs may save the same key"""
+
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(path):
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp_" + key)
+    dataset_dict.save_to_disk(tmp_path)
+    with open(os.path.join(tmp_path, "random_state.pkl"), "wb") as f:
+        pickle.dump(random.getstate(), f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another run saved it first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
 def raw_data_loader(args):
     """load raw datasets from csv files"""
 
@@ -40,6 +123,11 @@ def raw_data_loader(args):
         args.validation_file = "./data/dialogtest/dialogsum.dev.jsonl"
         args.test_file = "./data/dialogtest/dialogsum.test.jsonl"
 
+    if args.preprocessing_cache_dir is not None:
+        raw_datasets = load_cached_datasets(args.preprocessing_cache_dir, raw_data_key(args))
+        if raw_datasets is not None:
+            return raw_datasets
+
     if "samsum" in args.train_file:
         train_dict = load_from_samsum(args, args.train_file)
         val_dict = load_from_samsum(args, args.validation_file)
@@ -63,6 +151,9 @@ def raw_data_loader(args):
         {"train": train_dict, "validation": val_dict, "test": test_dict}
     )
 
+    if args.preprocessing_cache_dir is not None:
+        save_cached_datasets(args.preprocessing_cache_dir, raw_data_key(args), raw_datasets)
+
     return raw_datasets
 
 
@@ -419,15 +510,23 @@ def data_processor(logger, args, accelerator, raw_datasets, tokenizer, model):
     max_target_length = args.max_target_length
     padding = "max_length" if args.pad_to_max_length else False
 
-    with accelerator.main_process_first():
-        processed_datasets = raw_datasets.map(
-            preprocess_function,
-            batched=True,
-            batch_size=1000,
-            remove_columns=column_names,
-            load_from_cache_file=not args.overwrite_cache,
-            desc="Running tokenizer on dataset",
-        )
+    processed_datasets = None
+    if args.preprocessing_cache_dir is not None:
+        processed_key = processed_data_key(args, tokenizer)
+        processed_datasets = load_cached_datasets(args.preprocessing_cache_dir, processed_key)
+
+    if processed_datasets is None:
+        with accelerator.main_process_first():
+            processed_datasets = raw_datasets.map(
+                preprocess_function,
+                batched=True,
+                batch_size=1000,
+                remove_columns=column_names,
+                load_from_cache_file=not args.overwrite_cache,
+                desc="Running tokenizer on dataset",
+            )
+        if args.preprocessing_cache_dir is not None:
+            save_cached_datasets(args.preprocessing_cache_dir, processed_key, processed_datasets)
 
     train_dataset = processed_datasets["train"]
     eval_dataset = processed_datasets["validation"]
@@ -461,14 +560,18 @@ def data_processor(logger, args, accelerator, raw_datasets, tokenizer, model):
             tokenizer,
             model=model,
             label_pad_token_id=label_pad_token_id,
-            pad_to_multiple_of=8 if accelerator.use_fp16 else None,
+            pad_to_multiple_of=padding_multiple(
+                args.mixed_precision, accelerator.device
+            ),
         )
 
         valid_data_collator = DataCollatorForSeq2Seq(
             tokenizer,
             model=model,
             label_pad_token_id=label_pad_token_id,
-            pad_to_multiple_of=8 if accelerator.use_fp16 else None,
+            pad_to_multiple_of=padding_multiple(
+                args.mixed_precision, accelerator.device
+            ),
         )
         train_dataloader = DataLoader(
             train_dataset,
@@ -476,12 +579,14 @@ def data_processor(logger, args, accelerator, raw_datasets, tokenizer, model):
             collate_fn=data_collator,
             batch_size=args.per_device_train_batch_size,
         )
-        eval_dataloader = DataLoader(
+        eval_dataloader = inference_dataloader(
+            args,
             eval_dataset,
             collate_fn=valid_data_collator,
             batch_size=args.per_device_eval_batch_size,
         )
-        test_dataloader = DataLoader(
+        test_dataloader = inference_dataloader(
+            args,
             test_dataset,
             collate_fn=valid_data_collator,
             batch_size=args.per_device_test_batch_size,
@@ -491,7 +596,9 @@ def data_processor(logger, args, accelerator, raw_datasets, tokenizer, model):
             tokenizer,
             model=model,
             label_pad_token_id=label_pad_token_id,
-            pad_to_multiple_of=8 if accelerator.use_fp16 else None,
+            pad_to_multiple_of=padding_multiple(
+                args.mixed_precision, accelerator.device
+            ),
         )
 
         train_dataloader = DataLoader(
@@ -500,12 +607,14 @@ def data_processor(logger, args, accelerator, raw_datasets, tokenizer, model):
             collate_fn=data_collator,
             batch_size=args.per_device_train_batch_size,
         )
-        eval_dataloader = DataLoader(
+        eval_dataloader = inference_dataloader(
+            args,
             eval_dataset,
             collate_fn=data_collator,
             batch_size=args.per_device_eval_batch_size,
         )
-        test_dataloader = DataLoader(
+        test_dataloader = inference_dataloader(
+            args,
             test_dataset,
             collate_fn=data_collator,
             batch_size=args.per_device_test_batch_size,
@@ -516,3 +625,70 @@ def data_processor(logger, args, accelerator, raw_datasets, tokenizer, model):
         eval_dataset,
         test_dataset,
     )
+
+
+def eval_subset_loader(args, eval_dataset, eval_dataloader):
+    """fixed, seeded subset of the validation set for fast validation"""
+
+    if args.eval_subset_size is None or args.eval_subset_size >= len(eval_dataset):
+        return None
+
+    seed = args.eval_subset_seed if args.eval_subset_seed is not None else args.seed
+    rng = random.Random(seed)
+    subset_indices = sorted(rng.sample(range(len(eval_dataset)), args.eval_subset_size))
+
+    return inference_dataloader(
+        args,
+        eval_dataset.select(subset_indices),
+        collate_fn=eval_dataloader.collate_fn,
+        batch_size=args.per_device_eval_batch_size,
+    )
+
+
+def inference_dataloader(args, dataset, collate_fn, batch_size):
+    """DataLoader for generation, batched by length with --sort_by_length"""
+
+    sampler = None
+    if args.sort_by_length != "no":
+        source_lengths, target_lengths = source_target_lengths(dataset)
+        sampler = LengthSortedSampler(
+            source_lengths, target_lengths, sort_by=args.sort_by_length
+        )
+
+    return DataLoader(
+        dataset,
+        sampler=sampler,
+        collate_fn=collate_fn,
+        batch_size=batch_size,
+    )
+
+
+def generation_order(dataloader):
+    """sampler order of a generation DataLoader (None for dataset order)"""
+
+    if isinstance(dataloader.sampler, LengthSortedSampler):
+        return dataloader.sampler.order
+    return None
+
+
+def load_test_prompts(args, file_path, max_samples=None):
+    """
+    model inputs and references of a dialogsum file, built like the test split
+    (--len_input, --tagging and --source_prefix of `args`)
+    """
+
+    data_args = argparse.Namespace(
+        contrastive="no",
+        tagging=args.tagging,
+        len_input=args.len_input,
+        len_output="no",
+    )
+    test_dict = load_from_dialogsum(data_args, file_path)
+    if max_samples is not None:
+        test_dict = test_dict.select(range(min(max_samples, len(test_dict))))
+    test_dict = utils.len_adjust(data_args, test_dict, "test")
+
+    prefix = args.source_prefix if args.source_prefix is not None else ""
+    prompts = [prefix + dialogue for dialogue in test_dict["dialogue"]]
+
+    return prompts, test_dict["summary"]
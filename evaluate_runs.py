@@ -0,0 +1,484 @@
+import os
+import re
+import glob
+import json
+import time
+import logging
+import difflib
+import argparse
+
+import pandas as pd
+
+from predictions import SUMMARY_ID_PATTERN, read_predictions
+from bert_score_s import BERTSCORE_SETTINGS, BertScorer
+from rouge_s import RougeScorer
+
+# =  =  =  =  =  =  =  =  =  = Logging Setup =  =  =  =  =  =  =  =  =  =  =  =
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+
+# rows of the store are indexed by (method, fname, ref)
+STORE_INDEX = ["method", "fname", "ref"]
+
+# text columns a cached metric row must match to be reused
+TEXT_COLUMNS = ["gen_summary", "summary"]
+
+METRIC_COLUMNS = [
+    "rouge_1",
+    "rouge_2",
+    "rouge_l",
+    "gen_length",
+    "gold_length",
+    "diff_length",
+]
+
+# BERTScore F1 and the "<model>_L<layers>" it was computed with
+BERT_SCORE_COLUMNS = ["bert_score", "bert_score_model"]
+
+GEN_SUMMARY_PATTERN = re.compile(r"^gen_summary(?P<index>\d+)$")
+
+
+def parse_args():
+    """
+    config arguments for the cross-run evaluation
+    """
+    parser = argparse.ArgumentParser(
+        description="Evaluate the test predictions of many runs into one results store"
+    )
+    parser.add_argument(
+        "--runs",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Runs to ingest as [name=]path, a path is a predictions .jsonl/.parquet "
+        "file, a result/*.jsonl file, a gen_samples directory or an output_dir with "
+        "predictions or gen_samples "
+        "(default: every file of --result_dir).",
+    )
+    parser.add_argument(
+        "--result_dir",
+        type=str,
+        default="./result",
+        help="Directory of <method>.jsonl files ingested when --runs is not given.",
+    )
+    parser.add_argument(
+        "--gold_file",
+        type=str,
+        default="./data/dialogsum/dialogsum.test.jsonl",
+        help="Test jsonl file with the dialogues and summary<k>/topic<k> references.",
+    )
+    parser.add_argument(
+        "--store",
+        type=str,
+        default="./result/results.parquet",
+        help="Parquet results store, metrics of unchanged rows are reused from it.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=None,
+        help="Processes scoring ROUGE (default: min(8, CPU count)).",
+    )
+    parser.add_argument(
+        "--bert_score",
+        action="store_true",
+        default=False,
+        help="Also compute BERTScore F1, reference embeddings are cached in --bert_score_cache_dir.",
+    )
+    parser.add_argument(
+        "--bert_score_model",
+        type=str,
+        default=BERTSCORE_SETTINGS["model_type"],
+        help="BERTScore model (bert_score's default for English).",
+    )
+    parser.add_argument(
+        "--bert_score_layers",
+        type=int,
+        default=BERTSCORE_SETTINGS["num_layers"],
+        help="Layer of --bert_score_model whose embeddings are matched.",
+    )
+    parser.add_argument(
+        "--bert_score_batch_size",
+        type=int,
+        default=BERTSCORE_SETTINGS["batch_size"],
+        help="Texts embedded, and pairs matched, per batch.",
+    )
+    parser.add_argument(
+        "--bert_score_cache_dir",
+        type=str,
+        default="./result/bert_score_cache",
+        help="Where reference embeddings are persisted, keyed by model and text hash.",
+    )
+    parser.add_argument(
+        "--table_file",
+        type=str,
+        default=None,
+        help="Write the per-method comparison table as csv.",
+    )
+    parser.add_argument(
+        "--excel_file",
+        type=str,
+        default=None,
+        help="Write one sheet per method with gen<k>_* metric columns, like build_excel.ipynb.",
+    )
+    parser.add_argument(
+        "--show",
+        type=str,
+        nargs="*",
+        default=None,
+        help="Print the gold and generated summaries of every method for these fnames, "
+        "with the passages each one shares with the gold summary.",
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+def _read_jsonl(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_gen_samples(path):
+    """records of a legacy gen_samples directory, one <fname>_sum<k>.txt per sample"""
+
+    records = {}
+    for file_name in sorted(os.listdir(path)):
+        if not file_name.endswith(".txt"):
+            continue
+        with open(os.path.join(path, file_name), "r") as f:
+            text = f.read()
+        prediction = text.split("Generate Summary:\n")[-1]
+        match = SUMMARY_ID_PATTERN.match(file_name[: -len(".txt")])
+        if match is not None:
+            fname, index = match.group("fname"), match.group("index")
+        else:
+            fname, index = file_name[: -len(".txt")], "1"
+        records.setdefault(fname, {"fname": fname})["gen_summary" + index] = prediction
+
+    return list(records.values())
+
+
+def read_run(path):
+    """prediction records of a run, see --runs"""
+
+    if os.path.isdir(path):
+        for name in ("predictions.parquet", "predictions.jsonl"):
+            if os.path.exists(os.path.join(path, name)):
+                return read_predictions(os.path.join(path, name))
+        for name in ("gen_samples", "predict_gen_samples"):
+            if os.path.isdir(os.path.join(path, name)):
+                return read_gen_samples(os.path.join(path, name))
+        if glob.glob(os.path.join(path, "*.txt")):
+            return read_gen_samples(path)
+        raise ValueError("no predictions or gen_samples in {}".format(path))
+
+    return read_predictions(path)
+
+
+def run_specs(args):
+    """(method, path) of every run"""
+
+    if args.runs is None:
+        specs = [
+            (os.path.splitext(os.path.basename(path))[0], path)
+            for path in glob.glob(os.path.join(args.result_dir, "*.jsonl"))
+        ]
+        # result/<i>.jsonl in method order
+        return sorted(
+            specs,
+            key=lambda spec: (
+                not spec[0].isdigit(),
+                int(spec[0]) if spec[0].isdigit() else 0,
+                spec[0],
+            ),
+        )
+
+    specs = []
+    for run in args.runs:
+        if "=" in run:
+            method, path = run.split("=", 1)
+        else:
+            method = os.path.splitext(os.path.basename(os.path.normpath(run)))[0]
+            path = run
+        specs.append((method, path))
+
+    return specs
+
+
+def long_rows(method, records, gold):
+    """one row per (fname, ref) with a prediction, references come from the record or `gold`"""
+
+    rows = []
+    for record in records:
+        fname = record.get("fname")
+        if fname is None:
+            continue
+        gold_record = gold.get(fname, {})
+        for key, prediction in record.items():
+            match = GEN_SUMMARY_PATTERN.match(key)
+            if match is None or prediction is None:
+                continue
+            index = match.group("index")
+            summary = record.get("summary" + index, gold_record.get("summary" + index))
+            if summary is None:
+                continue
+            rows.append(
+                {
+                    "method": method,
+                    "fname": fname,
+                    "ref": int(index),
+                    "gen_summary": prediction,
+                    "summary": summary,
+                    "topic": record.get(
+                        "topic" + index, gold_record.get("topic" + index)
+                    ),
+                }
+            )
+
+    return rows
+
+
+def build_store(specs, gold):
+    rows = []
+    for method, path in specs:
+        records = read_run(path)
+        method_rows = long_rows(method, records, gold)
+        logger.info(
+            "{}: {} predictions of {} dialogues from {}".format(
+                method, len(method_rows), len(records), path
+            )
+        )
+        rows.extend(method_rows)
+
+    return pd.DataFrame(rows, columns=STORE_INDEX + TEXT_COLUMNS + ["topic"])
+
+
+def reuse_metrics(store, store_file):
+    """copy the metrics of rows whose texts did not change from a previous store"""
+
+    for column in METRIC_COLUMNS + ["bert_score"]:
+        store[column] = float("nan")
+    store["bert_score_model"] = None
+    if store_file is None or not os.path.exists(store_file):
+        return store
+
+    previous = pd.read_parquet(store_file)
+    if not set(METRIC_COLUMNS + TEXT_COLUMNS) <= set(previous.columns):
+        return store
+    columns = METRIC_COLUMNS + [
+        column for column in BERT_SCORE_COLUMNS if column in previous.columns
+    ]
+    previous = previous.reset_index()[STORE_INDEX + TEXT_COLUMNS + columns]
+    merged = store[STORE_INDEX + TEXT_COLUMNS].merge(
+        previous, on=STORE_INDEX + TEXT_COLUMNS, how="left"
+    )
+    for column in columns:
+        store[column] = merged[column].values
+
+    return store
+
+
+def compute_metrics(store, num_workers=None):
+    """ROUGE and length metrics of the rows without metrics, all methods in one pass"""
+
+    todo = store["rouge_1"].isna().values
+    if not todo.any():
+        return store
+
+    hypotheses = store.loc[todo, "gen_summary"].tolist()
+    references = store.loc[todo, "summary"].tolist()
+    scorer = RougeScorer(num_workers)
+    try:
+        # references are shared by every method and only tokenized once
+        scores = scorer.score_samples(hypotheses, references)
+    finally:
+        scorer.close()
+
+    store.loc[todo, "rouge_1"] = [score["rouge-1"]["f"] for score in scores]
+    store.loc[todo, "rouge_2"] = [score["rouge-2"]["f"] for score in scores]
+    store.loc[todo, "rouge_l"] = [score["rouge-l"]["f"] for score in scores]
+    gen_length = store.loc[todo, "gen_summary"].str.split(" ").str.len()
+    gold_length = store.loc[todo, "summary"].str.split(" ").str.len()
+    store.loc[todo, "gen_length"] = gen_length
+    store.loc[todo, "gold_length"] = gold_length
+    store.loc[todo, "diff_length"] = gen_length - gold_length
+
+    return store
+
+
+def compute_bert_scores(store, args):
+    """BERTScore F1 of the rows without a score of --bert_score_model, all methods in one pass"""
+
+    model_key = "{}_L{}".format(args.bert_score_model, args.bert_score_layers)
+    todo = (
+        store["bert_score"].isna() | (store["bert_score_model"] != model_key)
+    ).values
+    if not todo.any():
+        return store
+
+    scorer = BertScorer(
+        args.bert_score_model,
+        args.bert_score_layers,
+        args.bert_score_batch_size,
+        cache_dir=args.bert_score_cache_dir,
+    )
+    _, _, F = scorer.score(
+        store.loc[todo, "gen_summary"].tolist(), store.loc[todo, "summary"].tolist()
+    )
+    store.loc[todo, "bert_score"] = F.tolist()
+    store.loc[todo, "bert_score_model"] = model_key
+
+    return store
+
+
+def score_columns(store):
+    """metric columns of the store, bert_score once computed"""
+
+    if store["bert_score"].notna().any():
+        return METRIC_COLUMNS + ["bert_score"]
+    return METRIC_COLUMNS
+
+
+def comparison_table(store):
+    """mean metrics per method, overall and per reference"""
+
+    metrics = store.assign(abs_diff_length=store["diff_length"].abs())
+    columns = score_columns(store) + ["abs_diff_length"]
+    overall = metrics.groupby("method", sort=False)[columns].mean()
+    per_ref = (
+        metrics.groupby(["method", "ref"], sort=False)[
+            ["rouge_1", "rouge_2", "rouge_l"]
+        ]
+        .mean()
+        .unstack("ref")
+    )
+    per_ref.columns = [
+        "ref{}_{}".format(ref, metric) for metric, ref in per_ref.columns
+    ]
+    table = overall.join(per_ref)
+    table.insert(0, "samples", metrics.groupby("method", sort=False).size())
+
+    return table
+
+
+def method_sheet(store, method):
+    """the wide layout of build_excel.ipynb: fname, gen_summary<k> and gen<k>_* columns"""
+
+    rows = store[store["method"] == method]
+    sheet = rows.pivot(
+        index="fname", columns="ref", values=["gen_summary"] + score_columns(store)
+    )
+    sheet.columns = [
+        (
+            "gen_summary{}".format(ref)
+            if column == "gen_summary"
+            else "gen{}_{}".format(ref, column)
+        )
+        for column, ref in sheet.columns
+    ]
+    order = rows["fname"].drop_duplicates()
+
+    return sheet.loc[order].reset_index()
+
+
+def matched_spans(gold, generated, min_size=20):
+    """
+    the passages a generated summary copies from the gold one, the difflib
+    matching blocks longer than `min_size` characters of highlight_word.ipynb
+    """
+
+    matcher = difflib.SequenceMatcher(isjunk=None, a=gold, b=generated, autojunk=True)
+
+    return [
+        gold[block.a : block.a + block.size]
+        for block in matcher.get_matching_blocks()
+        if block.size > min_size
+    ]
+
+
+def show_examples(store, fnames):
+    for fname in fnames:
+        rows = store[store["fname"] == fname]
+        for ref, ref_rows in rows.groupby("ref"):
+            logger.info("=" * 100)
+            logger.info(
+                "{} summary{}, topic: {}".format(fname, ref, ref_rows["topic"].iloc[0])
+            )
+            logger.info("Gold Summary: {}".format(ref_rows["summary"].iloc[0]))
+            logger.info("-" * 100)
+            for row in ref_rows.itertuples():
+                logger.info(
+                    "{} (ROUGE-L {:.2f}): {}".format(
+                        row.method, 100 * row.rouge_l, row.gen_summary
+                    )
+                )
+                for span in matched_spans(row.summary, row.gen_summary):
+                    logger.info("    matches gold: {}".format(span))
+
+
+def main():
+    args = parse_args()
+
+    # display parameters
+    logging.info("*** Parameters ***")
+    for item, value in vars(args).items():
+        logging.info("{}: {}".format(item, value))
+    logging.info("")
+
+    if args.excel_file is not None:
+        try:
+            import openpyxl  # noqa: F401
+        except ImportError:
+            raise ImportError("--excel_file needs openpyxl, `pip install openpyxl`")
+
+    start = time.time()
+    gold = {}
+    if args.gold_file is not None and os.path.exists(args.gold_file):
+        gold = {sample["fname"]: sample for sample in _read_jsonl(args.gold_file)}
+
+    store = build_store(run_specs(args), gold)
+    store = reuse_metrics(store, args.store)
+    num_cached = int(store["rouge_1"].notna().sum())
+    store = compute_metrics(store, args.num_workers)
+    if args.bert_score:
+        store = compute_bert_scores(store, args)
+    logger.info(
+        "Scored {} predictions ({} reused from the store) in {:.1f}s".format(
+            len(store), num_cached, time.time() - start
+        )
+    )
+
+    if args.store is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.store)), exist_ok=True)
+        store.set_index(STORE_INDEX).to_parquet(args.store)
+        logger.info("Results store saved to {}".format(args.store))
+
+    table = comparison_table(store)
+    logger.info("*** Mean metrics per method ***")
+    for line in table.to_string(float_format=lambda x: "{:.4f}".format(x)).split("\n"):
+        logger.info(line)
+    if args.table_file is not None:
+        table.to_csv(args.table_file)
+
+    if args.excel_file is not None:
+        with pd.ExcelWriter(args.excel_file) as writer:
+            for method in store["method"].unique():
+                method_sheet(store, method).to_excel(
+                    writer, sheet_name=str(method)[:31]
+                )
+        logger.info("Sheets saved to {}".format(args.excel_file))
+
+    if args.show:
+        show_examples(store, args.show)
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# main process
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+import os
+import time
+import logging
+import argparse
+import tempfile
+import multiprocessing
+
+import torch
+from transformers.utils import is_offline_mode
+
+from data_loader import load_test_prompts
+from generation import summarize_sorted
+from model_loader import (
+    QUANTIZED_WEIGHTS_NAME,
+    checkpoint_loader,
+    quantize_model,
+)
+from nltk_resources import ensure_nltk_resources, required_resources
+from rouge_s import py_rouge_scores
+from timing import peak_rss_mb, reset_peak_rss
+
+# =  =  =  =  =  =  =  =  =  = Logging Setup =  =  =  =  =  =  =  =  =  =  =  =
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+
+
+def parse_args():
+    """
+    config arguments for export
+    """
+    parser = argparse.ArgumentParser(
+        description="Export a trained checkpoint to int8 (PyTorch or ONNX) for CPU inference"
+    )
+    parser.add_argument(
+        "--model_name_or_path",
+        type=str,
+        required=True,
+        help="Checkpoint saved by train.py, e.g. output_dir/best.",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="Where to store the exported model, loadable by predict.py and serve.py.",
+    )
+    parser.add_argument(
+        "--onnx",
+        action="store_true",
+        default=False,
+        help="Export encoder/decoder ONNX graphs with past key values "
+        "(needs optimum[onnxruntime]) instead of a quantized PyTorch model.",
+    )
+    parser.add_argument(
+        "--eval_file",
+        type=str,
+        default="./data/dialogsum/dialogsum.test.jsonl",
+        help="DialogSum jsonl file used to compare the exported model with the original, "
+        "set to an empty string to skip.",
+    )
+    parser.add_argument(
+        "--max_eval_samples",
+        type=int,
+        default=None,
+        help="Compare on the first n samples of --eval_file only.",
+    )
+    parser.add_argument(
+        "--len_input",
+        type=str,
+        default="topic-length",
+        help="Prompt used when training the checkpoint",
+        choices=(
+            "no",
+            "topic",
+            "length",
+            "topic-length",
+        ),
+    )
+    parser.add_argument(
+        "--tagging",
+        type=str,
+        default="no",
+        help="Tagging used when training the checkpoint",
+        choices=(
+            "no",
+            "word",
+            "prompt",
+        ),
+    )
+    parser.add_argument(
+        "--source_prefix",
+        type=str,
+        default=None,
+        help="A prefix to add before every source text " "(useful for T5 models).",
+    )
+    parser.add_argument(
+        "--max_source_length",
+        type=int,
+        default=1024,
+        help="The maximum total input sequence length after tokenization.",
+    )
+    parser.add_argument(
+        "--min_target_length",
+        type=int,
+        default=1,
+        help="The minimal total sequence length for target text",
+    )
+    parser.add_argument(
+        "--max_target_length",
+        type=int,
+        default=128,
+        help="The maximum total sequence length for target text.",
+    )
+    parser.add_argument(
+        "--length_penalty",
+        type=float,
+        default=1.0,
+        help="large - longer sequence, small - shorter sequence",
+    )
+    parser.add_argument(
+        "--num_beams",
+        type=int,
+        default=4,
+        help="Number of beams to use for generation.",
+    )
+    parser.add_argument(
+        "--length_budget_slack",
+        type=float,
+        default=None,
+        help="End each summary once it reaches the length asked by its "
+        "'Length of Summary: N' prompt plus this fraction of slack (e.g. 0.2).",
+    )
+    parser.add_argument(
+        "--tokens_per_word",
+        type=float,
+        default=1.5,
+        help="Tokens per summary word used to turn the requested length into a token budget.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="Batch size for the comparison.",
+    )
+    parser.add_argument(
+        "--nltk_data_dir",
+        type=str,
+        default=None,
+        help="Directory searched first for the nltk data (punkt, and the --tagging resources).",
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+def model_size_mb(model):
+    """
+    in-memory size of the weights of a PyTorch model (the packed int8 Linear
+    weights included), or the files of an ONNX export (external data included)
+    """
+
+    if isinstance(model, torch.nn.Module):
+        # the packed params are (weight, bias) tuples, next to their dtype,
+        # tensors are kept alive while collecting so tied weights are counted once
+        tensors = {}
+
+        def collect(value):
+            if isinstance(value, torch.Tensor):
+                tensors[value.data_ptr()] = value
+            elif isinstance(value, (tuple, list)):
+                for item in value:
+                    collect(item)
+
+        for value in model.state_dict().values():
+            collect(value)
+        return sum(tensor.nbytes for tensor in tensors.values()) / 2**20
+
+    return (
+        sum(
+            os.path.getsize(os.path.join(model.model_save_dir, name))
+            for name in os.listdir(model.model_save_dir)
+            if name.endswith((".onnx", ".onnx_data", ".onnx.data"))
+        )
+        / 2**20
+    )
+
+
+def export_quantized(model_path, output_dir):
+    """int8 dynamic quantization of a checkpoint, saved next to its config and tokenizer"""
+
+    config, tokenizer, model = checkpoint_loader(model_path)
+    model.eval()
+    quantized = quantize_model(model)
+
+    os.makedirs(output_dir, exist_ok=True)
+    config.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    torch.save(quantized.state_dict(), os.path.join(output_dir, QUANTIZED_WEIGHTS_NAME))
+
+
+def export_onnx(model_path, output_dir):
+    """
+    encoder, decoder and decoder-with-past ONNX graphs with int8 weights,
+    generation reuses the past key values like the PyTorch model
+    """
+
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    except ImportError:
+        raise ImportError("To export to ONNX: pip install optimum[onnxruntime]")
+
+    config, tokenizer, _ = checkpoint_loader(model_path)
+    with tempfile.TemporaryDirectory() as fp32_dir:
+        model = ORTModelForSeq2SeqLM.from_pretrained(
+            model_path, export=True, use_cache=True
+        )
+        model.save_pretrained(fp32_dir)
+
+        os.makedirs(output_dir, exist_ok=True)
+        for name in os.listdir(fp32_dir):
+            if name.endswith(".onnx"):
+                quantize_dynamic(
+                    os.path.join(fp32_dir, name),
+                    os.path.join(output_dir, name),
+                    weight_type=QuantType.QInt8,
+                )
+
+    config.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+
+
+def benchmark(args, model, tokenizer, prompts):
+    """generate every prompt in length-sorted batches, returns summaries and seconds"""
+
+    start = time.time()
+    summaries, _ = summarize_sorted(args, model, tokenizer, prompts)
+
+    return summaries, time.time() - start
+
+
+def generation_run(args, model_path, prompts):
+    """
+    load a model and generate every prompt, runs in a process of its own so
+    the peak resident memory is the one of this model only, returns the
+    peak while loading and while generating apart (loading an int8 model
+    goes through its fp32 version)
+    """
+
+    _, tokenizer, model = checkpoint_loader(model_path)
+    if isinstance(model, torch.nn.Module):
+        model.eval()
+    load_rss_mb = peak_rss_mb()
+    reset_peak_rss()
+    summaries, seconds = benchmark(args, model, tokenizer, prompts)
+
+    return summaries, seconds, model_size_mb(model), (load_rss_mb, peak_rss_mb())
+
+
+def main():
+    args = parse_args()
+
+    # display parameters
+    logging.info("*** Parameters ***")
+    for item, value in vars(args).items():
+        logging.info("{}: {}".format(item, value))
+    logging.info("")
+
+    if args.onnx:
+        export_onnx(args.model_name_or_path, args.output_dir)
+    else:
+        export_quantized(args.model_name_or_path, args.output_dir)
+    logger.info("Exported {} to {}".format(args.model_name_or_path, args.output_dir))
+
+    if not args.eval_file:
+        return
+
+    # punkt splits the summaries into sentences, the tagger tags the dialogues
+    ensure_nltk_resources(
+        required_resources(args.tagging),
+        data_dir=args.nltk_data_dir,
+        download=not is_offline_mode(),
+    )
+
+    # the comparison runs on CPU, where int8 kernels are available
+    prompts, references = load_test_prompts(args, args.eval_file, args.max_eval_samples)
+    results = {}
+    for name, model_path in (
+        ("fp32", args.model_name_or_path),
+        ("int8", args.output_dir),
+    ):
+        # spawned, not forked, so the exported model of this process is not counted
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            summaries, seconds, size_mb, (load_rss_mb, rss_mb) = pool.apply(
+                generation_run, (args, model_path, prompts)
+            )
+        logger.info("ROUGE of the {} model".format(name))
+        results[name] = {
+            "rouge": py_rouge_scores(summaries, references),
+            "seconds": seconds,
+            "size_mb": size_mb,
+            "load_rss_mb": load_rss_mb,
+            "rss_mb": rss_mb,
+        }
+
+    fp32, int8 = results["fp32"], results["int8"]
+    logger.info("*** fp32 vs int8 on {} dialogues ***".format(len(prompts)))
+    for metric in sorted(fp32["rouge"]):
+        logger.info(
+            "{}: F1 {:.2f} -> {:.2f} ({:+.2f})".format(
+                metric,
+                100 * fp32["rouge"][metric]["f"],
+                100 * int8["rouge"][metric]["f"],
+                100 * (int8["rouge"][metric]["f"] - fp32["rouge"][metric]["f"]),
+            )
+        )
+    logger.info(
+        "Generation: {:.1f}s -> {:.1f}s ({:.2f}x), {:.1f} ms/dialogue int8".format(
+            fp32["seconds"],
+            int8["seconds"],
+            fp32["seconds"] / int8["seconds"] if int8["seconds"] else 0.0,
+            1000 * int8["seconds"] / len(prompts),
+        )
+    )
+    logger.info(
+        "Model size: {:.1f}MB -> {:.1f}MB".format(fp32["size_mb"], int8["size_mb"])
+    )
+    logger.info(
+        "Peak RSS: {:.1f}MB -> {:.1f}MB generating, {:.1f}MB -> {:.1f}MB loading".format(
+            fp32["rss_mb"], int8["rss_mb"], fp32["load_rss_mb"], int8["load_rss_mb"]
+        )
+    )
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# main process
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+import re
+import math
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from transformers import LogitsProcessor, LogitsProcessorList
+
+from generation_cache import generation_key
+from rouge_s import rouge_scorer
+from utils import postprocess_text
+
+LENGTH_PROMPT = re.compile(r"Length of Summary: (\d+)\.")
+
+
+def active_precision(mixed_precision, device):
+    """the --mixed_precision that takes effect on `device`, fp16 autocast needs a GPU"""
+
+    if mixed_precision == "fp16" and device.type == "cpu":
+        return "no"
+    return mixed_precision
+
+
+def autocast(mixed_precision, device):
+    """autocast context of --mixed_precision on `device`, bf16 also works on CPU"""
+
+    precision = active_precision(mixed_precision, device)
+    if precision == "no":
+        return contextlib.nullcontext()
+    return torch.autocast(
+        device_type=device.type,
+        dtype=torch.bfloat16 if precision == "bf16" else torch.float16,
+    )
+
+
+def padding_multiple(mixed_precision, device):
+    """
+    sequence length multiple of the collators: 8 for the tensor cores of a GPU
+    in fp16/bf16, none on CPU (measured, a bf16 step only grows with the padded
+    tokens there) or in fp32
+    """
+
+    precision = active_precision(mixed_precision, device)
+    if precision == "no" or device.type == "cpu":
+        return None
+    return 8
+
+
+def source_target_lengths(dataset):
+    """tokenized source/target length of every example in a processed dataset"""
+
+    source_lengths = [len(ids) for ids in dataset["input_ids"]]
+    if "labels" in dataset.column_names:
+        target_lengths = [len(ids) for ids in dataset["labels"]]
+    else:
+        target_lengths = [0] * len(source_lengths)
+
+    return source_lengths, target_lengths
+
+
+class LengthSortedSampler(Sampler):
+    """
+    visit examples from the longest to the shortest source so every
+    beam search batch holds dialogues of similar length,
+    `sort_by` source: source length only
+    `sort_by` source-target: source length buckets, then target length
+    """
+
+    def __init__(
+        self, source_lengths, target_lengths=None, sort_by="source", bucket_size=16
+    ):
+        if sort_by == "source-target" and target_lengths is not None:
+            keys = [
+                (src // bucket_size, tgt)
+                for src, tgt in zip(source_lengths, target_lengths)
+            ]
+        else:
+            keys = source_lengths
+
+        self.order = sorted(range(len(keys)), key=lambda i: keys[i], reverse=True)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+
+def shard_indices(
+    num_samples, batch_size, order=None, num_processes=1, process_index=0
+):
+    """
+    dataset indices of the samples in every batch this process gets from a
+    prepared generation dataloader (`order` is its sampler order), batches are
+    dealt out round-robin and the last ones filled up with samples from the
+    start, those fill-ins are left out so every sample is handled exactly once
+    """
+
+    if order is None:
+        order = range(num_samples)
+    num_batches = math.ceil(num_samples / batch_size)
+    # every process gets the same number of batches
+    num_batches = math.ceil(num_batches / num_processes) * num_processes
+
+    return [
+        list(order[batch * batch_size : (batch + 1) * batch_size])
+        for batch in range(process_index, num_batches, num_processes)
+    ]
+
+
+def restore_order(items, indices):
+    """put the items of the samples at dataset `indices` back in the dataset order"""
+
+    restored = [None] * len(indices)
+    for index, item in zip(indices, items):
+        restored[index] = item
+
+    return restored
+
+
+def padded_tokens(lengths, batch_size, order=None):
+    """number of source tokens (with padding) processed when batching in `order`"""
+
+    if order is None:
+        order = range(len(lengths))
+    order = list(order)
+
+    total = 0
+    for start in range(0, len(order), batch_size):
+        batch = [lengths[i] for i in order[start : start + batch_size]]
+        total += max(batch) * len(batch)
+
+    return total
+
+
+def padding_report(lengths, batch_size, order):
+    """compare the padded workload of the dataset order and a scheduled order"""
+
+    real = sum(lengths)
+    dataset_order = padded_tokens(lengths, batch_size)
+    scheduled = padded_tokens(lengths, batch_size, order)
+    saved = 0.0 if dataset_order == 0 else 100.0 * (1 - scheduled / dataset_order)
+
+    return {
+        "real_tokens": real,
+        "dataset_order_tokens": dataset_order,
+        "scheduled_tokens": scheduled,
+        "saved_percent": saved,
+        "num_batches": math.ceil(len(lengths) / batch_size),
+    }
+
+
+def generation_kwargs(args):
+    """beam search settings, the same train.py puts into model.config"""
+
+    return {
+        "num_beams": args.num_beams,
+        "min_length": args.min_target_length,
+        "max_length": args.max_target_length,
+        "length_penalty": args.length_penalty,
+    }
+
+
+def requested_lengths(prompts):
+    """summary length in words asked for by each prompt, None without a length prompt"""
+
+    lengths = []
+    for prompt in prompts:
+        match = LENGTH_PROMPT.search(prompt)
+        lengths.append(int(match.group(1)) if match else None)
+
+    return lengths
+
+
+def length_budgets(lengths, tokens_per_word, slack, min_length, max_length):
+    """
+    decoder length budget of every example, the requested words converted to
+    tokens plus `slack` (a fraction), the decoder start and the eos token,
+    examples without a requested length keep `max_length`
+    """
+
+    budgets = []
+    for length in lengths:
+        if length is None:
+            budgets.append(max_length)
+        else:
+            budget = math.ceil(length * tokens_per_word * (1 + slack)) + 2
+            # eos is still masked by min_length up to step min_length - 1,
+            # forcing it there as well would leave no token to pick
+            budgets.append(min(max(budget, min_length + 1), max_length))
+
+    return budgets
+
+
+class LengthBudgetLogitsProcessor(LogitsProcessor):
+    """
+    force eos on every hypothesis that reached the budget of its example,
+    rows are the batch_size * num_beams hypotheses of beam search
+    """
+
+    def __init__(self, budgets, eos_token_id, num_beams):
+        self.budgets = torch.tensor(budgets).repeat_interleave(num_beams)
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids, scores):
+        # the next token is the last one allowed by the budget
+        over_budget = self.budgets.to(scores.device) <= input_ids.shape[-1] + 1
+        if over_budget.any():
+            eos_scores = scores[over_budget, self.eos_token_id]
+            scores[over_budget] = -float("inf")
+            scores[over_budget, self.eos_token_id] = eos_scores
+        return scores
+
+
+def length_budget_kwargs(args, model, prompts):
+    """
+    generate() arguments bounding each example by its requested length
+    (`--length_budget_slack`), nothing when disabled or without length prompts
+    """
+
+    slack = args.length_budget_slack
+    if slack is None:
+        return {}
+
+    lengths = requested_lengths(prompts)
+    if all(length is None for length in lengths):
+        return {}
+
+    budgets = length_budgets(
+        lengths,
+        args.tokens_per_word,
+        slack,
+        args.min_target_length,
+        args.max_target_length,
+    )
+    processor = LengthBudgetLogitsProcessor(
+        budgets, model.config.eos_token_id, args.num_beams
+    )
+
+    # the whole batch stops at its longest budget
+    return {
+        "logits_processor": LogitsProcessorList([processor]),
+        "max_length": max(budgets),
+    }
+
+
+def length_adherence(predictions, lengths):
+    """
+    how close the generated summaries are to the requested length in words,
+    examples without a requested length are skipped
+    """
+
+    pairs = [
+        (len(prediction.split(" ")), length)
+        for prediction, length in zip(predictions, lengths)
+        if length is not None
+    ]
+    if not pairs:
+        return None
+
+    generated, requested = np.array(pairs).T
+    error = generated - requested
+
+    return {
+        "num_samples": len(pairs),
+        "mean_abs_error": float(np.mean(np.abs(error))),
+        "mean_error": float(np.mean(error)),
+        "within_10_percent": float(np.mean(np.abs(error) <= 0.1 * requested)),
+        "over_length_percent": 100.0 * float(np.mean(error > 0)),
+    }
+
+
+def generation_settings(args, model):
+    """everything besides the weights and the input that changes generate() output"""
+
+    settings = generation_kwargs(args)
+    settings["length_budget_slack"] = args.length_budget_slack
+    settings["tokens_per_word"] = args.tokens_per_word
+    settings["mixed_precision"] = active_precision(
+        getattr(args, "mixed_precision", "no"), model.device
+    )
+    settings["generation_config"] = model.generation_config.to_diff_dict()
+
+    return settings
+
+
+def budgeted_generate(args, model, tokenizer, **generate_kwargs):
+    """
+    model.generate for a batch of input ids, bounded by the length budget of
+    the prompts (decoded back from the ids) when --length_budget_slack is set
+    """
+
+    def generate(input_ids, attention_mask):
+        kwargs = dict(generate_kwargs)
+        if args.length_budget_slack is not None:
+            prompts = tokenizer.batch_decode(input_ids, skip_special_tokens=True)
+            kwargs.update(length_budget_kwargs(args, model, prompts))
+        # scripts without --mixed_precision generate in fp32
+        with torch.no_grad(), autocast(
+            getattr(args, "mixed_precision", "no"), model.device
+        ):
+            return model.generate(input_ids, attention_mask=attention_mask, **kwargs)
+
+    return generate
+
+
+def cached_generate(
+    generate, input_ids, attention_mask, pad_token_id, cache=None, namespace=None
+):
+    """
+    run `generate` only for the inputs missing from the generation cache,
+    returns the generated ids padded with `pad_token_id` like model.generate
+    """
+
+    if cache is None:
+        return generate(input_ids, attention_mask)
+
+    keys = [
+        generation_key(namespace, row[mask.bool()].tolist())
+        for row, mask in zip(input_ids.cpu(), attention_mask.cpu())
+    ]
+    found = cache.get_many(keys)
+
+    missing = [i for i, key in enumerate(keys) if key not in found]
+    if missing:
+        rows = torch.tensor(missing, device=input_ids.device)
+        generated_tokens = generate(input_ids[rows], attention_mask[rows])
+        generated = {}
+        for i, tokens in zip(missing, generated_tokens.tolist()):
+            while tokens and tokens[-1] == pad_token_id:
+                tokens.pop()
+            generated[keys[i]] = tokens
+        cache.put_many(generated)
+        found.update(generated)
+
+    sequences = [found[key] for key in keys]
+    width = max(len(tokens) for tokens in sequences)
+
+    return torch.tensor(
+        [tokens + [pad_token_id] * (width - len(tokens)) for tokens in sequences],
+        device=input_ids.device,
+    )
+
+
+def real_summary(prediction):
+    """the generated summary after the 'Summary: ' prompts of --len_output real"""
+
+    try:
+        return prediction.split("Summary: ")[2]
+    except:
+        return prediction
+
+
+class BackgroundDecoder:
+    """
+    decode, sentence-split and ROUGE-score generated batches on a worker thread
+    while the model generates the next batch, `result` only waits for the
+    batches still in flight
+    """
+
+    def __init__(self, tokenizer, join_lines=False, len_output="no"):
+        self.tokenizer = tokenizer
+        self.join_lines = join_lines
+        self.len_output = len_output
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batches = []
+
+    def submit(self, generated_tokens, labels, indices):
+        """queue a batch (numpy arrays of token ids) of the samples at dataset `indices`"""
+        self.batches.append(
+            (indices, self.executor.submit(self._decode, generated_tokens, labels))
+        )
+
+    def _decode(self, generated_tokens, labels):
+        decoded_preds = self.tokenizer.batch_decode(
+            generated_tokens, skip_special_tokens=True
+        )
+        decoded_labels = self.tokenizer.batch_decode(labels, skip_special_tokens=True)
+        decoded_preds, decoded_labels = postprocess_text(decoded_preds, decoded_labels)
+
+        if self.join_lines:
+            decoded_preds = [" ".join(sent.split("\n")) for sent in decoded_preds]
+            decoded_labels = [" ".join(sent.split("\n")) for sent in decoded_labels]
+
+        scored_preds = decoded_preds
+        if self.len_output == "real":
+            scored_preds = [real_summary(pred) for pred in decoded_preds]
+
+        return (
+            scored_preds,
+            decoded_labels,
+            rouge_scorer().score_samples(scored_preds, decoded_labels),
+        )
+
+    def result(self):
+        """
+        dataset indices, predictions, references and per-sample ROUGE scores
+        of the submitted samples
+        """
+
+        indices, predictions, references, samples = [], [], [], []
+        for batch_indices, batch in self.batches:
+            batch_preds, batch_labels, batch_scores = batch.result()
+            indices.extend(batch_indices)
+            predictions.extend(batch_preds)
+            references.extend(batch_labels)
+            samples.extend(batch_scores)
+        self.executor.shutdown()
+
+        return indices, predictions, references, samples
+
+
+def summarize(args, model, tokenizer, prompts, cache=None, namespace=None):
+    """
+    generate summaries for a list of prompts, decoded like the test phase of train.py,
+    returns the summaries and the generated token ids
+    """
+
+    inputs = tokenizer(
+        prompts,
+        max_length=args.max_source_length,
+        padding=True,
+        truncation=True,
+        return_tensors="pt",
+    ).to(model.device)
+
+    generated_tokens = cached_generate(
+        budgeted_generate(args, model, tokenizer, **generation_kwargs(args)),
+        inputs["input_ids"],
+        inputs["attention_mask"],
+        tokenizer.pad_token_id,
+        cache,
+        namespace,
+    )
+
+    decoded_preds = tokenizer.batch_decode(generated_tokens, skip_special_tokens=True)
+    decoded_preds, _ = postprocess_text(decoded_preds, [])
+    decoded_preds = [" ".join(sent.split("\n")) for sent in decoded_preds]
+
+    return decoded_preds, generated_tokens
+
+
+def summarize_sorted(args, model, tokenizer, prompts, cache=None, namespace=None):
+    """
+    generate prompts in batches of similar length (and length budget),
+    returns the summaries in input order and the number of generated tokens
+    """
+
+    order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]), reverse=True)
+
+    summaries = [None] * len(prompts)
+    num_tokens = 0
+    for start in range(0, len(order), args.batch_size):
+        batch_order = order[start : start + args.batch_size]
+        batch_summaries, generated_tokens = summarize(
+            args,
+            model,
+            tokenizer,
+            [prompts[i] for i in batch_order],
+            cache,
+            namespace,
+        )
+        num_tokens += int((generated_tokens != tokenizer.pad_token_id).sum())
+        for i, summary in zip(batch_order, batch_summaries):
+            summaries[i] = summary
+
+    return summaries, num_tokens
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+import torch
+
+
+def tensor_bytes(tensor):
+    """raw bytes of a tensor of any dtype (quantized tensors are dequantized)"""
+
+    tensor = tensor.detach().cpu()
+    if tensor.is_quantized:
+        tensor = tensor.dequantize()
+    return tensor.contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+
+
+def model_fingerprint(model):
+    """
+    hash of the model weights, a PyTorch model (also int8) or the graphs of an
+    ONNX export
+    """
+
+    digest = hashlib.sha256()
+    if isinstance(model, torch.nn.Module):
+        for name, value in sorted(model.state_dict().items()):
+            digest.update(name.encode("utf-8"))
+            # packed int8 Linear weights are stored as tuples of tensors
+            values = value if isinstance(value, (tuple, list)) else [value]
+            for tensor in values:
+                if isinstance(tensor, torch.Tensor):
+                    digest.update(tensor_bytes(tensor))
+    else:
+        for name in sorted(os.listdir(model.model_save_dir)):
+            if name.endswith(".onnx") or name.endswith(".onnx_data"):
+                with open(os.path.join(model.model_save_dir, name), "rb") as f:
+                    for block in iter(lambda: f.read(2**20), b""):
+                        digest.update(block)
+
+    return digest.hexdigest()
+
+
+def generation_namespace(model, settings):
+    """cache namespace of a model and its generation settings"""
+
+    digest = hashlib.sha256()
+    digest.update(model_fingerprint(model).encode("utf-8"))
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def generation_key(namespace, token_ids):
+    """cache key of one unpadded input"""
+
+    digest = hashlib.sha256(namespace.encode("utf-8"))
+    digest.update(np.asarray(token_ids, dtype=np.int64).tobytes())
+
+    return digest.hexdigest()
+
+
+class GenerationCache:
+    """
+    generated token ids stored in a sqlite file, entries are evicted least
+    recently used first once the cache grows over `max_size_mb`
+    """
+
+    def __init__(self, path, max_size_mb=1024):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.max_size = int(max_size_mb * 2**20)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        # several processes may share the file (multi-gpu test, serving)
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            "key TEXT PRIMARY KEY, token_ids BLOB, size INTEGER, last_access REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS generations_last_access "
+            "ON generations (last_access)"
+        )
+        self.connection.commit()
+
+    def get_many(self, keys):
+        """cached token ids of the keys found in the cache"""
+
+        with self.lock:
+            return self._get_many(keys)
+
+    def put_many(self, items):
+        """store {key: token ids} and evict old entries over the size bound"""
+
+        with self.lock:
+            self._put_many(items)
+
+    def _get_many(self, keys):
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = self.connection.execute(
+                "SELECT key, token_ids FROM generations WHERE key IN ({})".format(
+                    ",".join("?" * len(chunk))
+                ),
+                chunk,
+            ).fetchall()
+            for key, token_ids in rows:
+                found[key] = np.frombuffer(token_ids, dtype=np.int32).tolist()
+
+        if found:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE generations SET last_access = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+            self.connection.commit()
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+
+        return found
+
+    def _put_many(self, items):
+        now = time.time()
+        rows = []
+        for key, token_ids in items.items():
+            blob = np.asarray(token_ids, dtype=np.int32).tobytes()
+            rows.append((key, blob, len(blob) + len(key), now))
+
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?)", rows
+        )
+        self.connection.commit()
+        self._evict()
+
+    def _size(self):
+        return self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM generations"
+        ).fetchone()[0]
+
+    def _evict(self):
+        """drop least recently used entries until the cache is 90% of its bound"""
+
+        size = self._size()
+        if size <= self.max_size:
+            return
+
+        target = int(0.9 * self.max_size)
+        evicted = []
+        for key, entry_size in self.connection.execute(
+            "SELECT key, size FROM generations ORDER BY last_access"
+        ):
+            if size <= target:
+                break
+            evicted.append((key,))
+            size -= entry_size
+
+        self.connection.executemany("DELETE FROM generations WHERE key = ?", evicted)
+        self.connection.commit()
+        self.evictions += len(evicted)
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM generations"
+            ).fetchone()
+        lookups = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size_mb": size / 2**20,
+        }
+
+    def close(self):
+        self.connection.close()
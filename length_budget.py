@@ -0,0 +1,212 @@
+import time
+import logging
+import argparse
+
+import torch
+from transformers.utils import is_offline_mode
+
+from data_loader import load_test_prompts
+from generation import length_adherence, requested_lengths, summarize_sorted
+from model_loader import checkpoint_loader
+from nltk_resources import ensure_nltk_resources, required_resources
+from rouge_s import py_rouge_scores
+
+# =  =  =  =  =  =  =  =  =  = Logging Setup =  =  =  =  =  =  =  =  =  =  =  =
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+
+
+def parse_args():
+    """
+    config arguments for the length budget comparison
+    """
+    parser = argparse.ArgumentParser(
+        description="Compare decoding with and without a per-example length budget"
+    )
+    parser.add_argument(
+        "--model_name_or_path",
+        type=str,
+        required=True,
+        help="Checkpoint trained with a length prompt, e.g. output_dir/best.",
+    )
+    parser.add_argument(
+        "--eval_file",
+        type=str,
+        default="./data/dialogsum/dialogsum.test.jsonl",
+        help="DialogSum jsonl file to generate.",
+    )
+    parser.add_argument(
+        "--max_eval_samples",
+        type=int,
+        default=None,
+        help="Generate the first n samples of --eval_file only.",
+    )
+    parser.add_argument(
+        "--len_input",
+        type=str,
+        default="topic-length",
+        help="Prompt used when training the checkpoint",
+        choices=(
+            "length",
+            "topic-length",
+        ),
+    )
+    parser.add_argument(
+        "--tagging",
+        type=str,
+        default="no",
+        help="Tagging used when training the checkpoint",
+        choices=(
+            "no",
+            "word",
+            "prompt",
+        ),
+    )
+    parser.add_argument(
+        "--source_prefix",
+        type=str,
+        default=None,
+        help="A prefix to add before every source text " "(useful for T5 models).",
+    )
+    parser.add_argument(
+        "--max_source_length",
+        type=int,
+        default=1024,
+        help="The maximum total input sequence length after tokenization.",
+    )
+    parser.add_argument(
+        "--min_target_length",
+        type=int,
+        default=1,
+        help="The minimal total sequence length for target text",
+    )
+    parser.add_argument(
+        "--max_target_length",
+        type=int,
+        default=128,
+        help="The maximum total sequence length for target text.",
+    )
+    parser.add_argument(
+        "--length_penalty",
+        type=float,
+        default=1.0,
+        help="large - longer sequence, small - shorter sequence",
+    )
+    parser.add_argument(
+        "--num_beams",
+        type=int,
+        default=4,
+        help="Number of beams to use for generation.",
+    )
+    parser.add_argument(
+        "--slacks",
+        type=float,
+        nargs="+",
+        default=[0.1, 0.2, 0.5],
+        help="Length budget slacks to compare with unbounded decoding.",
+    )
+    parser.add_argument(
+        "--tokens_per_word",
+        type=float,
+        default=1.5,
+        help="Tokens per summary word used to turn the requested length into a token budget.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="Batch size for generation.",
+    )
+    parser.add_argument(
+        "--nltk_data_dir",
+        type=str,
+        default=None,
+        help="Directory searched first for the nltk data (punkt, and the --tagging resources).",
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = parse_args()
+
+    # display parameters
+    logging.info("*** Parameters ***")
+    for item, value in vars(args).items():
+        logging.info("{}: {}".format(item, value))
+    logging.info("")
+
+    # punkt splits the summaries into sentences, the tagger tags the dialogues
+    ensure_nltk_resources(
+        required_resources(args.tagging),
+        data_dir=args.nltk_data_dir,
+        download=not is_offline_mode(),
+    )
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    _, tokenizer, model = checkpoint_loader(args.model_name_or_path)
+    model.to(device)
+    model.eval()
+
+    prompts, references = load_test_prompts(args, args.eval_file, args.max_eval_samples)
+    lengths = requested_lengths(prompts)
+
+    results = []
+    for slack in [None] + args.slacks:
+        args.length_budget_slack = slack
+        start = time.time()
+        summaries, num_tokens = summarize_sorted(args, model, tokenizer, prompts)
+        seconds = time.time() - start
+
+        logger.info("ROUGE with --length_budget_slack {}".format(slack))
+        results.append(
+            {
+                "slack": slack,
+                "seconds": seconds,
+                "tokens": num_tokens,
+                "rouge": py_rouge_scores(summaries, references),
+                "adherence": length_adherence(summaries, lengths),
+            }
+        )
+
+    baseline = results[0]
+    logger.info("*** Length budget on {} dialogues ***".format(len(prompts)))
+    logger.info(
+        "slack | time (s) | speedup | tokens | R1 | R2 | RL | "
+        "abs len err | within 10% | too long"
+    )
+    for result in results:
+        rouge = result["rouge"]
+        adherence = result["adherence"]
+        logger.info(
+            "{} | {:.1f} | {:.2f}x | {} | {:.2f} ({:+.2f}) | {:.2f} ({:+.2f}) | "
+            "{:.2f} ({:+.2f}) | {:.2f} | {:.1f}% | {:.1f}%".format(
+                "none" if result["slack"] is None else result["slack"],
+                result["seconds"],
+                baseline["seconds"] / result["seconds"] if result["seconds"] else 0.0,
+                result["tokens"],
+                *[
+                    value
+                    for metric in ("rouge-1", "rouge-2", "rouge-l")
+                    for value in (
+                        100 * rouge[metric]["f"],
+                        100 * (rouge[metric]["f"] - baseline["rouge"][metric]["f"]),
+                    )
+                ],
+                adherence["mean_abs_error"],
+                100 * adherence["within_10_percent"],
+                adherence["over_length_percent"],
+            )
+        )
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# main process
+if __name__ == "__main__":
+    main()
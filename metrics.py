@@ -0,0 +1,71 @@
+import os
+import json
+import time
+
+import torch
+
+from timing import peak_rss_mb
+
+METRICS_FILE_NAME = "metrics.jsonl"
+
+
+def peak_memory_mb():
+    """peak CUDA memory allocated by torch, or the peak RSS on CPU"""
+
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2**20
+    return peak_rss_mb()
+
+
+class MetricsWriter:
+    """
+    appends one json line per record to output_dir/metrics.jsonl, lines are
+    buffered and flushed every `flush_every` records and on close
+    """
+
+    def __init__(self, output_dir, flush_every=20, enabled=True):
+        self.enabled = enabled
+        self.flush_every = flush_every
+        self.buffer = []
+        self.path = os.path.join(output_dir, METRICS_FILE_NAME)
+        if enabled:
+            os.makedirs(output_dir, exist_ok=True)
+            self.file = open(self.path, "w")
+
+    def write(self, record_type, **values):
+        if not self.enabled:
+            return
+        record = {"type": record_type, "time": time.time()}
+        record.update(values)
+        self.buffer.append(json.dumps(record, default=float))
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.enabled or not self.buffer:
+            return
+        self.file.write("\n".join(self.buffer) + "\n")
+        self.file.flush()
+        self.buffer = []
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.flush()
+        self.file.close()
+
+
+def read_metrics(path, record_type=None):
+    """records of a metrics.jsonl file (or of the one in a directory)"""
+
+    if os.path.isdir(path):
+        path = os.path.join(path, METRICS_FILE_NAME)
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record_type is None or record["type"] == record_type:
+                    records.append(record)
+
+    return records
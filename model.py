@@ -13,6 +13,31 @@ from transformers import (
 from utils import label_smoothed_nll_loss
 
 
+def sim_band_pairs(num_tokens, one_side_window_width, device=None):
+    """(row, col) indices of the cosine matrix entries with 0 < col - row <= width"""
+
+    rows = torch.arange(num_tokens, device=device)[:, None]
+    cols = rows + torch.arange(1, one_side_window_width + 1, device=device)[None, :]
+    rows = rows.expand_as(cols)
+    inside = cols < num_tokens
+
+    return rows[inside], cols[inside]
+
+
+def banded_sim_loss(embeddings, band_rows, band_cols):
+    """
+    (sum of the cosine matrix - 2 * sum of its diagonals within the window) / N^2
+    of the embeddings without building the N x N matrix: the sum of the matrix
+    is |sum of the normalized embeddings|^2 and the band is symmetric
+    """
+
+    embeddings = nn.functional.normalize(embeddings, dim=1)
+    total = embeddings.sum(dim=0).pow(2).sum()
+    band = (embeddings[band_rows] * embeddings[band_cols]).sum()
+
+    return (total - 4 * band) / embeddings.shape[0] ** 2
+
+
 class CTRLenModel(nn.Module):
     def __init__(self, args, config):
         """initialization"""
@@ -34,6 +59,11 @@ class CTRLenModel(nn.Module):
         self.sim_loss = args.sim_loss
         self.label_smoothing = args.label_smoothing
 
+        # ids of the added special tokens and the band of the sim loss, built
+        # on the first step, the added tokens do not change during training
+        self.sim_token_ids = None
+        self.sim_band = None
+
     def forward(self, batch, tokenizer):
         """
         batch computation
@@ -62,33 +92,21 @@ class CTRLenModel(nn.Module):
 
         # sim loss for addtional embeddings
         if self.sim_loss:
-            one_side_window_width = int((self.args.sim_window_size - 1) / 2)
-
             if "bart" in self.args.model_type:
-                special_token_weights = self.seq2seq_model.model.shared.weight[
-                    tokenizer.additional_special_tokens_ids
-                ]
+                shared = self.seq2seq_model.model.shared.weight
             else:
-                special_token_weights = self.seq2seq_model.shared.weight[
-                    tokenizer.additional_special_tokens_ids
-                ]
-
-            special_token_weights = nn.functional.normalize(
-                special_token_weights, dim=1
-            )
-
-            cos_sim_matrix = torch.matmul(
-                special_token_weights, special_token_weights.T
-            )
-
-            sim_loss = 0
-            for i in range(-one_side_window_width, one_side_window_width + 1):
-                if i == 0:
-                    continue
-                sim_loss += torch.diagonal(cos_sim_matrix, offset=i).sum()
-
-            sim_loss = cos_sim_matrix.sum() - 2 * sim_loss
-            sim_loss = sim_loss / cos_sim_matrix.shape[0] ** 2
+                shared = self.seq2seq_model.shared.weight
+
+            if self.sim_token_ids is None:
+                one_side_window_width = int((self.args.sim_window_size - 1) / 2)
+                self.sim_token_ids = torch.tensor(
+                    tokenizer.additional_special_tokens_ids, device=shared.device
+                )
+                self.sim_band = sim_band_pairs(
+                    len(self.sim_token_ids), one_side_window_width, shared.device
+                )
+
+            sim_loss = banded_sim_loss(shared[self.sim_token_ids], *self.sim_band)
             loss += self.sim_loss * sim_loss
 
         else:
@@ -1,5 +1,9 @@
 import os
+import json
+import hashlib
+import tempfile
 import numpy as np
+import torch
 
 from transformers import (
     CONFIG_MAPPING,
@@ -7,6 +11,12 @@ from transformers import (
     AutoModelForSeq2SeqLM,
     AutoTokenizer,
 )
+from transformers.utils import WEIGHTS_NAME
+
+from generation_cache import tensor_bytes
+
+START_SNAPSHOT_NAME = "start_snapshot.json"
+ADDED_ROWS_NAME = "added_rows.pt"
 
 
 def model_loader(accelerator, logger, args):
@@ -56,6 +66,7 @@ def model_loader(accelerator, logger, args):
         config=config,
         cache_dir=args.cache_dir,
     )
+    base_vocab_size = model.get_input_embeddings().weight.shape[0]
 
     model.resize_token_embeddings(ori_tokenizer_len)
     model.resize_token_embeddings(len(tokenizer))
@@ -70,9 +81,26 @@ def model_loader(accelerator, logger, args):
         os.makedirs(args.output_dir + "/start", exist_ok=True)
         accelerator.wait_for_everyone()
         unwrapped_model = accelerator.unwrap_model(model)
-        unwrapped_model.save_pretrained(
-            args.output_dir + "/start", save_function=accelerator.save
-        )
+        if args.start_snapshot == "full":
+            unwrapped_model.save_pretrained(
+                args.output_dir + "/start", save_function=accelerator.save
+            )
+        elif args.start_snapshot == "dedup" and accelerator.is_main_process:
+            weight_store = args.weight_store_dir or os.path.join(
+                args.cache_dir or os.path.expanduser("~/.cache/topic-length"),
+                "start_weights",
+            )
+            save_start_snapshot(
+                unwrapped_model,
+                args.output_dir + "/start",
+                base_vocab_size,
+                weight_store,
+            )
+            logger.info(
+                "Initial weights of output_dir/start linked to {}".format(weight_store)
+            )
+        elif accelerator.is_main_process:
+            unwrapped_model.config.save_pretrained(args.output_dir + "/start")
         if accelerator.is_main_process:
             tokenizer.save_pretrained(args.output_dir + "/start")
 
@@ -84,3 +112,212 @@ def model_loader(accelerator, logger, args):
                 f.write(str(index) + ": " + word + "\n")
 
     return config, tokenizer, model
+
+
+def unique_state_dict(model):
+    """state dict without the tied copies (lm_head, embed_tokens), as save_pretrained drops them"""
+
+    state_dict, seen = {}, set()
+    for name, tensor in model.state_dict().items():
+        key = (tensor.data_ptr(), tuple(tensor.shape))
+        if key not in seen:
+            seen.add(key)
+            state_dict[name] = tensor
+
+    return state_dict
+
+
+def enable_activation_checkpointing(model):
+    """checkpoint every encoder and decoder layer, also of the model inside a CTRLenModel"""
+
+    seq2seq_model = getattr(model, "seq2seq_model", model)
+    seq2seq_model.gradient_checkpointing_enable()
+
+
+def snapshot_state(model):
+    """CPU copy of the weights of `model`, tied weights once, pinned next to a GPU"""
+
+    snapshot = {}
+    for name, tensor in unique_state_dict(model).items():
+        copy = tensor.detach().to("cpu", copy=True)
+        snapshot[name] = copy.pin_memory() if tensor.is_cuda else copy
+
+    return snapshot
+
+
+@torch.no_grad()
+def restore_state(model, snapshot):
+    """copy a snapshot_state back into the weights of `model`, in place"""
+
+    state_dict = unique_state_dict(model)
+    if state_dict.keys() != snapshot.keys():
+        raise ValueError("the snapshot does not match the weights of the model")
+    for name, tensor in state_dict.items():
+        tensor.copy_(snapshot[name], non_blocking=True)
+
+
+def _link(source, target):
+    """hardlink, or a symlink across file systems"""
+
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        os.symlink(os.path.abspath(source), target)
+
+
+def _vocab_dim(shape, vocab_size):
+    """the dimension of a weight that runs over the vocabulary, None if there is none"""
+
+    for dim, size in enumerate(shape):
+        if size == vocab_size:
+            return dim
+    return None
+
+
+def save_start_snapshot(model, output_dir, base_vocab_size, weight_store):
+    """
+    initial weights of `model` as a link into a content-addressed `weight_store`,
+    rows appended to the vocabulary (e.g. <t>, </t>) are stored in output_dir as
+    the only per-run weights, load with load_start_snapshot
+    """
+
+    state_dict = unique_state_dict(model)
+    vocab_size = model.get_input_embeddings().weight.shape[0]
+    base, added = {}, {}
+    for name, tensor in state_dict.items():
+        # embeddings (vocab, hidden) and final_logits_bias (1, vocab)
+        dim = _vocab_dim(tensor.shape, vocab_size)
+        if vocab_size > base_vocab_size and dim is not None:
+            base[name] = tensor.narrow(dim, 0, base_vocab_size).clone()
+            added[name] = tensor.narrow(
+                dim, base_vocab_size, vocab_size - base_vocab_size
+            ).clone()
+        else:
+            base[name] = tensor
+
+    digest = hashlib.sha256()
+    for name, tensor in sorted(base.items()):
+        digest.update(name.encode("utf-8"))
+        digest.update(str(tensor.dtype).encode("utf-8"))
+        digest.update(str(tuple(tensor.shape)).encode("utf-8"))
+        digest.update(tensor_bytes(tensor))
+    fingerprint = digest.hexdigest()
+
+    # one copy of the weights across runs
+    os.makedirs(weight_store, exist_ok=True)
+    stored = os.path.join(weight_store, fingerprint + ".bin")
+    if not os.path.exists(stored):
+        # torch.save derives the archive name from the file name, no leading dot
+        handle, tmp_path = tempfile.mkstemp(
+            dir=weight_store, prefix="tmp_", suffix=".bin"
+        )
+        os.close(handle)
+        try:
+            torch.save(base, tmp_path)
+            os.replace(tmp_path, stored)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    os.makedirs(output_dir, exist_ok=True)
+    model.config.save_pretrained(output_dir)
+    _link(stored, os.path.join(output_dir, WEIGHTS_NAME))
+    if added:
+        torch.save(added, os.path.join(output_dir, ADDED_ROWS_NAME))
+    with open(os.path.join(output_dir, START_SNAPSHOT_NAME), "w") as f:
+        json.dump(
+            {
+                "weights": stored,
+                "sha256": fingerprint,
+                "base_vocab_size": base_vocab_size,
+                "added_rows": ADDED_ROWS_NAME if added else None,
+            },
+            f,
+            indent=2,
+        )
+
+
+def load_start_snapshot(model_path):
+    """model of an output_dir/start written by save_start_snapshot (or save_pretrained)"""
+
+    if not os.path.exists(os.path.join(model_path, START_SNAPSHOT_NAME)):
+        return AutoModelForSeq2SeqLM.from_pretrained(model_path)
+
+    with open(os.path.join(model_path, START_SNAPSHOT_NAME), "r") as f:
+        snapshot = json.load(f)
+    config = AutoConfig.from_pretrained(model_path)
+    model = AutoModelForSeq2SeqLM.from_config(config)
+    expected = model.state_dict()
+    state_dict = torch.load(os.path.join(model_path, WEIGHTS_NAME), map_location="cpu")
+    if snapshot["added_rows"] is not None:
+        added = torch.load(
+            os.path.join(model_path, snapshot["added_rows"]), map_location="cpu"
+        )
+        for name, rows in added.items():
+            base = state_dict[name]
+            dim = _vocab_dim(base.shape, snapshot["base_vocab_size"])
+            if name not in expected or dim is None:
+                raise ValueError(
+                    "{}: added rows of {} do not fit the model".format(model_path, name)
+                )
+            state_dict[name] = torch.cat([base, rows], dim=dim)
+
+    # only the tied copies that unique_state_dict left out may be missing
+    result = model.load_state_dict(state_dict, strict=False)
+    tied = set(expected) - set(unique_state_dict(model))
+    untied_missing = set(result.missing_keys) - tied
+    if untied_missing or result.unexpected_keys:
+        raise ValueError(
+            "{} does not match its config: missing {}, unexpected {}".format(
+                model_path, sorted(untied_missing), sorted(result.unexpected_keys)
+            )
+        )
+    model.tie_weights()
+
+    return model
+
+
+QUANTIZED_WEIGHTS_NAME = "quantized_model.pt"
+ONNX_ENCODER_NAME = "encoder_model.onnx"
+
+
+def quantize_model(model):
+    """int8 dynamic quantization of all Linear layers for CPU inference"""
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def checkpoint_loader(model_path, cache_dir=None):
+    """
+    load a checkpoint saved by train.py (e.g. output_dir/best) for inference,
+    also the int8 and ONNX exports written by export.py
+    """
+
+    config = AutoConfig.from_pretrained(model_path, cache_dir=cache_dir)
+    tokenizer = AutoTokenizer.from_pretrained(model_path, cache_dir=cache_dir)
+
+    if os.path.exists(os.path.join(model_path, QUANTIZED_WEIGHTS_NAME)):
+        model = quantize_model(AutoModelForSeq2SeqLM.from_config(config))
+        state_dict = torch.load(
+            os.path.join(model_path, QUANTIZED_WEIGHTS_NAME),
+            map_location="cpu",
+            weights_only=False,
+        )
+        model.load_state_dict(state_dict)
+    elif os.path.exists(os.path.join(model_path, START_SNAPSHOT_NAME)):
+        model = load_start_snapshot(model_path)
+    elif os.path.exists(os.path.join(model_path, ONNX_ENCODER_NAME)):
+        try:
+            from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        except ImportError:
+            raise ImportError("To run an ONNX export: pip install optimum[onnxruntime]")
+        model = ORTModelForSeq2SeqLM.from_pretrained(model_path, config=config)
+    else:
+        model = AutoModelForSeq2SeqLM.from_pretrained(
+            model_path, config=config, cache_dir=cache_dir
+        )
+
+    return config, tokenizer, model
@@ -0,0 +1,150 @@
+import os
+import logging
+import argparse
+
+from filelock import FileLock
+
+# nltk data used by this repo and where nltk.data.find looks for it
+NLTK_RESOURCES = {
+    "punkt": "tokenizers/punkt",
+    "averaged_perceptron_tagger": "taggers/averaged_perceptron_tagger",
+    "wordnet": "corpora/wordnet",
+    "stopwords": "corpora/stopwords",
+}
+
+# resources found by this process, each one is looked up once
+_verified = set()
+
+
+def required_resources(tagging="no", contrastive="no"):
+    """the nltk resources needed by a --tagging/--contrastive setting"""
+
+    # sentence splitting of the summaries and tokenization of the topics
+    resources = ["punkt"]
+    if contrastive in ("synonym", "combine"):
+        resources.append("wordnet")
+    if tagging != "no":
+        resources += ["averaged_perceptron_tagger", "wordnet", "stopwords"]
+
+    return list(dict.fromkeys(resources))
+
+
+def _missing(resources):
+    import nltk
+
+    missing = []
+    for name in resources:
+        if name in _verified:
+            continue
+        try:
+            nltk.data.find(NLTK_RESOURCES[name])
+        except LookupError:
+            missing.append(name)
+            continue
+        _verified.add(name)
+
+    return missing
+
+
+def ensure_nltk_resources(resources, data_dir=None, download=True):
+    """
+    make sure the nltk `resources` can be loaded, `data_dir` is searched first,
+    missing ones are downloaded once into it (or the nltk default directory)
+    under a file lock, without `download` they raise a LookupError instead
+    """
+
+    import nltk
+
+    if data_dir is not None:
+        data_dir = os.path.abspath(data_dir)
+        if data_dir not in nltk.data.path:
+            nltk.data.path.insert(0, data_dir)
+
+    missing = _missing(resources)
+    if not missing:
+        return
+
+    if not download:
+        raise LookupError(
+            "Missing nltk data {} and downloads are disabled (offline mode). Provision it "
+            "once with `python nltk_resources.py --data_dir DIR {}` and pass "
+            "--nltk_data_dir DIR or set NLTK_DATA=DIR".format(
+                missing, " ".join(missing)
+            )
+        )
+
+    if data_dir is None:
+        data_dir = nltk.downloader.Downloader().default_download_dir()
+    os.makedirs(data_dir, exist_ok=True)
+    with FileLock(os.path.join(data_dir, ".nltk.lock")):
+        # another process may have downloaded them while we waited
+        for name in _missing(missing):
+            logging.info("Downloading nltk {} to {}".format(name, data_dir))
+            if not nltk.download(name, download_dir=data_dir, quiet=True):
+                raise LookupError(
+                    "Could not download nltk {}, provision it with `python nltk_resources.py "
+                    "--data_dir DIR {}` where there is network access and pass "
+                    "--nltk_data_dir DIR".format(name, name)
+                )
+        if data_dir not in nltk.data.path:
+            nltk.data.path.insert(0, data_dir)
+
+    still_missing = _missing(missing)
+    if still_missing:
+        raise LookupError(
+            "nltk data {} not found after downloading to {}".format(
+                still_missing, data_dir
+            )
+        )
+
+
+def parse_args():
+    """
+    config arguments for provisioning the nltk data
+    """
+    parser = argparse.ArgumentParser(
+        description="Download the nltk data used by train.py and predict.py, e.g. "
+        "before running on machines without network access"
+    )
+    parser.add_argument(
+        "resources",
+        type=str,
+        nargs="*",
+        help="Resources to download, out of {} (default: all).".format(
+            ", ".join(NLTK_RESOURCES)
+        ),
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        default=None,
+        help="Directory to download into, passed later as --nltk_data_dir "
+        "(default: the nltk default directory).",
+    )
+    args = parser.parse_args()
+
+    unknown = [name for name in args.resources if name not in NLTK_RESOURCES]
+    if unknown:
+        parser.error("unknown nltk resources {}".format(unknown))
+    if not args.resources:
+        args.resources = list(NLTK_RESOURCES)
+
+    return args
+
+
+def main():
+    args = parse_args()
+
+    ensure_nltk_resources(args.resources, data_dir=args.data_dir)
+    logging.info("nltk data available: {}".format(", ".join(args.resources)))
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# main process
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    main()
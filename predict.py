@@ -0,0 +1,393 @@
+import os
+import json
+import time
+import logging
+import argparse
+
+import torch
+from transformers.utils import is_offline_mode
+
+from generation import generation_settings, summarize_sorted
+from generation_cache import GenerationCache, generation_namespace
+from model_loader import checkpoint_loader
+from nltk_resources import ensure_nltk_resources, required_resources
+from special_token import tag_dialogue
+from utils import build_prompt, summary_length
+
+# =  =  =  =  =  =  =  =  =  = Logging Setup =  =  =  =  =  =  =  =  =  =  =  =
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+
+
+def parse_args():
+    """
+    config arguments for prediction
+    """
+    parser = argparse.ArgumentParser(
+        description="Generate summaries from a trained checkpoint"
+    )
+    parser.add_argument(
+        "--model_name_or_path",
+        type=str,
+        required=True,
+        help="Checkpoint saved by train.py, e.g. output_dir/best.",
+    )
+    parser.add_argument(
+        "--input_file",
+        type=str,
+        required=True,
+        help="A jsonl file with one dialogue per line "
+        "(dialogue, topic, length or summary, fname or id), dialogsum test "
+        "records (summary1/topic1, ...) give one prediction per summary.",
+    )
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        required=True,
+        help="A jsonl file for the predictions, finished dialogues are skipped on restart.",
+    )
+    parser.add_argument(
+        "--len_input",
+        type=str,
+        default="topic-length",
+        help="Prompt used when training the checkpoint",
+        choices=(
+            "no",
+            "topic",
+            "length",
+            "topic-length",
+        ),
+    )
+    parser.add_argument(
+        "--tagging",
+        type=str,
+        default="no",
+        help="Tagging used when training the checkpoint",
+        choices=(
+            "no",
+            "word",
+            "prompt",
+        ),
+    )
+    parser.add_argument(
+        "--source_prefix",
+        type=str,
+        default=None,
+        help="A prefix to add before every source text " "(useful for T5 models).",
+    )
+    parser.add_argument(
+        "--max_source_length",
+        type=int,
+        default=1024,
+        help="The maximum total input sequence length after tokenization.",
+    )
+    parser.add_argument(
+        "--min_target_length",
+        type=int,
+        default=1,
+        help="The minimal total sequence length for target text",
+    )
+    parser.add_argument(
+        "--max_target_length",
+        type=int,
+        default=128,
+        help="The maximum total sequence length for target text.",
+    )
+    parser.add_argument(
+        "--length_penalty",
+        type=float,
+        default=1.0,
+        help="large - longer sequence, small - shorter sequence",
+    )
+    parser.add_argument(
+        "--num_beams",
+        type=int,
+        default=4,
+        help="Number of beams to use for generation.",
+    )
+    parser.add_argument(
+        "--length_budget_slack",
+        type=float,
+        default=None,
+        help="End each summary once it reaches the length asked by its "
+        "'Length of Summary: N' prompt plus this fraction of slack (e.g. 0.2).",
+    )
+    parser.add_argument(
+        "--tokens_per_word",
+        type=float,
+        default=1.5,
+        help="Tokens per summary word used to turn the requested length into a token budget.",
+    )
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default="no",
+        choices=("no", "fp16", "bf16"),
+        help="Autocast precision of generation, fp16 needs a GPU, bf16 also works on CPU.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="Batch size for generation.",
+    )
+    parser.add_argument(
+        "--sort_window",
+        type=int,
+        default=16,
+        help="Number of batches read ahead and sorted by length before generation.",
+    )
+    parser.add_argument(
+        "--generation_cache",
+        type=str,
+        default=None,
+        help="sqlite file caching generated summaries by model weights, "
+        "generation settings and input ids.",
+    )
+    parser.add_argument(
+        "--generation_cache_size_mb",
+        type=float,
+        default=1024,
+        help="Size bound of --generation_cache, least recently used entries are evicted.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Cache directory for pre-trained models.",
+    )
+    parser.add_argument(
+        "--nltk_data_dir",
+        type=str,
+        default=None,
+        help="Directory searched first for the nltk data (punkt, and the --tagging resources).",
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+def read_examples(file_path):
+    """stream dialogues from a jsonl file"""
+
+    with open(file_path, "r") as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            example = json.loads(line)
+            example["fname"] = str(example.get("fname", example.get("id", line_number)))
+            for example in annotated_examples(example):
+                if "length" not in example and "summary" in example:
+                    example["length"] = summary_length(example["summary"])
+                yield example
+
+
+def annotated_examples(example):
+    """
+    a dialogsum test record (summary1/topic1, summary2/topic2, ...) becomes one
+    example per annotation, with the ids of the test split of train.py
+    """
+
+    if "summary" in example or "summary1" not in example:
+        return [example]
+
+    examples = []
+    k = 1
+    while "summary{}".format(k) in example:
+        annotated = {
+            key: value
+            for key, value in example.items()
+            if not key.startswith(("summary", "topic"))
+        }
+        annotated["fname"] = "{}_sum{}".format(example["fname"], k)
+        annotated["summary"] = example["summary{}".format(k)]
+        if "topic{}".format(k) in example:
+            annotated["topic"] = example["topic{}".format(k)]
+        examples.append(annotated)
+        k += 1
+
+    return examples
+
+
+def finished_examples(file_path):
+    """
+    ids already written to the output file,
+    a partially written last line is cut off so the file can be appended to
+    """
+
+    finished = set()
+    if not os.path.exists(file_path):
+        return finished
+
+    valid_bytes = 0
+    with open(file_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                prediction = json.loads(line)
+            except ValueError:
+                break
+            finished.add(prediction["fname"])
+            valid_bytes += len(line)
+
+    if valid_bytes != os.path.getsize(file_path):
+        logger.warning("Dropping a partially written line from {}".format(file_path))
+        with open(file_path, "rb+") as f:
+            f.truncate(valid_bytes)
+
+    return finished
+
+
+def missing_prompt_fields(args, example):
+    """fields the --len_input/--tagging prompt needs that `example` lacks"""
+
+    needed = ["dialogue"]
+    if args.len_input in ("topic", "topic-length") or args.tagging != "no":
+        needed.append("topic")
+    if args.len_input in ("length", "topic-length"):
+        needed.append("length")
+
+    return [field for field in needed if example.get(field) is None]
+
+
+def example_prompt(args, example):
+    """build the model input for one dialogue exactly like utils.len_adjust"""
+
+    missing = missing_prompt_fields(args, example)
+    if missing:
+        raise ValueError(
+            "Record {} has no {}, needed by --len_input {} --tagging {}".format(
+                example.get("fname"),
+                " or ".join("`{}`".format(field) for field in missing),
+                args.len_input,
+                args.tagging,
+            )
+        )
+
+    dialogue = example["dialogue"]
+    if args.tagging != "no":
+        dialogue = tag_dialogue(dialogue, example["topic"])
+
+    prompt = build_prompt(
+        args.len_input,
+        args.tagging,
+        dialogue,
+        example.get("topic"),
+        example.get("length"),
+    )
+    prefix = args.source_prefix if args.source_prefix is not None else ""
+
+    return prefix + prompt
+
+
+def chunked(examples, size):
+    """group a stream of examples into lists of `size`"""
+
+    chunk = []
+    for example in examples:
+        chunk.append(example)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def predict_chunk(args, model, tokenizer, chunk, cache=None, namespace=None):
+    """generate a chunk in length-sorted batches and return it in input order"""
+
+    prompts = [example_prompt(args, example) for example in chunk]
+
+    return summarize_sorted(args, model, tokenizer, prompts, cache, namespace)
+
+
+def main():
+    args = parse_args()
+
+    # display parameters
+    logging.info("*** Parameters ***")
+    for item, value in vars(args).items():
+        logging.info("{}: {}".format(item, value))
+    logging.info("")
+
+    # punkt splits the summaries into sentences, the tagger tags the dialogues
+    ensure_nltk_resources(
+        required_resources(args.tagging),
+        data_dir=args.nltk_data_dir,
+        download=not is_offline_mode(),
+    )
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    config, tokenizer, model = checkpoint_loader(
+        args.model_name_or_path, cache_dir=args.cache_dir
+    )
+    model.to(device)
+    model.eval()
+
+    cache, namespace = None, None
+    if args.generation_cache is not None:
+        cache = GenerationCache(args.generation_cache, args.generation_cache_size_mb)
+        namespace = generation_namespace(model, generation_settings(args, model))
+
+    finished = finished_examples(args.output_file)
+    if finished:
+        logger.info("Resuming, {} dialogues already predicted".format(len(finished)))
+
+    pending = (
+        example
+        for example in read_examples(args.input_file)
+        if example["fname"] not in finished
+    )
+
+    num_examples = 0
+    num_tokens = 0
+    start = time.time()
+    with open(args.output_file, "a") as output_file:
+        for chunk in chunked(pending, args.batch_size * args.sort_window):
+            summaries, chunk_tokens = predict_chunk(
+                args, model, tokenizer, chunk, cache, namespace
+            )
+
+            for example, summary in zip(chunk, summaries):
+                prediction = {
+                    "fname": example["fname"],
+                    "topic": example.get("topic"),
+                    "length": example.get("length"),
+                    "gen_summary": summary,
+                }
+                output_file.write(json.dumps(prediction) + "\n")
+            output_file.flush()
+
+            num_examples += len(chunk)
+            num_tokens += chunk_tokens
+            elapsed = time.time() - start
+            logger.info(
+                "Predicted {} dialogues, {:.2f} dialogues/s, {:.1f} tokens/s".format(
+                    num_examples, num_examples / elapsed, num_tokens / elapsed
+                )
+            )
+
+    elapsed = time.time() - start
+    logger.info(
+        "Finished {} dialogues in {:.1f}s ({:.2f} dialogues/s, {:.1f} tokens/s)".format(
+            num_examples,
+            elapsed,
+            num_examples / elapsed if elapsed else 0.0,
+            num_tokens / elapsed if elapsed else 0.0,
+        )
+    )
+    if cache is not None:
+        logger.info("Generation cache: {}".format(cache.stats()))
+        cache.close()
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# main process
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import os
+import re
+import json
+
+# ids of the DialogSum test set carry the reference they were built from
+SUMMARY_ID_PATTERN = re.compile(r"^(?P<fname>.+)_sum(?P<index>\d+)$")
+
+PREDICTION_FORMATS = ("jsonl", "parquet")
+
+
+def _ascii(text):
+    return text.encode("ascii", "ignore").decode("ascii")
+
+
+def prediction_records(ids, prompts, summaries, topics, predictions):
+    """
+    one record per dialogue in the schema of result/*.jsonl, the predictions
+    for "<fname>_sum<k>" become gen_summary<k> (with prompt<k>, the model input
+    of that reference, summary<k> and topic<k>), a plain id gives gen_summary1,
+    records keep the order of first appearance
+    """
+
+    if topics is None:
+        topics = [None] * len(ids)
+
+    records = {}
+    for test_id, prompt, summary, topic, prediction in zip(
+        ids, prompts, summaries, topics, predictions
+    ):
+        match = SUMMARY_ID_PATTERN.match(str(test_id))
+        if match is not None:
+            fname, index = match.group("fname"), match.group("index")
+        else:
+            fname, index = str(test_id), "1"
+        record = records.setdefault(fname, {"fname": fname})
+        record["prompt" + index] = prompt
+        record["gen_summary" + index] = prediction
+        record["summary" + index] = summary
+        if topic is not None:
+            record["topic" + index] = topic
+
+    return list(records.values())
+
+
+class PredictionWriter:
+    """
+    streams records to a jsonl file, or to a parquet file in row groups of
+    `batch_size` records (needs pyarrow)
+    """
+
+    def __init__(self, path, format="jsonl", batch_size=1000):
+        if format not in PREDICTION_FORMATS:
+            raise ValueError(
+                "unknown prediction format {}, use one of {}".format(
+                    format, PREDICTION_FORMATS
+                )
+            )
+        self.path = path
+        self.format = format
+        self.batch_size = batch_size
+        self.buffer = []
+        self.columns = None
+        self.parquet_writer = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if format == "parquet":
+            try:
+                import pyarrow  # noqa: F401
+                import pyarrow.parquet  # noqa: F401
+            except ImportError:
+                raise ImportError(
+                    "--prediction_format parquet needs pyarrow, `pip install pyarrow`"
+                )
+            self.file = None
+        else:
+            self.file = open(path, "w")
+
+    def write(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.format == "jsonl":
+            self.file.write(
+                "".join(json.dumps(record) + "\n" for record in self.buffer)
+            )
+        else:
+            import pyarrow
+            import pyarrow.parquet
+
+            if self.columns is None:
+                # the columns of the first row group, in order of appearance
+                self.columns = list(
+                    {key: None for record in self.buffer for key in record}
+                )
+            table = pyarrow.Table.from_pydict(
+                {
+                    column: [record.get(column) for record in self.buffer]
+                    for column in self.columns
+                }
+            )
+            if self.parquet_writer is None:
+                self.parquet_writer = pyarrow.parquet.ParquetWriter(
+                    self.path, table.schema
+                )
+            self.parquet_writer.write_table(table)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+def write_predictions(path, records, format="jsonl"):
+    writer = PredictionWriter(path, format)
+    for record in records:
+        writer.write(record)
+    writer.close()
+
+
+def write_gen_samples(output_dir, ids, dialogues, summaries, predictions):
+    """legacy output, one <id>.txt per test sample with dialogue, golden and generated summary"""
+
+    os.makedirs(output_dir, exist_ok=True)
+    for test_id, dialogue, summary, prediction in zip(
+        ids, dialogues, summaries, predictions
+    ):
+        with open(os.path.join(output_dir, str(test_id) + ".txt"), "w") as f:
+            f.write(_ascii(dialogue))
+            f.write("\n\n")
+            f.write("Golden Summary:\n")
+            f.write(_ascii(summary))
+            f.write("\n\n")
+            f.write("Generate Summary:\n")
+            f.write(_ascii(prediction))
+
+
+def read_predictions(path):
+    """records of a predictions .jsonl or .parquet file"""
+
+    if path.endswith(".parquet"):
+        import pyarrow.parquet
+
+        return pyarrow.parquet.read_table(path).to_pylist()
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -1,5 +1,348 @@
-import rouge
+import os
 import logging
+import threading
+import multiprocessing
+from collections import Counter
+
+import rouge
+
+# settings of every ROUGE score reported by this repo
+ROUGE_SETTINGS = {
+    "metrics": ["rouge-n", "rouge-l"],
+    "max_n": 2,
+    "limit_length": True,
+    "length_limit": 100,
+    "length_limit_type": "words",
+    "apply_avg": True,
+    "apply_best": False,
+    "alpha": 0.5,  # Default F1_score
+    "weight_factor": 1.2,
+    "stemming": True,
+}
+
+# py-rouge evaluator of this process, used for tokenization and stemming
+_evaluator = None
+
+
+def py_rouge_evaluator():
+    return rouge.Rouge(**ROUGE_SETTINGS)
+
+
+def _get_evaluator():
+    global _evaluator
+    if _evaluator is None:
+        _evaluator = py_rouge_evaluator()
+    return _evaluator
+
+
+# stems of the tokens seen by this process, stemming dominates preprocessing
+_stems = {}
+
+
+def _stem(token):
+    """Rouge.stem_tokens of one token, memoized"""
+
+    if len(token) <= 3:
+        return token
+    if token not in _stems:
+        if token in rouge.Rouge.WORDNET_KEY_VALUE:
+            _stems[token] = rouge.Rouge.WORDNET_KEY_VALUE[token]
+        else:
+            _stems[token] = rouge.Rouge.STEMMER.stem(token)
+    return _stems[token]
+
+
+def _preprocess(text):
+    """lower-casing, tokenization and stemming of Rouge._preprocess_summary_*"""
+
+    text = rouge.Rouge.REMOVE_CHAR_PATTERN.sub(" ", text.lower()).strip()
+    tokens = rouge.Rouge.tokenize_text(
+        rouge.Rouge.KEEP_CANNOT_IN_ONE_WORD.sub("_cannot_", text)
+    )
+    return rouge.Rouge.KEEP_CANNOT_IN_ONE_WORD_REVERSED.sub(
+        "cannot", " ".join(_stem(token) for token in tokens)
+    ).split()
+
+
+def summary_stats(summary):
+    """
+    n-gram counts (ROUGE-N) and sentence tokens (ROUGE-L) of a summary,
+    truncated, tokenized and stemmed exactly as py-rouge does
+    """
+
+    _get_evaluator()  # loads the stemmer and the WordNet exceptions
+    length_limit = ROUGE_SETTINGS["length_limit"]
+    sentences = summary.split("\n")
+
+    # as a whole, truncated to the first words
+    tokens = _preprocess(" ".join(" ".join(sentences).split()[:length_limit]))
+    ngrams = {}
+    for n in range(1, ROUGE_SETTINGS["max_n"] + 1):
+        ngrams[n] = (
+            Counter(zip(*[tokens[i:] for i in range(n)])),
+            len(tokens) - (n - 1),
+        )
+
+    # per sentence, the sentence reaching the limit is cut and ends the summary
+    truncated = []
+    current_length = 0
+    for sentence in sentences:
+        words = sentence.strip().split()
+        if current_length + len(words) < length_limit:
+            truncated.append(" ".join(words))
+            current_length += len(words)
+        else:
+            truncated.append(" ".join(words[: length_limit - current_length]))
+            break
+
+    return ngrams, [_preprocess(sentence) for sentence in truncated]
+
+
+def _lcs_hits(reference, evaluated, mask):
+    """mark the reference tokens of the LCS, with the tie-breaking of py-rouge"""
+
+    m, n = len(reference), len(evaluated)
+    vals = [[0] * (n + 1) for _ in range(m + 1)]
+    for i in range(1, m + 1):
+        token, previous, row = reference[i - 1], vals[i - 1], vals[i]
+        for j in range(1, n + 1):
+            if token == evaluated[j - 1]:
+                row[j] = previous[j - 1] + 1
+            elif previous[j] >= row[j - 1]:
+                row[j] = previous[j]
+            else:
+                row[j] = row[j - 1]
+
+    while m != 0 and n != 0:
+        if reference[m - 1] == evaluated[n - 1]:
+            m -= 1
+            n -= 1
+            mask[m] = 1
+        elif vals[m - 1][n] >= vals[m][n - 1]:
+            m -= 1
+        else:
+            n -= 1
+
+
+def _lcs_counts(evaluated_sentences, reference_sentences):
+    """summary-level LCS counts of py-rouge (Rouge._compute_ngrams_lcs)"""
+
+    evaluated_unigrams = Counter(
+        token for sentence in evaluated_sentences for token in sentence
+    )
+    evaluated_count = sum(len(sentence) for sentence in evaluated_sentences)
+    reference_count = sum(len(sentence) for sentence in reference_sentences)
+
+    overlapping_count = 0.0
+    for reference in reference_sentences:
+        mask = [0] * len(reference)
+        for evaluated in evaluated_sentences:
+            _lcs_hits(reference, evaluated, mask)
+        # py-rouge never decrements its reference counts, every reference
+        # token is available, only hypothesis tokens are used up
+        for token, hit in zip(reference, mask):
+            if hit and evaluated_unigrams[token] > 0:
+                evaluated_unigrams[token] -= 1
+                overlapping_count += 1
+
+    return evaluated_count, reference_count, overlapping_count
+
+
+def score_sample(hypothesis, references):
+    """ROUGE-1/2/L p/r/f of one hypothesis, `references` is a list of summary_stats"""
+
+    alpha = ROUGE_SETTINGS["alpha"]
+    hypothesis_ngrams, hypothesis_sentences = hypothesis
+
+    scores = {}
+    for n, (evaluated, evaluated_count) in hypothesis_ngrams.items():
+        totals = [0, 0, 0]
+        for reference_ngrams, _ in references:
+            reference, reference_count = reference_ngrams[n]
+            totals[0] += evaluated_count
+            totals[1] += reference_count
+            totals[2] += sum(
+                min(count, reference[ngram])
+                for ngram, count in evaluated.items()
+                if ngram in reference
+            )
+        scores["rouge-{}".format(n)] = rouge.Rouge._compute_p_r_f_score(*totals, alpha)
+
+    totals = [0, 0, 0.0]
+    for _, reference_sentences in references:
+        for index, count in enumerate(
+            _lcs_counts(hypothesis_sentences, reference_sentences)
+        ):
+            totals[index] += count
+    scores["rouge-l"] = rouge.Rouge._compute_p_r_f_score(
+        *totals, alpha, ROUGE_SETTINGS["weight_factor"]
+    )
+
+    return scores
+
+
+def _summary_stats_chunk(summaries):
+    return [summary_stats(summary) for summary in summaries]
+
+
+def _sample_scores_chunk(pairs):
+    return [
+        score_sample(summary_stats(hypothesis), references)
+        for hypothesis, references in pairs
+    ]
+
+
+# metrics of every score_sample result and the statistics averaged per metric
+ROUGE_METRICS = [
+    "rouge-{}".format(n) for n in range(1, ROUGE_SETTINGS["max_n"] + 1)
+] + ["rouge-l"]
+ROUGE_STATS = ["f", "p", "r"]
+
+
+def score_totals(samples):
+    """
+    sums of the per-sample p/r/f of every metric followed by the number of
+    samples, summed in order like py-rouge, the totals of disjoint shards add up
+    """
+
+    totals = [0.0] * (len(ROUGE_METRICS) * len(ROUGE_STATS)) + [len(samples)]
+    for sample in samples:
+        for i, metric in enumerate(ROUGE_METRICS):
+            for j, stat in enumerate(ROUGE_STATS):
+                totals[i * len(ROUGE_STATS) + j] += sample[metric][stat]
+
+    return totals
+
+
+def totals_to_scores(totals):
+    """averaged scores of `score_totals` (possibly summed over shards)"""
+
+    count = totals[-1]
+    scores = {}
+    for i, metric in enumerate(ROUGE_METRICS):
+        scores[metric] = {}
+        for j, stat in enumerate(ROUGE_STATS):
+            total = totals[i * len(ROUGE_STATS) + j]
+            scores[metric][stat] = total / count if count > 1 else total
+
+    return scores
+
+
+def average_scores(samples):
+    """average of per-sample scores, summed in order like py-rouge"""
+
+    return totals_to_scores(score_totals(samples))
+
+
+class RougeScorer:
+    """
+    py-rouge scores (ROUGE_SETTINGS) computed over a process pool, references
+    are tokenized and stemmed once and cached across calls (epochs, methods)
+    """
+
+    def __init__(self, num_workers=None, chunk_size=64):
+        if num_workers is None:
+            num_workers = min(8, os.cpu_count() or 1)
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.references = {}
+        self.pool = None
+
+    def _map(self, function, items):
+        chunks = [
+            items[start : start + self.chunk_size]
+            for start in range(0, len(items), self.chunk_size)
+        ]
+        if self.pool is None and threading.current_thread() is threading.main_thread():
+            self.start()
+        if self.pool is None or len(chunks) < 2:
+            # no pool is forked off other threads (e.g. the BackgroundDecoder),
+            # they score serially unless `start` ran on the main thread
+            results = [function(chunk) for chunk in chunks]
+        else:
+            results = self.pool.map(function, chunks)
+
+        return [item for chunk in results for item in chunk]
+
+    def start(self):
+        """
+        fork the worker pool, from the main thread before other threads score
+        (forking while another thread holds a lock can deadlock the workers)
+        """
+
+        if self.pool is None and self.num_workers > 1:
+            # fork: workers must not re-import the training script
+            self.pool = multiprocessing.get_context("fork").Pool(self.num_workers)
+
+        return self
+
+    def get_scores(self, hypotheses, references):
+        """averaged p/r/f of every metric, the output of rouge.Rouge.get_scores"""
+
+        if isinstance(hypotheses, str):
+            hypotheses, references = [hypotheses], [references]
+
+        return average_scores(self.score_samples(hypotheses, references))
+
+    def score_samples(self, hypotheses, references):
+        """p/r/f of every metric for each hypothesis"""
+
+        if isinstance(hypotheses, str):
+            hypotheses, references = [hypotheses], [references]
+        if type(hypotheses) != type(references):
+            raise ValueError("'hyps' and 'refs' are not of the same type")
+        if len(hypotheses) != len(references):
+            raise ValueError("'hyps' and 'refs' do not have the same length")
+
+        # a list of one reference is the same as the reference alone
+        references = [
+            reference if isinstance(reference, list) else [reference]
+            for reference in references
+        ]
+        missing = list(
+            {
+                reference: None
+                for sample in references
+                for reference in sample
+                if reference not in self.references
+            }
+        )
+        self.references.update(zip(missing, self._map(_summary_stats_chunk, missing)))
+
+        pairs = list(
+            zip(
+                hypotheses,
+                [
+                    [self.references[reference] for reference in sample]
+                    for sample in references
+                ],
+            )
+        )
+
+        return self._map(_sample_scores_chunk, pairs)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+# scorer shared by every py_rouge_scores call of this process
+_scorer = None
+
+
+def rouge_scorer(num_workers=None):
+    """the shared RougeScorer, `num_workers` replaces its pool size"""
+
+    global _scorer
+    if _scorer is None:
+        _scorer = RougeScorer(num_workers)
+    elif num_workers is not None and num_workers != _scorer.num_workers:
+        _scorer.close()
+        _scorer.num_workers = num_workers
+
+    return _scorer
 
 
 def prepare_results(m, p, r, f):
@@ -14,22 +357,9 @@ def py_rouge_scores(generated, reference, scores=None):
     """
 
     if not scores:
-        apply_avg = True
-        evaluator = rouge.Rouge(
-            metrics=["rouge-n", "rouge-l"],
-            max_n=2,
-            limit_length=True,
-            length_limit=100,
-            length_limit_type="words",
-            apply_avg=apply_avg,
-            apply_best=False,
-            alpha=0.5,  # Default F1_score
-            weight_factor=1.2,
-            stemming=True,
-        )
         all_hypothesis = generated
         all_references = reference
-        scores = evaluator.get_scores(all_hypothesis, all_references)
+        scores = rouge_scorer().get_scores(all_hypothesis, all_references)
 
         logging.info("")
         for metric, results in sorted(scores.items(), key=lambda x: x[0]):
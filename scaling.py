@@ -0,0 +1,403 @@
+import os
+import sys
+import glob
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import subprocess
+
+import psutil
+
+from tiny_model import build_tiny_model
+
+# =  =  =  =  =  =  =  =  =  = Logging Setup =  =  =  =  =  =  =  =  =  =  =  =
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+
+# number of dialogues in the DialogSum train split, scale 1
+DIALOGSUM_TRAIN_SIZE = 12460
+
+# stages of train.py reported per run
+STAGE_NAMES = ["load", "preprocess", "model", "data", "train", "eval", "test", "rouge"]
+
+
+def parse_args():
+    """
+    config arguments for the scaling harness
+    """
+    parser = argparse.ArgumentParser(
+        description="End-to-end train.py throughput on CPU with a tiny random BART "
+        "and synthetic DialogSum-sized corpora"
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default="./scaling",
+        help="Where to store the tiny model, the synthetic corpora and the runs.",
+    )
+    parser.add_argument(
+        "--base_file",
+        type=str,
+        default="./data/dialogtest/dialogsum.train.jsonl",
+        help="DialogSum jsonl file the synthetic dialogues are sampled from.",
+    )
+    parser.add_argument(
+        "--validation_file",
+        type=str,
+        default="./data/dialogtest/dialogsum.dev.jsonl",
+        help="DialogSum jsonl file used for validation.",
+    )
+    parser.add_argument(
+        "--test_file",
+        type=str,
+        default="./data/dialogtest/dialogsum.test.jsonl",
+        help="DialogSum jsonl file used for test.",
+    )
+    parser.add_argument(
+        "--eval_samples",
+        type=int,
+        default=16,
+        help="Validate and test on the first n dialogues only.",
+    )
+    parser.add_argument(
+        "--scales",
+        type=float,
+        nargs="+",
+        default=[1, 10],
+        help="Train set sizes as multiples of DialogSum (12460 dialogues), e.g. 1 10 100 1000.",
+    )
+    parser.add_argument(
+        "--num_processes",
+        type=int,
+        nargs="+",
+        default=[1, 2],
+        help="Process counts to run every scale with, > 1 runs torchrun with gloo, "
+        "every process pinned to its share of the cores.",
+    )
+    parser.add_argument(
+        "--max_train_steps",
+        type=int,
+        default=50,
+        help="Training steps of every run.",
+    )
+    parser.add_argument(
+        "--per_device_train_batch_size",
+        type=int,
+        default=8,
+        help="Batch size (per process) for training.",
+    )
+    parser.add_argument(
+        "--contrastive",
+        type=str,
+        default="random",
+        help="Contrastive setting passed to train.py",
+        choices=(
+            "no",
+            "random",
+        ),
+    )
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        default=None,
+        help="Write the results as json.",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Random seed.")
+    args = parser.parse_args()
+
+    return args
+
+
+def synthetic_dialogsum(base_file, output_file, num_samples, seed=1):
+    """
+    dialogsum jsonl file of `num_samples` dialogues, every dialogue keeps the
+    topic and summary of a base dialogue and mixes in turns of other dialogues
+    so that the tokenizer sees distinct texts
+    """
+
+    with open(base_file, "r") as f:
+        base = [json.loads(line) for line in f if line.strip()]
+    turns = [sample["dialogue"].split("\n") for sample in base]
+
+    rng = random.Random(seed)
+    with open(output_file, "w") as f:
+        for index in range(num_samples):
+            sample = dict(base[index % len(base)])
+            dialogue = list(turns[index % len(base)])
+            if index >= len(base):
+                other = turns[rng.randrange(len(turns))]
+                position = rng.randrange(len(dialogue))
+                dialogue[position] = other[rng.randrange(len(other))]
+            sample["fname"] = "train_{}".format(index)
+            sample["dialogue"] = "\n".join(dialogue)
+            f.write(json.dumps(sample) + "\n")
+
+
+def head_file(input_file, output_file, num_lines):
+    with open(input_file, "r") as f_in, open(output_file, "w") as f_out:
+        for index, line in enumerate(f_in):
+            if index >= num_lines:
+                break
+            f_out.write(line)
+
+
+def prepare_data(args, scale):
+    """train/dev/test files of one scale, the file names keep 'dialogsum' for raw_data_loader"""
+
+    data_dir = os.path.join(args.work_dir, "x{:g}".format(scale))
+    train_file = os.path.join(data_dir, "dialogsum.train.jsonl")
+    num_samples = max(1, int(round(scale * DIALOGSUM_TRAIN_SIZE)))
+    if not os.path.exists(train_file):
+        os.makedirs(data_dir, exist_ok=True)
+        logger.info(
+            "Writing {} synthetic dialogues to {}".format(num_samples, train_file)
+        )
+        synthetic_dialogsum(args.base_file, train_file, num_samples, args.seed)
+        head_file(
+            args.validation_file,
+            os.path.join(data_dir, "dialogsum.dev.jsonl"),
+            args.eval_samples,
+        )
+        head_file(
+            args.test_file,
+            os.path.join(data_dir, "dialogsum.test.jsonl"),
+            args.eval_samples,
+        )
+
+    return data_dir, num_samples
+
+
+def train_command(args, model_path, data_dir, output_dir, num_processes):
+    command = [sys.executable]
+    if num_processes > 1:
+        # accelerate launch --cpu expects MPI, torchrun with ACCELERATE_USE_CPU
+        # gives gloo processes on a single machine
+        command += [
+            "-m",
+            "torch.distributed.run",
+            "--standalone",
+            "--nproc_per_node",
+            str(num_processes),
+        ]
+    command += [
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "train.py"),
+        "--model_name_or_path",
+        model_path,
+        "--model_type",
+        "bart",
+        "--train_file",
+        os.path.join(data_dir, "dialogsum.train.jsonl"),
+        "--validation_file",
+        os.path.join(data_dir, "dialogsum.dev.jsonl"),
+        "--test_file",
+        os.path.join(data_dir, "dialogsum.test.jsonl"),
+        "--text_column",
+        "dialogue",
+        "--summary_column",
+        "summary",
+        "--len_input",
+        "topic-length",
+        "--contrastive",
+        args.contrastive,
+        "--output_dir",
+        output_dir,
+        "--per_device_train_batch_size",
+        str(args.per_device_train_batch_size),
+        "--max_train_steps",
+        str(args.max_train_steps),
+        "--num_train_epochs",
+        "1",
+        "--max_target_length",
+        "20",
+        "--label_smoothing",
+        "0.1",
+        "--num_beams",
+        "1",
+        "--seed",
+        str(args.seed),
+        "--overwrite_cache",
+        "True",
+    ]
+
+    return command
+
+
+def run_and_watch(command, log_file, env, cwd):
+    """run a command, returns its exit code, seconds and peak RSS of the process tree"""
+
+    start = time.time()
+    peak_rss = 0
+    with open(log_file, "w") as log:
+        process = subprocess.Popen(
+            command, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=cwd
+        )
+        root = psutil.Process(process.pid)
+        while process.poll() is None:
+            try:
+                tree = [root] + root.children(recursive=True)
+                rss = sum(p.memory_info().rss for p in tree if p.is_running())
+                peak_rss = max(peak_rss, rss)
+            except psutil.Error:
+                pass
+            time.sleep(0.2)
+
+    return process.returncode, time.time() - start, peak_rss / 2**20
+
+
+def read_stage_times(output_dir):
+    """
+    stage times of all processes, the slowest process sets the stage time,
+    nested stages (e.g. "train/eval/generate") count towards the innermost
+    of STAGE_NAMES on their path
+    """
+
+    stages, counters = {}, {}
+    for path in glob.glob(os.path.join(output_dir, "stage_times", "*.json")):
+        with open(path, "r") as f:
+            summary = json.load(f)
+        process_stages = {}
+        for name, stage in summary["stages"].items():
+            parts = [part for part in name.split("/") if part in STAGE_NAMES]
+            if parts:
+                process_stages[parts[-1]] = (
+                    process_stages.get(parts[-1], 0.0) + stage["seconds"]
+                )
+        for name, seconds in process_stages.items():
+            stages[name] = max(stages.get(name, 0.0), seconds)
+        for name, value in summary["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+
+    return stages, counters
+
+
+def main():
+    args = parse_args()
+
+    # display parameters
+    logging.info("*** Parameters ***")
+    for item, value in vars(args).items():
+        logging.info("{}: {}".format(item, value))
+    logging.info("")
+
+    args.work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(args.work_dir, exist_ok=True)
+    model_path = os.path.join(args.work_dir, "tiny")
+    if not os.path.exists(os.path.join(model_path, "config.json")):
+        build_tiny_model(model_path, data_files=(args.base_file,), seed=args.seed)
+
+    env = dict(
+        os.environ,
+        ACCELERATE_USE_CPU="true",
+        CUDA_VISIBLE_DEVICES="",
+        TOKENIZERS_PARALLELISM="false",
+    )
+    results = []
+    for scale in args.scales:
+        data_dir, num_samples = prepare_data(args, scale)
+        for num_processes in args.num_processes:
+            output_dir = os.path.join(
+                args.work_dir, "runs", "x{:g}_p{}".format(scale, num_processes)
+            )
+            shutil.rmtree(output_dir, ignore_errors=True)
+            os.makedirs(output_dir)
+            log_file = os.path.join(output_dir, "train.log")
+
+            logger.info(
+                "Training on x{:g} ({} dialogues) with {} process(es), log: {}".format(
+                    scale, num_samples, num_processes, log_file
+                )
+            )
+            command = train_command(
+                args, model_path, data_dir, output_dir, num_processes
+            )
+            returncode, seconds, peak_rss_mb = run_and_watch(
+                command, log_file, env, output_dir
+            )
+            if returncode != 0:
+                logger.warning(
+                    "train.py exited with {}, see {}".format(returncode, log_file)
+                )
+
+            stages, counters = read_stage_times(output_dir)
+            train_seconds = stages.get("train", 0.0) + stages.get("data", 0.0)
+            results.append(
+                {
+                    "scale": scale,
+                    "num_samples": num_samples,
+                    "num_processes": num_processes,
+                    "returncode": returncode,
+                    "seconds": seconds,
+                    "peak_rss_mb": peak_rss_mb,
+                    "examples_per_second": (
+                        counters.get("train_examples", 0) / train_seconds
+                        if train_seconds
+                        else 0.0
+                    ),
+                    "tokens_per_second": (
+                        counters.get("train_tokens", 0) / train_seconds
+                        if train_seconds
+                        else 0.0
+                    ),
+                    "stages": stages,
+                    "counters": counters,
+                }
+            )
+
+    # throughput against perfect scaling of the fewest processes of the scale
+    for result in results:
+        base = min(
+            (other for other in results if other["scale"] == result["scale"]),
+            key=lambda other: other["num_processes"],
+        )
+        ideal = (
+            base["examples_per_second"]
+            * result["num_processes"]
+            / base["num_processes"]
+        )
+        result["scaling_efficiency"] = (
+            result["examples_per_second"] / ideal if ideal else 0.0
+        )
+
+    logger.info(
+        "*** Scaling on CPU, {} train steps per run ***".format(args.max_train_steps)
+    )
+    logger.info(
+        "scale | dialogues | procs | total (s) | ex/s | efficiency | tok/s | peak RSS (MB) | "
+        + " | ".join("{} (s)".format(name) for name in STAGE_NAMES)
+    )
+    for result in results:
+        logger.info(
+            "x{:g} | {} | {} | {:.1f} | {:.1f} | {:.0%} | {:.0f} | {:.0f} | {}{}".format(
+                result["scale"],
+                result["num_samples"],
+                result["num_processes"],
+                result["seconds"],
+                result["examples_per_second"],
+                result["scaling_efficiency"],
+                result["tokens_per_second"],
+                result["peak_rss_mb"],
+                " | ".join(
+                    "{:.1f}".format(result["stages"].get(name, 0.0))
+                    for name in STAGE_NAMES
+                ),
+                "" if result["returncode"] == 0 else " (failed)",
+            )
+        )
+
+    if args.output_file is not None:
+        with open(args.output_file, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# main process
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,420 @@
+import json
+import time
+import queue
+import logging
+import argparse
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from transformers.utils import is_offline_mode
+
+from generation import generation_settings, summarize
+from generation_cache import GenerationCache, generation_namespace
+from model_loader import checkpoint_loader
+from nltk_resources import ensure_nltk_resources, required_resources
+from predict import example_prompt, missing_prompt_fields
+from tiny_model import build_tiny_model
+
+# =  =  =  =  =  =  =  =  =  = Logging Setup =  =  =  =  =  =  =  =  =  =  =  =
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+
+
+def parse_args():
+    """
+    config arguments for serving
+    """
+    parser = argparse.ArgumentParser(
+        description="Serve a trained checkpoint over HTTP with dynamic batching"
+    )
+    parser.add_argument(
+        "--model_name_or_path",
+        type=str,
+        default=None,
+        help="Checkpoint saved by train.py, e.g. output_dir/best.",
+    )
+    parser.add_argument(
+        "--tiny_model",
+        action="store_true",
+        default=False,
+        help="Serve a tiny randomly initialized BART (CPU testing without a checkpoint)",
+    )
+    parser.add_argument(
+        "--len_input",
+        type=str,
+        default="topic-length",
+        help="Prompt used when training the checkpoint",
+        choices=(
+            "no",
+            "topic",
+            "length",
+            "topic-length",
+        ),
+    )
+    parser.add_argument(
+        "--tagging",
+        type=str,
+        default="no",
+        help="Tagging used when training the checkpoint",
+        choices=(
+            "no",
+            "word",
+            "prompt",
+        ),
+    )
+    parser.add_argument(
+        "--source_prefix",
+        type=str,
+        default=None,
+        help="A prefix to add before every source text " "(useful for T5 models).",
+    )
+    parser.add_argument(
+        "--max_source_length",
+        type=int,
+        default=1024,
+        help="The maximum total input sequence length after tokenization.",
+    )
+    parser.add_argument(
+        "--min_target_length",
+        type=int,
+        default=1,
+        help="The minimal total sequence length for target text",
+    )
+    parser.add_argument(
+        "--max_target_length",
+        type=int,
+        default=128,
+        help="The maximum total sequence length for target text.",
+    )
+    parser.add_argument(
+        "--length_penalty",
+        type=float,
+        default=1.0,
+        help="large - longer sequence, small - shorter sequence",
+    )
+    parser.add_argument(
+        "--num_beams",
+        type=int,
+        default=4,
+        help="Number of beams to use for generation.",
+    )
+    parser.add_argument(
+        "--length_budget_slack",
+        type=float,
+        default=None,
+        help="End each summary once it reaches the length asked by its "
+        "'Length of Summary: N' prompt plus this fraction of slack (e.g. 0.2).",
+    )
+    parser.add_argument(
+        "--tokens_per_word",
+        type=float,
+        default=1.5,
+        help="Tokens per summary word used to turn the requested length into a token budget.",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=8,
+        help="Largest batch formed from queued requests.",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=20.0,
+        help="How long the first queued request waits for others to join its batch.",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Bind address.")
+    parser.add_argument("--port", type=int, default=8000, help="Bind port.")
+    parser.add_argument(
+        "--generation_cache",
+        type=str,
+        default=None,
+        help="sqlite file caching generated summaries by model weights, "
+        "generation settings and input ids.",
+    )
+    parser.add_argument(
+        "--generation_cache_size_mb",
+        type=float,
+        default=1024,
+        help="Size bound of --generation_cache, least recently used entries are evicted.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Cache directory for pre-trained models.",
+    )
+    parser.add_argument(
+        "--nltk_data_dir",
+        type=str,
+        default=None,
+        help="Directory searched first for the nltk data (punkt, and the --tagging resources).",
+    )
+    args = parser.parse_args()
+
+    if args.model_name_or_path is None and not args.tiny_model:
+        raise ValueError("Need either --model_name_or_path or --tiny_model.")
+
+    return args
+
+
+class ServingMetrics:
+    """request latency and throughput of the server"""
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_errors = 0
+        self.start = time.time()
+        self.first_request = None
+        self.last_response = None
+
+    def record_batch(self, queued_times, finished):
+        with self.lock:
+            self.latencies.extend(finished - queued for queued in queued_times)
+            self.batch_sizes.append(len(queued_times))
+            self.num_requests += len(queued_times)
+            if self.first_request is None:
+                self.first_request = min(queued_times)
+            self.last_response = finished
+
+    def record_error(self, batch_size):
+        with self.lock:
+            self.num_errors += batch_size
+
+    def snapshot(self, queue_size=0):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            # throughput from the first request to the last response
+            busy = (
+                self.last_response - self.first_request
+                if self.first_request is not None
+                else 0.0
+            )
+            return {
+                "requests": self.num_requests,
+                "errors": self.num_errors,
+                "queue_size": queue_size,
+                "uptime_s": time.time() - self.start,
+                "throughput_rps": self.num_requests / busy if busy else 0.0,
+                "latency_p50_ms": (
+                    float(np.percentile(latencies, 50)) if len(latencies) else None
+                ),
+                "latency_p99_ms": (
+                    float(np.percentile(latencies, 99)) if len(latencies) else None
+                ),
+                "mean_batch_size": (
+                    float(np.mean(self.batch_sizes)) if self.batch_sizes else None
+                ),
+            }
+
+
+class BatchingSummarizer:
+    """
+    queue summarization requests and generate them in batches on a worker thread,
+    a batch is closed when it reaches max_batch_size or when its first request
+    has waited max_wait_ms
+    """
+
+    def __init__(self, args, model, tokenizer, cache=None, namespace=None):
+        self.args = args
+        self.model = model
+        self.tokenizer = tokenizer
+        self.cache = cache
+        self.namespace = namespace
+        self.max_batch_size = args.max_batch_size
+        self.max_wait = args.max_wait_ms / 1000.0
+        self.requests = queue.Queue()
+        self.metrics = ServingMetrics()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, example):
+        """queue one request, returns a Future resolved with the summary"""
+
+        future = Future()
+        prompt = example_prompt(self.args, example)
+        self.requests.put((prompt, future, time.time()))
+        return future
+
+    def next_batch(self):
+        """block for the first request, then gather more until size or deadline"""
+
+        batch = [self.requests.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # requests that queued up during the last batch join without waiting
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self.requests.get(timeout=timeout))
+                else:
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            prompts = [prompt for prompt, _, _ in batch]
+            try:
+                summaries, _ = summarize(
+                    self.args,
+                    self.model,
+                    self.tokenizer,
+                    prompts,
+                    self.cache,
+                    self.namespace,
+                )
+            except Exception as error:
+                logger.exception("Generation failed for a batch of %d", len(batch))
+                self.metrics.record_error(len(batch))
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+
+            self.metrics.record_batch([queued for _, _, queued in batch], time.time())
+            for (_, future, _), summary in zip(batch, summaries):
+                future.set_result(summary)
+
+
+class SummarizationServer(ThreadingHTTPServer):
+    """threaded HTTP server with a listen backlog for bursts of requests"""
+
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_handler(summarizer):
+    """HTTP handler bound to a BatchingSummarizer"""
+
+    class SummarizationHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                metrics = summarizer.metrics.snapshot(summarizer.requests.qsize())
+                if summarizer.cache is not None:
+                    metrics["generation_cache"] = summarizer.cache.stats()
+                self.send_json(200, metrics)
+            elif self.path == "/health":
+                self.send_json(200, {"status": "ok"})
+            else:
+                self.send_json(404, {"error": "unknown path {}".format(self.path)})
+
+        def do_POST(self):
+            if self.path != "/summarize":
+                self.send_json(404, {"error": "unknown path {}".format(self.path)})
+                return
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                example = json.loads(self.rfile.read(length))
+                if not isinstance(example, dict):
+                    raise ValueError("the body must be a json object")
+                missing = missing_prompt_fields(summarizer.args, example)
+                if missing:
+                    raise ValueError(
+                        "missing {}".format(
+                            ", ".join("`{}`".format(field) for field in missing)
+                        )
+                    )
+            except ValueError as error:
+                self.send_json(400, {"error": str(error)})
+                return
+
+            start = time.time()
+            try:
+                summary = summarizer.submit(example).result()
+            except Exception as error:
+                self.send_json(500, {"error": str(error)})
+                return
+
+            self.send_json(
+                200,
+                {
+                    "fname": example.get("fname"),
+                    "summary": summary,
+                    "latency_ms": (time.time() - start) * 1000,
+                },
+            )
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return SummarizationHandler
+
+
+def main():
+    args = parse_args()
+
+    # display parameters
+    logging.info("*** Parameters ***")
+    for item, value in vars(args).items():
+        logging.info("{}: {}".format(item, value))
+    logging.info("")
+
+    # punkt splits the summaries into sentences, the tagger tags the dialogues
+    ensure_nltk_resources(
+        required_resources(args.tagging),
+        data_dir=args.nltk_data_dir,
+        download=not is_offline_mode(),
+    )
+
+    if args.tiny_model:
+        args.model_name_or_path = tempfile.mkdtemp(prefix="tiny_bart_")
+        build_tiny_model(args.model_name_or_path)
+        logger.info("Built a tiny random BART in {}".format(args.model_name_or_path))
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    config, tokenizer, model = checkpoint_loader(
+        args.model_name_or_path, cache_dir=args.cache_dir
+    )
+    model.to(device)
+    model.eval()
+
+    cache, namespace = None, None
+    if args.generation_cache is not None:
+        cache = GenerationCache(args.generation_cache, args.generation_cache_size_mb)
+        namespace = generation_namespace(model, generation_settings(args, model))
+
+    summarizer = BatchingSummarizer(args, model, tokenizer, cache, namespace)
+    server = SummarizationServer((args.host, args.port), make_handler(summarizer))
+    logger.info(
+        "Serving on http://{}:{} (POST /summarize, GET /metrics)".format(
+            args.host, args.port
+        )
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info("Final metrics: {}".format(summarizer.metrics.snapshot()))
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# main process
+if __name__ == "__main__":
+    main()
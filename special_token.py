@@ -2,13 +2,19 @@ from nltk.corpus import wordnet
 from nltk.corpus import stopwords
 import nltk
 
-nltk.download("punkt")
-nltk.download("averaged_perceptron_tagger")
-nltk.download("wordnet")
-nltk.download("stopwords")
+# the nltk data is provisioned by nltk_resources.ensure_nltk_resources,
+# wordnet, stopwords and the tagger are only loaded when first used
+lemmatizer = nltk.stem.WordNetLemmatizer()  # Initiate nltk lemmatizer
 
+# english stopwords, read once
+_stopwords = None
 
-lemmatizer = nltk.stem.WordNetLemmatizer()  # Initiate nltk lemmatizer
+
+def english_stopwords():
+    global _stopwords
+    if _stopwords is None:
+        _stopwords = set(stopwords.words("english"))
+    return _stopwords
 
 
 def simple_tokenize(sentence):
@@ -56,10 +62,17 @@ def build_tagger(original_tokens, lemmatized_tokens, topic_list, idx):
         # If the lemmatized form of the token is in topic seeds, tag the original token
         if token.lower() in token_topics:
             # print(token.lower())
-            if token.lower() not in stopwords.words("english"):
+            if token.lower() not in english_stopwords():
                 # print("="*100)
                 # print(token.lower())
                 original_list[j] = "<t>" + original_list[j] + "</t>"
 
     tagged_tokens.append(" ".join(original_list))
     return tagged_tokens
+
+
+def tag_dialogue(dialogue, topic):
+    """tag the topic words of a single dialogue with <t></t>"""
+    return build_tagger(
+        [simple_tokenize(dialogue)], [lemmatize_text(dialogue)], topic, 0
+    )[0]
@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import itertools
+import subprocess
+from collections import deque
+
+import torch
+
+from metrics import METRICS_FILE_NAME, read_metrics
+
+# =  =  =  =  =  =  =  =  =  = Logging Setup =  =  =  =  =  =  =  =  =  =  =  =
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args():
+    """
+    config arguments for the sweep runner
+    """
+    parser = argparse.ArgumentParser(
+        description="Run a sweep of train.py configurations concurrently on the "
+        "available GPUs or CPU core slices"
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        required=True,
+        help="Sweep json: 'base' train.py arguments, a list of 'runs' (each with a "
+        "'name' and the arguments it changes) and/or a 'grid' of argument values, "
+        "true booleans become bare flags (e.g. run_test).",
+    )
+    parser.add_argument(
+        "--sweep_dir",
+        type=str,
+        default="./output/sweep",
+        help="Where to store the runs (sweep_dir/runs/<name>) and the summary.",
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        nargs="+",
+        default=None,
+        help="CUDA devices, one run at a time on each (default: every visible GPU).",
+    )
+    parser.add_argument(
+        "--cpu_slots",
+        type=int,
+        default=None,
+        help="Without GPUs, split the CPU cores into this many slots running one run each.",
+    )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        default=1,
+        help="Times a failed run is queued again.",
+    )
+    parser.add_argument(
+        "--rerun",
+        action="store_true",
+        default=False,
+        help="Also run the configurations that already have test metrics in sweep_dir.",
+    )
+    parser.add_argument(
+        "--only",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Run only these run names.",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        default=False,
+        help="Print the commands without running them.",
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+def expand_config(config):
+    """(name, train.py arguments) of every run: base + run + one point of the grid"""
+
+    base = config.get("base", {})
+    runs = config.get("runs", [{}])
+    grid = config.get("grid", {})
+    keys = list(grid)
+
+    expanded = []
+    for index, run in enumerate(runs):
+        run = dict(run)
+        name = run.pop("name", None)
+        for values in itertools.product(*[grid[key] for key in keys]):
+            point = dict(zip(keys, values))
+            parts = ([name] if name else []) + [
+                "{}-{}".format(key, value) for key, value in point.items()
+            ]
+            run_name = "_".join(parts) if parts else str(index)
+            arguments = dict(base)
+            arguments.update(run)
+            arguments.update(point)
+            expanded.append((run_name, arguments))
+
+    names = [name for name, _ in expanded]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError("duplicate run names: {}".format(sorted(duplicates)))
+
+    return expanded
+
+
+def train_command(arguments):
+    command = [sys.executable, os.path.join(REPO_DIR, "train.py")]
+    for key, value in arguments.items():
+        if value is None or value is False:
+            continue
+        command.append("--" + key)
+        if value is not True:
+            command.append(str(value))
+
+    return command
+
+
+def make_slots(args):
+    """one slot per device, or per slice of the CPU cores, with the env of its runs"""
+
+    devices = args.devices
+    if devices is None and args.cpu_slots is None and torch.cuda.is_available():
+        devices = [str(index) for index in range(torch.cuda.device_count())]
+    if devices:
+        return [
+            {"name": "cuda:" + device, "env": {"CUDA_VISIBLE_DEVICES": device}}
+            for device in devices
+        ]
+
+    cores = sorted(os.sched_getaffinity(0))
+    num_slots = max(1, min(args.cpu_slots or 1, len(cores)))
+    slots = []
+    for index in range(num_slots):
+        slot_cores = cores[index::num_slots]
+        threads = str(len(slot_cores))
+        slots.append(
+            {
+                "name": "cpu{}".format(",".join(map(str, slot_cores))),
+                "cores": slot_cores,
+                "env": {
+                    "CUDA_VISIBLE_DEVICES": "",
+                    "ACCELERATE_USE_CPU": "true",
+                    "OMP_NUM_THREADS": threads,
+                    "MKL_NUM_THREADS": threads,
+                },
+            }
+        )
+
+    return slots
+
+
+def prefetch_models(runs):
+    """download every hub model once, before concurrent runs race for the same files"""
+
+    from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+
+    for model, cache_dir in {
+        (arguments["model_name_or_path"], arguments.get("cache_dir"))
+        for _, arguments in runs
+        if "model_name_or_path" in arguments
+    }:
+        if os.path.isdir(model):
+            continue
+        try:
+            AutoTokenizer.from_pretrained(model, cache_dir=cache_dir)
+            AutoModelForSeq2SeqLM.from_pretrained(model, cache_dir=cache_dir)
+        except (OSError, ValueError) as error:
+            logger.warning("Could not prefetch {}: {}".format(model, error))
+
+
+def run_results(output_dir):
+    """best validation and test metrics of a run, None before its test"""
+
+    if not os.path.exists(os.path.join(output_dir, METRICS_FILE_NAME)):
+        return None
+    records = read_metrics(output_dir)
+    tests = [record for record in records if record["type"] == "test"]
+    if not tests:
+        return None
+    evals = [
+        record
+        for record in records
+        if record["type"] == "eval" and record.get("rouge2") is not None
+    ]
+    best = max(evals, key=lambda record: record["rouge2"]) if evals else {}
+
+    return {
+        "best_step": best.get("step"),
+        "eval_rouge1": best.get("rouge1"),
+        "eval_rouge2": best.get("rouge2"),
+        "eval_rougeL": best.get("rougeL"),
+        "test_rouge1": tests[-1]["rouge1"],
+        "test_rouge2": tests[-1]["rouge2"],
+        "test_rougeL": tests[-1]["rougeL"],
+    }
+
+
+def launch(run, slot):
+    name, arguments, output_dir = run["name"], run["arguments"], run["output_dir"]
+    os.makedirs(output_dir, exist_ok=True)
+    log = open(os.path.join(output_dir, "train.log"), "w")
+    cores = slot.get("cores")
+
+    process = subprocess.Popen(
+        train_command(arguments),
+        stdout=log,
+        stderr=subprocess.STDOUT,
+        cwd=REPO_DIR,
+        env=dict(os.environ, TOKENIZERS_PARALLELISM="false", **slot["env"]),
+        preexec_fn=(lambda: os.sched_setaffinity(0, cores)) if cores else None,
+    )
+    run["attempts"] += 1
+    logger.info(
+        "Started {} on {} (attempt {})".format(name, slot["name"], run["attempts"])
+    )
+
+    return process, log, time.time()
+
+
+def main():
+    args = parse_args()
+
+    # display parameters
+    logging.info("*** Parameters ***")
+    for item, value in vars(args).items():
+        logging.info("{}: {}".format(item, value))
+    logging.info("")
+
+    with open(args.config, "r") as f:
+        config = json.load(f)
+    sweep_dir = os.path.abspath(args.sweep_dir)
+    runs = []
+    for name, arguments in expand_config(config):
+        if args.only is not None and name not in args.only:
+            continue
+        output_dir = os.path.join(sweep_dir, "runs", name)
+        arguments = dict(arguments, output_dir=output_dir)
+        # runs share the model downloads and the tokenized datasets
+        arguments.setdefault("cache_dir", os.path.join(sweep_dir, "cache"))
+        arguments.setdefault(
+            "preprocessing_cache_dir", os.path.join(sweep_dir, "preprocessing")
+        )
+        runs.append(
+            {
+                "name": name,
+                "arguments": arguments,
+                "output_dir": output_dir,
+                "attempts": 0,
+                "status": "queued",
+                "seconds": 0.0,
+            }
+        )
+
+    if args.dry_run:
+        for run in runs:
+            logger.info(" ".join(train_command(run["arguments"])))
+        return
+
+    queue = deque()
+    for run in runs:
+        results = None if args.rerun else run_results(run["output_dir"])
+        if results is not None:
+            run.update(status="done", results=results)
+            logger.info("Skipping {}, it already has test metrics".format(run["name"]))
+        else:
+            queue.append(run)
+
+    prefetch_models([(run["name"], run["arguments"]) for run in queue])
+
+    slots = make_slots(args)
+    logger.info(
+        "{} runs on {} slot(s): {}".format(
+            len(queue), len(slots), ", ".join(slot["name"] for slot in slots)
+        )
+    )
+    running = {}
+    while queue or running:
+        for index, slot in enumerate(slots):
+            if index not in running and queue:
+                run = queue.popleft()
+                running[index] = (run,) + launch(run, slot)
+
+        time.sleep(1)
+        for index in list(running):
+            run, process, log, start = running[index]
+            if process.poll() is None:
+                continue
+            log.close()
+            del running[index]
+            run["seconds"] += time.time() - start
+            results = run_results(run["output_dir"])
+            if process.returncode == 0 and results is not None:
+                run.update(status="done", results=results)
+                logger.info(
+                    "Finished {} in {:.0f}s, test ROUGE-2 {:.4f}".format(
+                        run["name"], run["seconds"], results["test_rouge2"]
+                    )
+                )
+            elif run["attempts"] <= args.max_retries:
+                logger.warning(
+                    "{} exited with {}, queued again".format(
+                        run["name"], process.returncode
+                    )
+                )
+                queue.append(run)
+            else:
+                run["status"] = "failed"
+                logger.warning(
+                    "{} failed {} time(s), see {}".format(
+                        run["name"],
+                        run["attempts"],
+                        os.path.join(run["output_dir"], "train.log"),
+                    )
+                )
+
+    summary = [
+        dict(
+            {
+                "name": run["name"],
+                "status": run["status"],
+                "attempts": run["attempts"],
+                "seconds": run["seconds"],
+            },
+            **run.get("results", {})
+        )
+        for run in runs
+    ]
+    with open(os.path.join(sweep_dir, "summary.json"), "w") as f:
+        json.dump(
+            {"config": config, "runs": summary},
+            f,
+            indent=2,
+        )
+
+    logger.info("*** Sweep summary ***")
+    logger.info(
+        "run | status | attempts | time (s) | best step | eval R-2 | test R-1 | test R-2 | test R-L"
+    )
+    for run in summary:
+        logger.info(
+            "{} | {} | {} | {:.0f} | {} | {} | {} | {} | {}".format(
+                run["name"],
+                run["status"],
+                run["attempts"],
+                run["seconds"],
+                run.get("best_step"),
+                *[
+                    "{:.4f}".format(run[key]) if run.get(key) is not None else "-"
+                    for key in (
+                        "eval_rouge2",
+                        "test_rouge1",
+                        "test_rouge2",
+                        "test_rougeL",
+                    )
+                ]
+            )
+        )
+    logger.info("Summary saved to {}".format(os.path.join(sweep_dir, "summary.json")))
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# main process
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import gc
+import os
+import json
+import time
+import ctypes
+import resource
+from contextlib import contextmanager
+from collections import defaultdict
+
+import torch
+
+
+def peak_rss_mb():
+    """
+    peak resident memory of this process, VmHWM is reset by exec while
+    ru_maxrss keeps the peak of the parent a spawned process was forked from
+    (both in kilobytes on Linux)
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    """
+    restart peak_rss_mb from the memory in use, the heap freed so far (e.g. a
+    model loaded and then converted) is handed back first (Linux only)
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (OSError, AttributeError):
+        pass
+
+
+class StageTimer:
+    """
+    wall time per pipeline stage, time is attributed to the innermost active
+    stage only, so nested stages (e.g. validation inside training) are not
+    counted twice, nested stages are named by their path (e.g. "eval/save")
+
+    stages pushed with detail=True (forward, backward, generate, ...) are only
+    timed when `detailed`, they then also synchronize CUDA and show up as
+    ranges in a torch.profiler trace
+    """
+
+    def __init__(self, detailed=False):
+        self.detailed = detailed
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.active = []
+        self.ranges = []
+        self.last = None
+        self.start_time = time.perf_counter()
+
+    def _charge(self):
+        if self.detailed and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        if self.active:
+            self.seconds["/".join(self.active)] += now - self.last
+        self.last = now
+
+    def push(self, name, detail=False):
+        if detail and not self.detailed:
+            return
+        self._charge()
+        self.active.append(name)
+        self.calls["/".join(self.active)] += 1
+        if self.detailed:
+            self.ranges.append(torch.profiler.record_function("/".join(self.active)))
+            self.ranges[-1].__enter__()
+
+    def pop(self, detail=False):
+        if detail and not self.detailed:
+            return
+        self._charge()
+        self.active.pop()
+        if self.detailed:
+            self.ranges.pop().__exit__(None, None, None)
+
+    def switch(self, name, detail=False):
+        """end the current stage and start `name`"""
+        self.pop(detail)
+        self.push(name, detail)
+
+    @contextmanager
+    def stage(self, name, detail=False):
+        self.push(name, detail)
+        try:
+            yield
+        finally:
+            self.pop(detail)
+
+    def count(self, name, value):
+        self.counters[name] += int(value)
+
+    def summary(self):
+        total = time.perf_counter() - self.start_time
+        return {
+            "total_s": total,
+            "stages": {
+                name: {"seconds": seconds, "calls": self.calls[name]}
+                for name, seconds in self.seconds.items()
+            },
+            "counters": dict(self.counters),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+    def table(self):
+        """summary lines, slowest stage first"""
+
+        summary = self.summary()
+        lines = ["stage | seconds | % | calls | ms/call"]
+        for name, stage in sorted(
+            summary["stages"].items(), key=lambda item: -item[1]["seconds"]
+        ):
+            lines.append(
+                "{} | {:.2f} | {:.1f}% | {} | {:.2f}".format(
+                    name,
+                    stage["seconds"],
+                    100 * stage["seconds"] / summary["total_s"],
+                    stage["calls"],
+                    1000 * stage["seconds"] / max(stage["calls"], 1),
+                )
+            )
+        lines.append(
+            "total: {:.2f}s, peak RSS {:.0f}MB".format(
+                summary["total_s"], summary["peak_rss_mb"]
+            )
+        )
+
+        return lines
+
+    def log(self, logger):
+        logger.info("*** Stage times ***")
+        for line in self.table():
+            logger.info(line)
+
+    def write(self, output_dir, process_index=0):
+        """output_dir/stage_times/<process index>.json"""
+        os.makedirs(os.path.join(output_dir, "stage_times"), exist_ok=True)
+        path = os.path.join(output_dir, "stage_times", "{}.json".format(process_index))
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def trace_profiler(output_dir, start_step, num_steps, process_index=0):
+    """
+    torch.profiler recording train steps [start_step, start_step + num_steps),
+    exported as a Chrome trace to output_dir/profile_trace_<process index>.json
+    with the slowest operators in output_dir/profile_ops_<process index>.txt,
+    step the returned profiler once per train step
+    """
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    def export(profiler):
+        profiler.export_chrome_trace(
+            os.path.join(output_dir, "profile_trace_{}.json".format(process_index))
+        )
+        path = os.path.join(output_dir, "profile_ops_{}.txt".format(process_index))
+        with open(path, "w") as f:
+            f.write(
+                profiler.key_averages().table(
+                    sort_by="self_cpu_time_total", row_limit=30
+                )
+            )
+
+    return torch.profiler.profile(
+        activities=activities,
+        # one window, the profiler stays idle (and exports once) after it
+        schedule=torch.profiler.schedule(
+            skip_first=start_step, wait=0, warmup=0, active=num_steps, repeat=1
+        ),
+        on_trace_ready=export,
+        profile_memory=True,
+    )
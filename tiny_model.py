@@ -0,0 +1,114 @@
+import os
+import json
+import argparse
+
+import torch
+from tokenizers import ByteLevelBPETokenizer
+from transformers import BartConfig, BartForConditionalGeneration, BartTokenizerFast
+
+
+def corpus_texts(file_paths):
+    """dialogues, summaries and topics of dialogsum jsonl files"""
+
+    for file_path in file_paths:
+        with open(file_path, "r") as f:
+            for line in f:
+                sample = json.loads(line)
+                for key, value in sample.items():
+                    if key != "fname" and isinstance(value, str):
+                        yield value
+
+
+def build_tiny_model(
+    output_dir,
+    data_files=("./data/dialogtest/dialogsum.train.jsonl",),
+    vocab_size=1000,
+    d_model=32,
+    num_layers=1,
+    num_heads=2,
+    ffn_dim=64,
+    max_position_embeddings=1024,
+    seed=0,
+):
+    """
+    build and save a tiny, randomly initialized BART with a BPE tokenizer
+    trained on the bundled data, usable offline wherever facebook/bart-large is
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(
+        corpus_texts(data_files),
+        vocab_size=vocab_size,
+        special_tokens=["<s>", "<pad>", "</s>", "<unk>", "<mask>"],
+    )
+    bpe.save_model(output_dir)
+    tokenizer = BartTokenizerFast(
+        vocab_file=os.path.join(output_dir, "vocab.json"),
+        merges_file=os.path.join(output_dir, "merges.txt"),
+    )
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<t>", "</t>"]})
+    tokenizer.save_pretrained(output_dir)
+
+    config = BartConfig(
+        vocab_size=len(tokenizer),
+        d_model=d_model,
+        encoder_layers=num_layers,
+        decoder_layers=num_layers,
+        encoder_attention_heads=num_heads,
+        decoder_attention_heads=num_heads,
+        encoder_ffn_dim=ffn_dim,
+        decoder_ffn_dim=ffn_dim,
+        max_position_embeddings=max_position_embeddings,
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        decoder_start_token_id=tokenizer.eos_token_id,
+        forced_eos_token_id=tokenizer.eos_token_id,
+        task_specific_params={"summarization": {}},
+    )
+
+    torch.manual_seed(seed)
+    model = BartForConditionalGeneration(config)
+    model.save_pretrained(output_dir)
+
+    return tokenizer, model
+
+
+def parse_args():
+    """
+    config arguments for the tiny model
+    """
+    parser = argparse.ArgumentParser(
+        description="Build a tiny random BART checkpoint for CPU testing"
+    )
+    parser.add_argument(
+        "--output_dir", type=str, required=True, help="Where to store the model."
+    )
+    parser.add_argument(
+        "--data_files",
+        type=str,
+        nargs="+",
+        default=["./data/dialogtest/dialogsum.train.jsonl"],
+        help="jsonl files used to train the tokenizer.",
+    )
+    parser.add_argument("--vocab_size", type=int, default=1000, help="BPE vocab size.")
+    parser.add_argument("--d_model", type=int, default=32, help="Hidden size.")
+    parser.add_argument(
+        "--num_layers", type=int, default=1, help="Encoder and decoder layers."
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    build_tiny_model(
+        args.output_dir,
+        data_files=args.data_files,
+        vocab_size=args.vocab_size,
+        d_model=args.d_model,
+        num_layers=args.num_layers,
+    )
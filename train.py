@@ -3,27 +3,56 @@ import os
 import pprint
 import logging
 import random
-import json
+import time
 
 import datasets
-import nltk
 import numpy as np
+import psutil
 import torch
 from tqdm.auto import tqdm
 
 import transformers
 from accelerate import Accelerator
-from filelock import FileLock
+from accelerate.utils import gather_object
 from transformers import AdamW, get_scheduler, set_seed
 
 from transformers.file_utils import is_offline_mode
 from transformers.utils.versions import require_version
 
 from args import parse_args
-from data_loader import raw_data_loader, data_processor
-from model_loader import model_loader
-from rouge_s import py_rouge_scores
-from utils import label_smoothed_nll_loss, postprocess_text, cosine_embedding_loss
+from cpu_parallel import init_cpu_process_group, partition_cpu_threads
+from data_loader import (
+    raw_data_loader,
+    data_processor,
+    eval_subset_loader,
+    generation_order,
+)
+from generation import (
+    BackgroundDecoder,
+    active_precision,
+    budgeted_generate,
+    cached_generate,
+    generation_settings,
+    length_adherence,
+    padding_report,
+    requested_lengths,
+    restore_order,
+    shard_indices,
+    source_target_lengths,
+)
+from generation_cache import GenerationCache, generation_namespace
+from metrics import MetricsWriter, peak_memory_mb
+from model_loader import (
+    enable_activation_checkpointing,
+    model_loader,
+    restore_state,
+    snapshot_state,
+)
+from nltk_resources import ensure_nltk_resources, required_resources
+from predictions import prediction_records, write_gen_samples, write_predictions
+from rouge_s import py_rouge_scores, rouge_scorer, score_totals, totals_to_scores
+from timing import StageTimer, trace_profiler
+from utils import label_smoothed_nll_loss, contrastive_forward, cosine_embedding_loss
 
 
 # =  =  =  =  =  =  =  =  =  = Logging Setup =  =  =  =  =  =  =  =  =  =  =  =
@@ -41,20 +70,143 @@ require_version(
     "To fix: pip install -r examples/pytorch/summarization/requirements.txt",
 )
 
-try:
-    nltk.data.find("tokenizers/punkt")
-except (LookupError, OSError):
-    if is_offline_mode():
-        raise LookupError(
-            "Offline mode: run this script without TRANSFORMERS_OFFLINE first to download nltk data files"
-        )
-    with FileLock(".lock") as lock:
-        nltk.download("punkt", quiet=True)
-
 # = = = = = = = = = = = = = Main Process = = = = = = = = = = = = = = = = = =
 
 
+def evaluate(
+    args,
+    accelerator,
+    model,
+    tokenizer,
+    dataloader,
+    join_lines=False,
+    order=None,
+    cache=None,
+    namespace=None,
+    timer=None,
+    keep_predictions=False,
+):
+    """
+    generate summaries for a dataloader, return decoded predictions/references
+    and their ROUGE scores, decoding and scoring of a batch overlap the
+    generation of the next one,
+    every process generates and scores its own shard once, without the samples
+    repeated to even out the shards, and only the ROUGE totals are reduced,
+    `order` is the sampler order of a length-sorted dataloader,
+    `cache` a GenerationCache consulted before generating,
+    `timer` a StageTimer that times generate/reduce,
+    `keep_predictions` gathers the predictions/references (None otherwise)
+    """
+    if timer is None:
+        timer = StageTimer()
+    # the test dataloader comes wrapped in tqdm
+    loader = getattr(dataloader, "iterable", dataloader)
+    num_samples = len(loader.dataset)
+    batch_indices = shard_indices(
+        num_samples,
+        loader.batch_sampler.batch_size,
+        order,
+        accelerator.num_processes,
+        accelerator.process_index,
+    )
+
+    generate = budgeted_generate(args, accelerator.unwrap_model(model), tokenizer)
+    decoder = BackgroundDecoder(tokenizer, join_lines, args.len_output)
+    for step, batch in enumerate(dataloader):
+        indices = batch_indices[step]
+        if not indices:
+            # a batch of fill-ins only
+            continue
+        with torch.no_grad():
+            timer.push("generate", detail=True)
+            num_rows = len(indices)
+            generated_tokens = cached_generate(
+                generate,
+                batch["input_ids"][:num_rows],
+                batch["attention_mask"][:num_rows],
+                tokenizer.pad_token_id,
+                cache,
+                namespace,
+            )
+            if isinstance(generated_tokens, tuple):
+                generated_tokens = generated_tokens[0]
+            generated_tokens = generated_tokens.cpu().numpy()
+            labels = batch["labels"][:num_rows].cpu().numpy()
+
+            if args.ignore_pad_token_for_loss:
+                # Replace -100 in the labels as we can't decode them.
+                labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
+
+            decoder.submit(generated_tokens, labels, indices)
+            timer.pop(detail=True)
+
+    # only the batches still being decoded are waited for
+    with timer.stage("rouge"):
+        indices, predictions, references, samples = decoder.result()
+
+    with timer.stage("reduce"):
+        totals = score_totals(samples)
+        if accelerator.num_processes > 1:
+            totals = accelerator.reduce(
+                torch.tensor(totals, dtype=torch.float64, device=accelerator.device),
+                reduction="sum",
+            ).tolist()
+        if int(totals[-1]) != num_samples:
+            raise RuntimeError(
+                "{} of {} samples scored, the shards of the dataloader are not the "
+                "ones shard_indices expects".format(int(totals[-1]), num_samples)
+            )
+        scores = totals_to_scores(totals)
+
+    if not keep_predictions:
+        return None, None, scores
+
+    # only the texts travel, every process gets them in the dataset order
+    with timer.stage("gather"):
+        if accelerator.num_processes > 1:
+            shards = gather_object([(indices, predictions, references)])
+            indices = [index for shard in shards for index in shard[0]]
+            predictions = [text for shard in shards for text in shard[1]]
+            references = [text for shard in shards for text in shard[2]]
+        predictions = restore_order(predictions, indices)
+        references = restore_order(references, indices)
+
+    return predictions, references, scores
+
+
+def save_best_model(args, accelerator, model, tokenizer):
+    """
+    save the current model as output_dir/best
+    """
+    os.makedirs(args.output_dir + "/best", exist_ok=True)
+    accelerator.wait_for_everyone()
+    unwrapped_model = accelerator.unwrap_model(model)
+    unwrapped_model.save_pretrained(
+        args.output_dir + "/best",
+        is_main_process=accelerator.is_main_process,
+        save_function=accelerator.save,
+    )
+    if accelerator.is_main_process:
+        tokenizer.save_pretrained(args.output_dir + "/best")
+
+    if not accelerator.is_main_process:
+        return
+
+    # save vocab
+    vocab = tokenizer.vocab.copy()
+    vocab = {k: v for k, v in sorted(vocab.items(), key=lambda item: item[1])}
+    with open(args.output_dir + "/best/vocab.txt", "w") as f:
+        for word, index in vocab.items():
+            # it lead to encoding bug on some machines, so i add this line
+            word = word.encode("ascii", "ignore").decode("ascii")
+            f.write(str(index) + ": " + word + "\n")
+
+
 def main():
+    # seconds from the process start, imports included
+    process_start = psutil.Process().create_time()
+    import_seconds = time.time() - process_start
+
     args = parse_args()
 
     # display parameters
@@ -64,8 +216,43 @@ def main():
     logging.info("")
 
     # Initialize the accelerator. The accelerator will handle device placement for us.
-    accelerator = Accelerator(mixed_precision="fp16")
+    # a multi-process CPU launch (torchrun) talks over gloo, every process on
+    # its own share of the cores
+    cpu_parallel = init_cpu_process_group()
+    accelerator = Accelerator(mixed_precision=args.mixed_precision)
     logger.info(accelerator.state)
+    if cpu_parallel:
+        cores = partition_cpu_threads(args.cpu_threads_per_process)
+        logger.info(
+            "Process {} runs {} threads on cores {}".format(
+                accelerator.process_index, torch.get_num_threads(), cores
+            )
+        )
+    if (
+        active_precision(args.mixed_precision, accelerator.device)
+        != args.mixed_precision
+    ):
+        logger.warning(
+            "fp16 autocast needs a GPU, training on {} in fp32, use --mixed_precision "
+            "bf16 for mixed precision on CPU".format(accelerator.device)
+        )
+
+    # ROUGE pool, references are cached across validations, forked now on the
+    # main thread since the BackgroundDecoder scores from its worker thread
+    rouge_scorer(args.rouge_workers).start()
+
+    # wall time per pipeline stage, written to output_dir/stage_times,
+    # --profile also times the phases of every train/eval/test step
+    timer = StageTimer(detailed=args.profile)
+
+    # nltk data of the enabled options, looked up once and only downloaded
+    # when missing, by the main process first
+    with accelerator.main_process_first():
+        ensure_nltk_resources(
+            required_resources(args.tagging, args.contrastive),
+            data_dir=args.nltk_data_dir,
+            download=not is_offline_mode(),
+        )
 
     # Setup logging, we only want one process per machine to log things on the screen.
     # accelerator.is_local_main_process is only True for one process per machine.
@@ -100,7 +287,8 @@ def main():
     accelerator.wait_for_everyone()
 
     # load raw dataset
-    raw_datasets = raw_data_loader(args)
+    with timer.stage("load"):
+        raw_datasets = raw_data_loader(args)
 
     # # If passed along, set the training seed now.
     # if args.seed is not None:
@@ -116,14 +304,44 @@ def main():
     #     torch.backends.cudnn.deterministic = True
 
     # load model (config, tokenizer, s2s model)
-    config, tokenizer, model = model_loader(accelerator, logger, args)
+    with timer.stage("model"):
+        config, tokenizer, model = model_loader(accelerator, logger, args)
+
+    # activation checkpointing trades a second forward pass for the memory of
+    # the activations, "negatives" only recomputes the contrastive rows
+    if args.activation_checkpointing == "all":
+        enable_activation_checkpointing(model)
+    elif args.activation_checkpointing == "negatives":
+        if args.contrastive == "no" or args.label_smoothing == 0 or args.ctrlen_model:
+            raise ValueError(
+                "--activation_checkpointing negatives needs --contrastive, "
+                "--label_smoothing > 0 and no --ctrlen_model"
+            )
+        if accelerator.num_processes > 1:
+            raise ValueError(
+                "--activation_checkpointing negatives runs the encoder outside of "
+                "the distributed model, use all with several processes"
+            )
 
     # data processor (for DataLoader)
-    dataloader, processed_dataset = data_processor(
-        logger, args, accelerator, raw_datasets, tokenizer, model
-    )
+    with timer.stage("preprocess"):
+        dataloader, processed_dataset = data_processor(
+            logger, args, accelerator, raw_datasets, tokenizer, model
+        )
     train_dataloader, eval_dataloader, test_dataloader = dataloader
-    train_dataset, _, _ = processed_dataset
+    train_dataset, eval_dataset, test_dataset = processed_dataset
+
+    # fixed validation subset, screened before every full validation pass
+    eval_subset_dataloader = eval_subset_loader(args, eval_dataset, eval_dataloader)
+
+    # length-sorted generation order, needed to restore the dataset order
+    eval_order = generation_order(eval_dataloader)
+    test_order = generation_order(test_dataloader)
+    eval_subset_order = (
+        generation_order(eval_subset_dataloader)
+        if eval_subset_dataloader is not None
+        else None
+    )
 
     # = = = Training Preparation = = =
     # Optimizer
@@ -187,6 +405,11 @@ def main():
     ) = accelerator.prepare(
         model, optimizer, train_dataloader, eval_dataloader, test_dataloader
     )
+    if eval_subset_dataloader is not None:
+        eval_subset_dataloader = accelerator.prepare(eval_subset_dataloader)
+    encoder = None
+    if args.activation_checkpointing == "negatives":
+        encoder = accelerator.unwrap_model(model).get_encoder()
 
     # Scheduler and math around the number of training steps.
     num_update_steps_per_epoch = math.ceil(
@@ -235,30 +458,176 @@ def main():
 
     val_results = []
     acc_losses = []
-    contrastive_losses_all = []
-    contrastive_losses_steps = []
-    contrastive_losses_epoch = []
     best_r2_f1 = None
+    best_subset_r2 = None
     best_epoch = 0
-
+    best_step = 0
+    best_state = None
+    num_bad_evals = 0
+    last_eval_step = None
+    stop_training = False
+
+    # one json line per --metrics_steps optimizer steps and per validation
+    metrics = MetricsWriter(args.output_dir, enabled=accelerator.is_main_process)
+    interval_losses = []
+    interval_contrastive = []
+    interval_start = {
+        "time": time.perf_counter(),
+        "data": 0.0,
+        "examples": 0,
+        "tokens": 0,
+    }
+
+    # a distributed model wraps the transformers model and its config
+    model_config = accelerator.unwrap_model(model).config
     if args.model_type == "bart" or args.model_type == "t5":
-        task_specific_params = model.config.task_specific_params
+        task_specific_params = model_config.task_specific_params
         params = task_specific_params.get("summarization", {})
         params["min_length"] = args.min_target_length
         params["max_length"] = args.max_target_length
         params["length_penalty"] = args.length_penalty
         params["num_beams"] = args.num_beams
-        model.config.update(params)
+        model_config.update(params)
     else:
         raise ValueError("{} model type not implemented".format(args.model_type))
 
+    def validate(epoch):
+        """
+        validate the current model and save it when ROUGE-2 improves,
+        return True once the early stopping patience is used up
+        """
+        nonlocal best_r2_f1, best_subset_r2, best_epoch, best_step, best_state
+        nonlocal num_bad_evals, last_eval_step
+
+        last_eval_step = completed_steps
+        eval_start = time.perf_counter()
+        timer.push("eval")
+        model.eval()
+
+        # screen on the fixed subset, only candidate best checkpoints get a full pass
+        subset_r2 = None
+        if eval_subset_dataloader is not None:
+            _, _, subset_results = evaluate(
+                args,
+                accelerator,
+                model,
+                tokenizer,
+                eval_subset_dataloader,
+                order=eval_subset_order,
+                timer=timer,
+            )
+            logger.info("")
+            logger.info(
+                "Rouge score on val subset after epoch {} step {}".format(
+                    epoch + 1, completed_steps
+                )
+            )
+            py_rouge_scores(None, None, subset_results)
+            subset_r2 = subset_results["rouge-2"]["f"]
+
+        improved = False
+        eval_results = None
+        if best_subset_r2 is None or subset_r2 is None or subset_r2 >= best_subset_r2:
+            _, _, eval_results = evaluate(
+                args,
+                accelerator,
+                model,
+                tokenizer,
+                eval_dataloader,
+                order=eval_order,
+                timer=timer,
+            )
+            logger.info("")
+            logger.info(
+                "Rouge score on val set after epoch {} step {}".format(
+                    epoch + 1, completed_steps
+                )
+            )
+            py_rouge_scores(None, None, eval_results)
+
+            if (
+                best_r2_f1 is None
+                or eval_results["rouge-2"]["f"] >= best_r2_f1["rouge-2"]["f"]
+            ):
+                best_r2_f1 = eval_results
+                best_subset_r2 = subset_r2
+                best_epoch = epoch + 1
+                best_step = completed_steps
+                improved = True
+                with timer.stage("save"):
+                    save_best_model(args, accelerator, model, tokenizer)
+                    if args.restore_best == "memory":
+                        best_state = snapshot_state(accelerator.unwrap_model(model))
+        else:
+            logger.info(
+                "Subset ROUGE-2 is below the best checkpoint, skip the full val set"
+            )
+
+        # = = = = = = = = = = = = = = = = = = = = = = = = =
+        logger.info(
+            "Current Best Validation Result is at epoch {} step {}".format(
+                best_epoch, best_step
+            )
+        )
+        py_rouge_scores(None, None, best_r2_f1)
+        model.train()
+
+        metrics.write(
+            "eval",
+            epoch=epoch + 1,
+            step=completed_steps,
+            subset_rouge2=subset_r2,
+            rouge1=eval_results["rouge-1"]["f"] if eval_results else None,
+            rouge2=eval_results["rouge-2"]["f"] if eval_results else None,
+            rougeL=eval_results["rouge-l"]["f"] if eval_results else None,
+            improved=improved,
+            best_rouge2=best_r2_f1["rouge-2"]["f"],
+            best_step=best_step,
+        )
+        metrics.flush()
+        # keep validation out of the train throughput of the current interval
+        interval_start["time"] += time.perf_counter() - eval_start
+
+        num_bad_evals = 0 if improved else num_bad_evals + 1
+        timer.pop()
+        return (
+            args.early_stopping_patience is not None
+            and num_bad_evals >= args.early_stopping_patience
+        )
+
+    # Chrome trace of a window of train steps
+    profiler = None
+    if args.profile and args.profile_steps > 0:
+        profiler = trace_profiler(
+            args.output_dir,
+            args.profile_start_step,
+            args.profile_steps,
+            accelerator.process_index,
+        )
+        profiler.start()
+
+    # contrastive batches stack negative pairs after the real examples
+    num_views = {"no": 1, "combine": 3}.get(args.contrastive, 2)
+
     # =  =  =  =  =  =  =  =  =  =  =  =  =  =  =  = Train =  =  =  =  =  =  =  =  =  =  =  =  =  =  =
     for epoch in range(args.num_train_epochs):
+        epoch_losses = []
         contrastive_epoch = []
-        contrastive_steps = []
         # train
         model.train()
+        timer.push("data")
         for step, batch in enumerate(train_dataloader):
+            timer.switch("train")
+            timer.count("train_examples", len(batch["input_ids"]) // num_views)
+            timer.count(
+                "train_tokens",
+                batch["attention_mask"].sum().item()
+                + (
+                    (batch["labels"] != -100) & (batch["labels"] != tokenizer.pad_token_id)
+                ).sum().item(),
+            )
+            timer.push("forward", detail=True)
+            loss_cs = None
             if args.ctrlen_model:  # CTRLen model
                 outputs, loss = model(batch, tokenizer)
             # w/ and w/o label smoothing (always better with label smoothing)
@@ -267,18 +636,28 @@ def main():
                     outputs = model(**batch)
                     loss = outputs.loss
                 else:
-                    outputs = model(**batch)
+                    if encoder is not None:
+                        # the encoder is called outside of the prepared model
+                        with accelerator.autocast():
+                            outputs, encoder_states = contrastive_forward(
+                                model, encoder, batch, args.per_device_train_batch_size
+                            )
+                    else:
+                        outputs = model(**batch)
+                        encoder_states = outputs.encoder_last_hidden_state
                     output_logits = outputs.logits
                     output_probs = torch.nn.functional.log_softmax(
                         output_logits, dim=-1
                     )
 
                     if args.contrastive != "no":
-                        max_encoder_token = model.config.max_position_embeddings
-                        embeddings = outputs.encoder_last_hidden_state[
+                        timer.switch("contrastive_loss", detail=True)
+                        max_encoder_token = model_config.max_position_embeddings
+                        embeddings = encoder_states[
                             : args.per_device_train_batch_size, :, :max_encoder_token
                         ]
-                        embeddings = embeddings.reshape(-1, max_encoder_token)
+                        # one row per token, whatever the padding of the batch
+                        embeddings = embeddings.reshape(-1, embeddings.size(-1))
 
                         # plus_one = torch.ones(embeddings.size(dim=0)).to(device)
                         minus_one = -torch.ones(embeddings.size(dim=0)).to(device)
@@ -288,19 +667,22 @@ def main():
                             # plus_one = torch.cat((plus_one, plus_one), 0)
                             minus_one = torch.cat((minus_one, minus_one), 0)
 
-                        pair_embeddings = outputs.encoder_last_hidden_state[
+                        pair_embeddings = encoder_states[
                             args.per_device_train_batch_size :, :, :max_encoder_token
                         ]
-                        pair_embeddings = pair_embeddings.reshape(-1, max_encoder_token)
+                        pair_embeddings = pair_embeddings.reshape(
+                            -1, pair_embeddings.size(-1)
+                        )
                         loss_cs = cosine_embedding_loss(
                             # embeddings, pair_embeddings, plus_one, args.margin
                             embeddings, pair_embeddings, minus_one, args.margin
                         )
 
+                        timer.switch("nll_loss", detail=True)
                         output_probs = output_probs[
                             : args.per_device_train_batch_size, :, :
                         ]
-                        output_probs = output_probs.view(-1, model.config.vocab_size)
+                        output_probs = output_probs.view(-1, model_config.vocab_size)
                         gt_logits = batch["labels"][
                             : args.per_device_train_batch_size, :
                         ]
@@ -315,7 +697,8 @@ def main():
                         loss = loss_nll + (args.alpha * loss_cs)
 
                     else:
-                        output_probs = output_probs.view(-1, model.config.vocab_size)
+                        timer.switch("nll_loss", detail=True)
+                        output_probs = output_probs.view(-1, model_config.vocab_size)
 
                         gt_logits = batch["labels"]
                         gt_logits = gt_logits.view(-1)
@@ -328,141 +711,157 @@ def main():
                         )
             
             acc_losses.append(loss.item())
+            epoch_losses.append(acc_losses[-1])
+            interval_losses.append(acc_losses[-1])
+            if loss_cs is not None:
+                contrastive_epoch.append(loss_cs.item())
+                interval_contrastive.append(contrastive_epoch[-1])
+            timer.switch("backward", detail=True)
             loss = loss / args.gradient_accumulation_steps
             accelerator.backward(loss)
-
-            contrastive_losses_all.append(loss_cs.item())
-
-            contrastive_epoch.append(loss_cs.item())
-            contrastive_steps.append(loss_cs.item())
+            timer.pop(detail=True)
 
             if (
                 step % args.gradient_accumulation_steps == 0
                 or step == len(train_dataloader) - 1
             ):
-                optimizer.step()
-                lr_scheduler.step()
-                optimizer.zero_grad()
+                with timer.stage("optimizer", detail=True):
+                    optimizer.step()
+                    lr_scheduler.step()
+                    optimizer.zero_grad()
                 progress_bar.update(1)
                 progress_bar.set_postfix(
                     lr=lr_scheduler.get_last_lr()[0], loss=np.mean(acc_losses[-50:])
                 )
                 completed_steps += 1
 
-                contrastive_losses_steps.append(np.mean(contrastive_steps))
-
-            if completed_steps >= args.max_train_steps:
-                break
-                 
-        contrastive_losses_epoch.append(np.mean(contrastive_epoch))
-
-        # =  =  =  =  =  =  =  =  =  =  =  =  =  =  =  = EVAL =  =  =  =  =  =  =  =  =  =  =  =  =  =  =
-        model.eval()
-        val_predict = []
-        val_groundtruth = []
-        for step, batch in enumerate(eval_dataloader):
-            with torch.no_grad():
-                generated_tokens = accelerator.unwrap_model(model).generate(
-                    batch["input_ids"], attention_mask=batch["attention_mask"]
-                )
+                if completed_steps == 1:
+                    first_step_seconds = time.time() - process_start
+                    logger.info(
+                        "First optimizer step {:.1f}s after the process start "
+                        "({:.1f}s of imports)".format(first_step_seconds, import_seconds)
+                    )
+                    metrics.write(
+                        "startup",
+                        import_seconds=import_seconds,
+                        first_step_seconds=first_step_seconds,
+                    )
 
-                generated_tokens = accelerator.pad_across_processes(
-                    generated_tokens, dim=1, pad_index=tokenizer.pad_token_id
-                )
-                labels = batch["labels"]
-                if not args.pad_to_max_length:
-                    # If we did not pad to max length, we need to pad the labels too
-                    labels = accelerator.pad_across_processes(
-                        batch["labels"], dim=1, pad_index=tokenizer.pad_token_id
+                if completed_steps % args.metrics_steps == 0:
+                    now = time.perf_counter()
+                    seconds = now - interval_start["time"]
+                    examples = timer.counters["train_examples"]
+                    tokens = timer.counters["train_tokens"]
+                    data_wait = timer.seconds["data"]
+                    metrics.write(
+                        "train",
+                        epoch=epoch + 1,
+                        step=completed_steps,
+                        loss=np.mean(interval_losses),
+                        contrastive_loss=np.mean(interval_contrastive)
+                        if interval_contrastive
+                        else None,
+                        lr=lr_scheduler.get_last_lr()[0],
+                        samples_per_second=(examples - interval_start["examples"])
+                        / seconds,
+                        tokens_per_second=(tokens - interval_start["tokens"]) / seconds,
+                        data_wait_seconds=data_wait - interval_start["data"],
+                        peak_memory_mb=peak_memory_mb(),
                     )
+                    interval_losses = []
+                    interval_contrastive = []
+                    interval_start = {
+                        "time": now,
+                        "data": data_wait,
+                        "examples": examples,
+                        "tokens": tokens,
+                    }
 
-                generated_tokens = accelerator.gather(generated_tokens).cpu().numpy()
-                labels = accelerator.gather(labels).cpu().numpy()
+                if (
+                    args.eval_steps is not None
+                    and completed_steps % args.eval_steps == 0
+                ):
+                    stop_training = validate(epoch)
 
-                if args.ignore_pad_token_for_loss:
-                    # Replace -100 in the labels as we can't decode them.
-                    labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
-                if isinstance(generated_tokens, tuple):
-                    generated_tokens = generated_tokens[0]
+            if profiler is not None:
+                profiler.step()
+            if completed_steps >= args.max_train_steps or stop_training:
+                break
+            timer.switch("data")
+        timer.pop()
+
+        metrics.write(
+            "epoch",
+            epoch=epoch + 1,
+            step=completed_steps,
+            loss=np.mean(epoch_losses),
+            contrastive_loss=np.mean(contrastive_epoch) if contrastive_epoch else None,
+        )
 
-                decoded_preds = tokenizer.batch_decode(
-                    generated_tokens, skip_special_tokens=True
-                )
-                decoded_labels = tokenizer.batch_decode(
-                    labels, skip_special_tokens=True
-                )
+        # =  =  =  =  =  =  =  =  =  =  =  =  =  =  =  = EVAL =  =  =  =  =  =  =  =  =  =  =  =  =  =  =
+        if args.eval_steps is None:
+            stop_training = validate(epoch)
 
-                decoded_preds, decoded_labels = postprocess_text(
-                    decoded_preds, decoded_labels
+        if stop_training:
+            logger.info(
+                "Early stopping: no ROUGE-2 improvement in the last {} validations".format(
+                    args.early_stopping_patience
                 )
-
-                val_predict.extend(decoded_preds)
-                val_groundtruth.extend(decoded_labels)
-
-        if args.len_output == "real":
-            new_val_predict = []
-            for sample in val_predict:
-                try:
-                    gen_sum = sample.split("Summary: ")[2]
-                    new_val_predict.append(gen_sum)
-                except:
-                    new_val_predict.append(sample)
-            val_predict = new_val_predict
-        else:
-            new_val_predict = val_predict
-
-        logger.info("")
-        logger.info("Rouge score on val set after epoch {}".format(epoch + 1))
-        eval_results = py_rouge_scores(val_predict, val_groundtruth)
-
-        if best_r2_f1 is None:
-            best_r2_f1 = eval_results
-        if eval_results["rouge-2"]["f"] >= best_r2_f1["rouge-2"]["f"]:
-            best_r2_f1 = eval_results
-            best_epoch = epoch + 1
-
-            os.makedirs(args.output_dir + "/best", exist_ok=True)
-            accelerator.wait_for_everyone()
-            unwrapped_model = accelerator.unwrap_model(model)
-            unwrapped_model.save_pretrained(
-                args.output_dir + "/best", save_function=accelerator.save
             )
-            if accelerator.is_main_process:
-                tokenizer.save_pretrained(args.output_dir + "/best")
-
-            # save vocab
-            vocab = tokenizer.vocab.copy()
-            vocab = {k: v for k, v in sorted(vocab.items(), key=lambda item: item[1])}
-            with open(args.output_dir + "/best/vocab.txt", "w") as f:
-                for word, index in vocab.items():
-                    # it lead to encoding bug on some machines, so i add this line
-                    word = word.encode("ascii", "ignore").decode("ascii")
-                    f.write(str(index) + ": " + word + "\n")
+            break
 
-        # = = = = = = = = = = = = = = = = = = = = = = = = =
-        logger.info("Current Best Validation Result is at epoch {}".format(best_epoch))
-        py_rouge_scores(None, None, best_r2_f1)
+    # the last steps of a step-based schedule still need a validation
+    if (
+        args.eval_steps is not None
+        and not stop_training
+        and last_eval_step != completed_steps
+    ):
+        validate(epoch)
+
+    if profiler is not None:
+        profiler.stop()
 
     # =  =  =  =  =  =  =  =  =  =  =  =  =  =  =  = Test =  =  =  =  =  =  =  =  =  =  =  =  =  =  =  =  =  =  =
     # load best model
-    logger.info("Loading Best Result is at epoch {} for Testing".format(best_epoch))
+    logger.info(
+        "Loading Best Result is at epoch {} step {} for Testing".format(
+            best_epoch, best_step
+        )
+    )
 
-    unwrapped_model = accelerator.unwrap_model(model)
-    config = config.from_pretrained(args.output_dir + "/best")
-    tokenizer = tokenizer.from_pretrained(args.output_dir + "/best", config=config)
-    unwrapped_model = unwrapped_model.from_pretrained(
-        args.output_dir + "/best", config=config
+    restore_start = time.perf_counter()
+    with timer.stage("restore_best"):
+        if best_state is not None:
+            # the weights saved in output_dir/best, kept in memory
+            restore_state(accelerator.unwrap_model(model), best_state)
+            best_state = None
+            restored_from = "memory"
+        else:
+            unwrapped_model = accelerator.unwrap_model(model)
+            config = config.from_pretrained(args.output_dir + "/best")
+            tokenizer = tokenizer.from_pretrained(
+                args.output_dir + "/best", config=config
+            )
+            unwrapped_model = unwrapped_model.from_pretrained(
+                args.output_dir + "/best", config=config
+            )
+            model = accelerator.prepare(unwrapped_model)
+            restored_from = args.output_dir + "/best"
+    logger.info(
+        "Best weights restored from {} in {:.2f}s".format(
+            restored_from, time.perf_counter() - restore_start
+        )
     )
-    model = accelerator.prepare(unwrapped_model)
 
+    model_config = accelerator.unwrap_model(model).config
     if args.model_type == "bart" or args.model_type == "t5":
-        task_specific_params = model.config.task_specific_params
+        task_specific_params = model_config.task_specific_params
         params = task_specific_params.get("summarization", {})
         params["min_length"] = args.min_target_length
         params["max_length"] = args.max_target_length
         params["length_penalty"] = args.length_penalty
         params["num_beams"] = args.num_beams
-        model.config.update(params)
+        model_config.update(params)
     else:
         raise ValueError("{} model type not implemented".format(args.model_type))
 
@@ -470,125 +869,131 @@ def main():
     logger.info("Collecting Testing Result...")
     model.eval()
 
-    test_predict = []
-    test_groundtruth = []
-    for step, batch in enumerate(tqdm(test_dataloader, leave=False)):
-        with torch.no_grad():
-            generated_tokens = accelerator.unwrap_model(model).generate(
-                batch["input_ids"],
-                attention_mask=batch["attention_mask"],
-            )
-
-            generated_tokens = accelerator.pad_across_processes(
-                generated_tokens, dim=1, pad_index=tokenizer.pad_token_id
+    if test_order is not None:
+        source_lengths, _ = source_target_lengths(test_dataset)
+        padding = padding_report(
+            source_lengths, args.per_device_test_batch_size, test_order
+        )
+        logger.info(
+            "Test source tokens with padding: {} in dataset order, {} sorted by {} "
+            "({:.1f}% fewer, {} real tokens)".format(
+                padding["dataset_order_tokens"],
+                padding["scheduled_tokens"],
+                args.sort_by_length,
+                padding["saved_percent"],
+                padding["real_tokens"],
             )
-            labels = batch["labels"]
-
-            if not args.pad_to_max_length:
-                # If we did not pad to max length, we need to pad the labels too
-                labels = accelerator.pad_across_processes(
-                    batch["labels"], dim=1, pad_index=tokenizer.pad_token_id
-                )
+        )
 
-            generated_tokens = accelerator.gather(generated_tokens).cpu().numpy()
-            labels = accelerator.gather(labels).cpu().numpy()
+    generation_cache, namespace = None, None
+    if args.generation_cache is not None:
+        generation_cache = GenerationCache(
+            args.generation_cache, args.generation_cache_size_mb
+        )
+        unwrapped_model = accelerator.unwrap_model(model)
+        namespace = generation_namespace(
+            unwrapped_model, generation_settings(args, unwrapped_model)
+        )
 
-            if args.ignore_pad_token_for_loss:
-                # Replace -100 in the labels as we can't decode them.
-                labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
-            if isinstance(generated_tokens, tuple):
-                generated_tokens = generated_tokens[0]
+    test_start = time.time()
+    with timer.stage("test"):
+        test_predict, test_groundtruth, test_scores = evaluate(
+            args,
+            accelerator,
+            model,
+            tokenizer,
+            tqdm(test_dataloader, leave=False),
+            join_lines=True,
+            order=test_order,
+            cache=generation_cache,
+            namespace=namespace,
+            timer=timer,
+            keep_predictions=True,
+        )
+    timer.count("test_examples", len(test_predict))
+    logger.info(
+        "Test generation took {:.1f}s (--sort_by_length {}, --length_budget_slack {})".format(
+            time.time() - test_start, args.sort_by_length, args.length_budget_slack
+        )
+    )
 
-            decoded_preds = tokenizer.batch_decode(
-                generated_tokens, skip_special_tokens=True
-            )
-            decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
+    if generation_cache is not None:
+        logger.info("Generation cache: {}".format(generation_cache.stats()))
+        generation_cache.close()
 
-            decoded_preds, decoded_labels = postprocess_text(
-                decoded_preds, decoded_labels
+    adherence = length_adherence(
+        test_predict, requested_lengths(raw_datasets["test"]["dialogue"])
+    )
+    if adherence is not None:
+        logger.info(
+            "Summary length vs requested: mean abs error {:.2f} words, "
+            "mean error {:+.2f} words, {:.1f}% within 10%, {:.1f}% too long".format(
+                adherence["mean_abs_error"],
+                adherence["mean_error"],
+                100 * adherence["within_10_percent"],
+                adherence["over_length_percent"],
             )
-
-            decoded_preds = [" ".join(sent.split("\n")) for sent in decoded_preds]
-            decoded_labels = [" ".join(sent.split("\n")) for sent in decoded_labels]
-
-            test_predict.extend(decoded_preds)
-            test_groundtruth.extend(decoded_labels)
+        )
 
     print(raw_datasets["test"]["dialogue"][0])
 
-    if args.len_output == "real":
-        new_test_predict = []
-        for sample in test_predict:
-            try:
-                gen_sum = sample.split("Summary: ")[2]
-                new_test_predict.append(gen_sum)
-            except:
-                new_test_predict.append(sample)
-        test_predict = new_test_predict
-
     logger.info("")
     logger.info("ROUGE score on test set")
-    test_scores = py_rouge_scores(test_predict, test_groundtruth)
+    py_rouge_scores(None, None, test_scores)
     logger.info("")
 
-    # Save generated summaries
-    if args.len_input == "predict":
-        os.makedirs(args.output_dir + "/predict_gen_samples", exist_ok=True)
-    else:
-        os.makedirs(args.output_dir + "/gen_samples", exist_ok=True)
-
-    for i in range(len(test_predict)):
-        test_id = raw_datasets["test"]["id"][i]
-        test_dialogue = raw_datasets["test"]["dialogue"][i]
-        test_summary = raw_datasets["test"]["summary"][i]
-        test_predict_s = test_predict[i]
-
-        if args.len_input == "predict":
-            with open(
-                args.output_dir + "/predict_gen_samples/" + str(test_id) + ".txt", "w"
-            ) as f:
-                test_dialogue = test_dialogue.encode("ascii", "ignore").decode("ascii")
-                f.write(test_dialogue)
-                f.write("\n\n")
-                f.write("Golden Summary:\n")
-                test_summary = test_summary.encode("ascii", "ignore").decode("ascii")
-                f.write(test_summary)
-                f.write("\n\n")
-                f.write("Generate Summary:\n")
-                test_predict_s = test_predict_s.encode("ascii", "ignore").decode(
-                    "ascii"
-                )
-                f.write(test_predict_s)
-        else:
-            with open(
-                args.output_dir + "/gen_samples/" + str(test_id) + ".txt", "w"
-            ) as f:
-                test_dialogue = test_dialogue.encode("ascii", "ignore").decode("ascii")
-                f.write(test_dialogue)
-                f.write("\n\n")
-                f.write("Golden Summary:\n")
-                test_summary = test_summary.encode("ascii", "ignore").decode("ascii")
-                f.write(test_summary)
-                f.write("\n\n")
-                f.write("Generate Summary:\n")
-                test_predict_s = test_predict_s.encode("ascii", "ignore").decode(
-                    "ascii"
+    # Save generated summaries, the columns are fetched once
+    if accelerator.is_main_process:
+        with timer.stage("save"):
+            test_split = raw_datasets["test"]
+            test_ids = test_split["id"]
+            # the len_adjust model inputs, topic/length prompt included
+            test_prompts = test_split["dialogue"]
+            test_summaries = test_split["summary"]
+            test_topics = (
+                test_split["topic"] if "topic" in test_split.column_names else None
+            )
+            prefix = "predict_" if args.len_input == "predict" else ""
+            predictions_file = os.path.join(
+                args.output_dir,
+                "{}predictions.{}".format(prefix, args.prediction_format),
+            )
+            write_predictions(
+                predictions_file,
+                prediction_records(
+                    test_ids, test_prompts, test_summaries, test_topics, test_predict
+                ),
+                args.prediction_format,
+            )
+            logger.info("Predictions saved to {}".format(predictions_file))
+            if args.legacy_gen_samples:
+                write_gen_samples(
+                    os.path.join(args.output_dir, prefix + "gen_samples"),
+                    test_ids,
+                    test_prompts,
+                    test_summaries,
+                    test_predict,
                 )
-                f.write(test_predict_s)
 
+    metrics.write(
+        "test",
+        step=completed_steps,
+        num_samples=len(test_predict),
+        rouge1=test_scores["rouge-1"]["f"],
+        rouge2=test_scores["rouge-2"]["f"],
+        rougeL=test_scores["rouge-l"]["f"],
+    )
+    metrics.close()
 
-    file_json_all = f'./{args.len_input}_{args.contrastive}_all.json'
-    file_json_steps = f'./{args.len_input}_{args.contrastive}_steps.json'
-    file_json_epoch = f'./{args.len_input}_{args.contrastive}_epoch.json'
-    
-    with open(file_json_all, 'w') as output_file:
-    	print(json.dumps(contrastive_losses_all), file=output_file)
-    
-    with open(file_json_steps, 'w') as output_file:
-    	print(json.dumps(contrastive_losses_steps), file=output_file)
+    timer.log(logger)
+    timer.write(args.output_dir, accelerator.process_index)
+    if args.profile and accelerator.is_main_process:
+        with open(os.path.join(args.output_dir, "profile_summary.txt"), "w") as f:
+            f.write("\n".join(timer.table()) + "\n")
 
-    with open(file_json_epoch, 'w') as output_file:
-    	print(json.dumps(contrastive_losses_epoch), file=output_file)
+    if cpu_parallel:
+        accelerator.wait_for_everyone()
+        torch.distributed.destroy_process_group()
 
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
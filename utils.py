@@ -9,7 +9,9 @@ from nltk.util import ngrams
 from nltk import word_tokenize, sent_tokenize
 
 from datasets import Dataset
+import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 
 def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=-100):
@@ -50,6 +52,48 @@ def postprocess_text(preds, labels):
     return preds, labels
 
 
+def summary_length(summary):
+    """length of a summary in words, as given in the prompt"""
+    return len(summary.split(" "))
+
+
+def build_prompt(len_input, tagging, dialogue, topic=None, sum_len=None):
+    """add the topic and/or length prompt to a dialogue"""
+
+    if len_input == "no":
+        return dialogue
+
+    elif len_input == "topic":
+        if tagging == "word":
+            prompt = "Topic of Summary: <t>{}</t>. Dialogue: ".format(topic)
+        elif tagging == "prompt":
+            prompt = "<t>Topic of Summary: {}</t>. Dialogue: ".format(topic)
+        else:
+            prompt = "Topic of Summary: {}. Dialogue: ".format(topic)
+
+    elif len_input == "length":
+        prompt = "Length of Summary: {}. Dialogue: ".format(sum_len)
+
+    elif len_input == "topic-length":
+        if tagging == "word":
+            prompt = "Topic of Summary: <t>{}</t>. Length of Summary: {}. Dialogue: ".format(
+                topic, sum_len
+            )
+        elif tagging == "prompt":
+            prompt = "<t>Topic of Summary: {}</t>. Length of Summary: {}. Dialogue: ".format(
+                topic, sum_len
+            )
+        else:
+            prompt = "Topic of Summary: {}. Length of Summary: {}. Dialogue: ".format(
+                topic, sum_len
+            )
+
+    else:
+        raise ValueError("{} len_input not implemented".format(len_input))
+
+    return prompt + dialogue
+
+
 def len_adjust(args, split_dict, split_type=None):
     """add length to the input"""
 
@@ -67,72 +111,14 @@ def len_adjust(args, split_dict, split_type=None):
         if args.contrastive == "random" or args.contrastive == "combine":
             dialogue_random_list = split_dict["random_dialogue"]
 
-    if args.len_input == "no":
-        new_dialogue_list = dialogue_list
-
-    elif args.len_input == "topic":
-        new_dialogue_list = []
-        for dialogue, topic in zip(dialogue_list, topic_list):
-            new_dialogue = "Topic of Summary: {}. Dialogue: ".format(topic) + dialogue
-            if args.tagging == "word":
-                new_dialogue = (
-                    "Topic of Summary: <t>{}</t>. Dialogue: ".format(
-                        topic
-                    )
-                    + dialogue
-                )
-            elif args.tagging == "prompt":
-                new_dialogue = (
-                    "<t>Topic of Summary: {}</t>. Dialogue: ".format(
-                        topic
-                    )
-                    + dialogue
-                )
-            else:
-                new_dialogue = (
-                    "Topic of Summary: {}. Dialogue: ".format(
-                        topic
-                    )
-                    + dialogue
-                )
-            new_dialogue_list.append(new_dialogue)
-
-    elif args.len_input == "length":
-        new_dialogue_list = []
-        for dialogue, summary in zip(dialogue_list, summary_list):
-            sum_len = len(summary.split(" "))
-            new_dialogue = (
-                "Length of Summary: {}. Dialogue: ".format(sum_len) + dialogue
-            )
-            new_dialogue_list.append(new_dialogue)
-
-    elif args.len_input == "topic-length":
-        new_dialogue_list = []
-        for dialogue, topic, summary in zip(dialogue_list, topic_list, summary_list):
-            sum_len = len(summary.split(" "))
-            if args.tagging == "word":
-                new_dialogue = (
-                    "Topic of Summary: <t>{}</t>. Length of Summary: {}. Dialogue: ".format(
-                        topic, sum_len
-                    )
-                    + dialogue
-                )
-            elif args.tagging == "prompt":
-                new_dialogue = (
-                    "<t>Topic of Summary: {}</t>. Length of Summary: {}. Dialogue: ".format(
-                        topic, sum_len
-                    )
-                    + dialogue
-                )
-            else:
-                new_dialogue = (
-                    "Topic of Summary: {}. Length of Summary: {}. Dialogue: ".format(
-                        topic, sum_len
-                    )
-                    + dialogue
-                )
-            new_dialogue_list.append(new_dialogue)
+    new_dialogue_list = []
+    for dialogue, topic, summary in zip(dialogue_list, topic_list, summary_list):
+        new_dialogue = build_prompt(
+            args.len_input, args.tagging, dialogue, topic, summary_length(summary)
+        )
+        new_dialogue_list.append(new_dialogue)
 
+    # negative inputs always carry both the topic and the length
     if args.contrastive == "synonym" or args.contrastive == "combine":
         if args.tagging != "no":
             dialogue_list = dialogue_synonym_list
@@ -140,28 +126,9 @@ def len_adjust(args, split_dict, split_type=None):
         for dialogue, synonym, summary in zip(
             dialogue_list, synonym_list, summary_list
         ):
-            sum_len = len(summary.split(" "))
-            if args.tagging == "word":
-                new_dialogue = (
-                    "Topic of Summary: <t>{}</t>. Length of Summary: {}. Dialogue: ".format(
-                        synonym, sum_len
-                    )
-                    + dialogue
-                )
-            elif args.tagging == "prompt":
-                new_dialogue = (
-                    "<t>Topic of Summary: {}</t>. Length of Summary: {}. Dialogue: ".format(
-                        synonym, sum_len
-                    )
-                    + dialogue
-                )
-            else:
-                new_dialogue = (
-                    "Topic of Summary: {}. Length of Summary: {}. Dialogue: ".format(
-                        synonym, sum_len
-                    )
-                    + dialogue
-                )
+            new_dialogue = build_prompt(
+                "topic-length", args.tagging, dialogue, synonym, summary_length(summary)
+            )
             new_synonym_list.append(new_dialogue)
 
     if args.contrastive == "random" or args.contrastive == "combine":
@@ -169,28 +136,9 @@ def len_adjust(args, split_dict, split_type=None):
             dialogue_list = dialogue_random_list
         new_random_list = []
         for dialogue, random, summary in zip(dialogue_list, random_list, summary_list):
-            sum_len = len(summary.split(" "))
-            if args.tagging == "word":
-                new_dialogue = (
-                    "Topic of Summary: <t>{}</t>. Length of Summary: {}. Dialogue: ".format(
-                        random, sum_len
-                    )
-                    + dialogue
-                )
-            elif args.tagging == "prompt":
-                new_dialogue = (
-                    "<t>Topic of Summary: {}</t>. Length of Summary: {}. Dialogue: ".format(
-                        random, sum_len
-                    )
-                    + dialogue
-                )
-            else:
-                new_dialogue = (
-                    "Topic of Summary: {}. Length of Summary: {}. Dialogue: ".format(
-                        random, sum_len
-                    )
-                    + dialogue
-                )
+            new_dialogue = build_prompt(
+                "topic-length", args.tagging, dialogue, random, summary_length(summary)
+            )
             new_random_list.append(new_dialogue)
 
     # elif args.len_input == 'surface':
@@ -242,6 +190,7 @@ def len_adjust(args, split_dict, split_type=None):
         "id": id_list,
         "dialogue": new_dialogue_list,
         "summary": new_summary_list,
+        "topic": topic_list,
     }
 
     if args.contrastive == "synonym" or args.contrastive == "combine":
@@ -258,3 +207,30 @@ def cosine_embedding_loss(pos, neg, contrastive, margin=0.5):
     cs_loss = nn.CosineEmbeddingLoss(margin)
     loss_cosine_embedding = cs_loss(pos, neg, contrastive)
     return loss_cosine_embedding
+
+
+def contrastive_forward(model, encoder, batch, num_positives):
+    """
+    forward of a contrastive batch (positives, then the synonym/random rows),
+    the negative rows only reach the loss through their encoder states, so
+    they skip the decoder and their encoder pass is checkpointed,
+    returns the outputs of the positives and the encoder states of every row
+    """
+
+    positives = {key: value[:num_positives] for key, value in batch.items()}
+    outputs = model(**positives)
+
+    def encode(input_ids, attention_mask):
+        return encoder(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+    negative_states = checkpoint(
+        encode,
+        batch["input_ids"][num_positives:],
+        batch["attention_mask"][num_positives:],
+        use_reentrant=False,
+    )
+    encoder_states = torch.cat(
+        (outputs.encoder_last_hidden_state, negative_states.float()), 0
+    )
+
+    return outputs, encoder_states